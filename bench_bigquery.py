@@ -0,0 +1,195 @@
+"""
+Benchmarks for bigquery.py.
+
+Run with: python bench_bigquery.py [startup] [throughput] [--rows N] [--latency SECONDS]
+
+The throughput benchmarks run each method against a local FakeBigQueryServer
+and report rows/sec, wall time and the peak memory it took. Each one runs in
+a forked process so the peak memory of one doesn't hide the next.
+"""
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import bigquery
+import fake_bigquery
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def run_python(code):
+    """
+    Runs the code in a fresh interpreter and returns the float it prints.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=here)
+    return float(output.strip().split()[-1])
+
+
+def bench_import(repeat=5):
+    """
+    Seconds to import the bigquery module in a fresh process.
+    """
+    code = 'import time; t = time.time(); import bigquery; print time.time() - t'
+    return median([run_python(code) for n in range(repeat)])
+
+
+def bench_first_client(repeat=3, cold=False):
+    """
+    Seconds to create the first BigQuery client in a fresh process.
+
+    :param cold: if True, the cached discovery document is removed first
+    """
+    code = 'import time; t = time.time(); import bigquery; bigquery.BigQuery(); print time.time() - t'
+    times = []
+    for n in range(repeat):
+        if cold and os.path.exists(bigquery.DISCOVERY_CACHE):
+            os.remove(bigquery.DISCOVERY_CACHE)
+        times.append(run_python(code))
+    return median(times)
+
+
+def bench_next_client(repeat=100):
+    """
+    Seconds to create another BigQuery client once one exists in the process.
+    """
+    bigquery.BigQuery()
+    start = time.time()
+    for n in range(repeat):
+        bigquery.BigQuery()
+    return (time.time() - start) / repeat
+
+
+def report(name, seconds):
+    print '%-40s %10.4f s' % (name, seconds)
+
+
+def bench_startup():
+    report('import bigquery', bench_import())
+    if not os.path.exists('key.p12'):
+        print 'key.p12 not found, skipping client benchmarks'
+        return
+    report('first client (no discovery cache)', bench_first_client(cold=True))
+    report('first client (cached discovery)', bench_first_client())
+    report('next client in the same process', bench_next_client())
+
+
+def measure(fn, *args):
+    """
+    Runs fn(*args), which returns a row count, in a forked process.
+
+    Returns (rows, seconds, peak memory in MB above what the process started with).
+    """
+    results = multiprocessing.Queue()
+
+    def run():
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        rows = fn(*args)
+        seconds = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+        results.put((rows, seconds, peak / 1024.0))
+
+    process = multiprocessing.Process(target=run)
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def temp_file():
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    return filename
+
+
+def query(server):
+    return len(server.client().query('select id, name, score'))
+
+
+def iter_query(server):
+    return sum(1 for row in server.client().iter_query('select id, name, score'))
+
+
+def query_columns(server):
+    return len(server.client().query_columns('select id, name, score'))
+
+
+def get_query_results(server, workers=1):
+    client = server.client()
+    jobid = client.query('select id, name, score', 'results_%d' % os.getpid(), write_disposition='WRITE_TRUNCATE')
+    client.wait_for_job(jobid)
+    filename = temp_file()
+    try:
+        client.get_query_results(jobid, filename, workers=workers)
+        return server.rows
+    finally:
+        os.remove(filename)
+
+
+def update_table(server, compress=False):
+    client = server.client()
+    rows = ('%d,name%d,%d.5' % (n, n % 1000, n) for n in range(server.rows))
+    client.wait_for_job(client.update_table('upload_%d' % os.getpid(), rows, '[]', compress=compress))
+    return server.rows
+
+
+def export_table(server, compress=False):
+    client = server.client()
+    table = 'export_%d' % os.getpid()
+    jobid = client.query('select id, name, score', table, write_disposition='WRITE_TRUNCATE')
+    client.wait_for_job(jobid)
+    filename = temp_file()
+    try:
+        client.export_table(table, filename, compress=compress)
+        return server.rows
+    finally:
+        os.remove(filename)
+
+
+def bench_throughput(rows=200000, latency=0):
+    """
+    Runs every throughput benchmark against a local stand-in server.
+    """
+    benchmarks = [('query', query),
+                  ('iter_query', iter_query),
+                  ('query_columns', query_columns),
+                  ('get_query_results', get_query_results),
+                  ('get_query_results (4 workers)', get_query_results, 4),
+                  ('update_table', update_table),
+                  ('update_table (gzip)', update_table, True),
+                  ('export_table', export_table),
+                  ('export_table (gzip)', export_table, True)]
+
+    server = fake_bigquery.FakeBigQueryServer(rows=rows, page_size=10000, latency=latency,
+                                              shard_rows=rows / 4 or 1)
+    server.start()
+    try:
+        print '%-40s %12s %10s %10s' % ('%d rows, %.3fs latency' % (rows, latency), 'rows/sec', 'wall', 'peak MB')
+        for benchmark in benchmarks:
+            name, fn, args = benchmark[0], benchmark[1], benchmark[2:]
+            count, seconds, peak = measure(fn, server, *args)
+            print '%-40s %12d %9.2fs %10.1f' % (name, count / seconds, seconds, peak)
+    finally:
+        server.stop()
+
+
+def main(argv):
+    rows = int(argv[argv.index('--rows') + 1]) if '--rows' in argv else 200000
+    latency = float(argv[argv.index('--latency') + 1]) if '--latency' in argv else 0
+    suites = [arg for arg in argv if arg in ('startup', 'throughput')] or ['startup', 'throughput']
+    if 'startup' in suites:
+        bench_startup()
+    if 'throughput' in suites:
+        bench_throughput(rows, latency)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
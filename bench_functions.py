@@ -0,0 +1,284 @@
+"""
+Benchmarks for functions.py.
+
+Run with: python bench_functions.py [imap] [lxml] [db] [csv] [--messages N] [--latency SECONDS]
+       [--nodes N] [--rows N]
+
+The imap benchmarks delete and fetch messages on a local FakeImapServer, which delays every
+response by latency seconds like a network round trip.
+"""
+import contextlib
+import functools
+import gzip
+import multiprocessing
+import os
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import fake_imap
+import functions
+
+
+def measure(fn):
+    """
+    Runs fn(), which returns a row count, in a forked process.
+
+    Returns (rows, seconds, peak memory in MB above what the process started with).
+    """
+    results = multiprocessing.Queue()
+
+    def run():
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        rows = fn()
+        seconds = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+        results.put((rows, seconds, peak / 1024.0))
+
+    process = multiprocessing.Process(target=run)
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def connect(server):
+    imap = functions.imap_login('127.0.0.1', 'user', 'password', port=server.port, ssl=False)
+    imap.select('INBOX')
+    return imap
+
+
+def delete_batches(imap, message_ids):
+    """
+    How imap_delete_messages used to work: 1,000 literal ids per STORE, one round trip each.
+    """
+    for batch in functions.seq_batch(message_ids, 1000):
+        imap.store(','.join(batch), '+FLAGS', '\\Deleted')
+    imap.expunge()
+
+
+def delete_sequence_sets(imap, message_ids):
+    functions.imap_delete_messages(imap, message_ids)
+
+
+def delete_uids(imap, message_ids):
+    functions.imap_delete_messages(imap, message_ids, uid=True)
+
+
+def bench_imap(messages=100000, latency=0.01):
+    """
+    Deletes every other message (so the ids don't collapse into ranges) and
+    then the first half of the messages (so they do), each way.
+    """
+    benchmarks = [('1000 literal ids per STORE', delete_batches, False),
+                  ('pipelined sequence sets', delete_sequence_sets, False),
+                  ('pipelined UID sequence sets', delete_uids, True)]
+    server = fake_imap.FakeImapServer(messages, latency)
+    server.start()
+    try:
+        print '%-40s %10s %10s %12s' % ('%d messages, %.3fs latency' % (messages, latency),
+                                        'wall', 'commands', 'bytes sent')
+        # after a reset sequence numbers and UIDs are both 1 to messages. SEARCH
+        # isn't used because imaplib refuses replies over 1MB.
+        ids = [str(n) for n in range(1, messages + 1)]
+        for pattern, message_ids in [('every other', ids[::2]), ('first half', ids[:messages / 2])]:
+            for name, fn, uid in benchmarks:
+                server.reset(messages)
+                imap = connect(server)
+                start = time.time()
+                fn(imap, message_ids)
+                seconds = time.time() - start
+                imap.logout()
+                store = server.commands['UID STORE' if uid else 'STORE']
+                print '%-40s %9.2fs %10d %12d' % ('%s: %s' % (pattern, name), seconds, store, server.bytes_received)
+    finally:
+        server.stop()
+
+
+def bench_imap_fetch(messages=100000, latency=0.01):
+    """
+    Fetches every message with one connection and with a pool of them.
+    """
+    server = fake_imap.FakeImapServer(messages, latency)
+    server.start()
+    try:
+        connect = functools.partial(functions.imap_login, '127.0.0.1', 'user', 'password', port=server.port, ssl=False)
+        print '%-40s %12s %10s' % ('fetch %d messages, %.3fs latency' % (messages, latency), 'messages/sec', 'wall')
+        for connections in (1, 4):
+            for batch_size in (100, 1000):
+                start = time.time()
+                count = sum(1 for message in functions.imap_fetch_messages(connect, connections=connections,
+                                                                           batch_size=batch_size))
+                seconds = time.time() - start
+                print '%-40s %12d %9.2fs' % ('%d connections, %d per FETCH' % (connections, batch_size),
+                                             count / seconds, seconds)
+    finally:
+        server.stop()
+
+
+def bench_lxml(nodes=100000, fields=20):
+    """
+    Times extracting the text of each field from every node.
+    """
+    doc = '<items>%s</items>' % ''.join('<item>%s</item>' % ''.join('<f%d>%d</f%d>' % (f, n, f) for f in range(fields))
+                                        for n in range(nodes))
+    items = functions.parse_xml(doc).findall('item')
+    selectors = ['f%d' % f for f in range(fields)]
+
+    def uncompiled():
+        for item in items:
+            for selector in selectors:
+                children = item.xpath('./%s' % selector)
+                children[0].text if children else None
+
+    def cached():
+        for item in items:
+            for selector in selectors:
+                functions.lxml_get_child_value(item, selector)
+
+    def extract():
+        for record in functions.lxml_extract(items, [(selector, selector) for selector in selectors]):
+            pass
+
+    print '%-40s %12s %10s' % ('%d nodes, %d fields' % (nodes, fields), 'nodes/sec', 'wall')
+    for name, fn in [('node.xpath each time', uncompiled),
+                     ('lxml_get_child_value', cached),
+                     ('lxml_extract', extract)]:
+        start = time.time()
+        fn()
+        seconds = time.time() - start
+        print '%-40s %12d %9.2fs' % (name, nodes / seconds, seconds)
+
+
+def bench_db(rows=500000):
+    """
+    Loads rows into an indexed table in a sqlite file each way.
+    """
+    def load(fn):
+        path = tempfile.mkdtemp()
+        try:
+            conn = sqlite3.connect(os.path.join(path, 'bench.db'))
+            conn.execute('CREATE TABLE events (id INTEGER, name TEXT, score REAL)')
+            conn.execute('CREATE INDEX events_name ON events (name)')
+            conn.commit()
+            records = ({'id': n, 'name': 'name%d' % (n % 1000), 'score': n / 2.0} for n in xrange(rows))
+            start = time.time()
+            fn(conn, records)
+            seconds = time.time() - start
+            conn.close()
+            return seconds
+        finally:
+            shutil.rmtree(path)
+
+    def insert(conn, records):
+        for record in records:
+            functions.db_insert(conn, 'events', record)
+        conn.commit()
+
+    def bulk(conn, records):
+        functions.db_bulk_insert(conn, 'events', records)
+
+    def bulk_options(conn, records):
+        functions.db_bulk_insert(conn, 'events', records, pragmas={'journal_mode': 'WAL', 'synchronous': 'OFF'},
+                                 defer_indexes=True)
+
+    print '%-40s %12s %10s' % ('%d rows' % rows, 'rows/sec', 'wall')
+    for name, fn in [('db_insert each row', insert),
+                     ('db_bulk_insert', bulk),
+                     ('db_bulk_insert, pragmas, deferred index', bulk_options)]:
+        seconds = load(fn)
+        print '%-40s %12d %9.2fs' % (name, rows / seconds, seconds)
+
+
+def bench_db_select(rows=500000):
+    """
+    Reads every row of a table back each way, with the peak memory it took.
+    """
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE events (id INTEGER, name TEXT, score REAL)')
+    functions.db_bulk_insert(conn, 'events', ((n, 'name%d' % (n % 1000), n / 2.0) for n in xrange(rows)))
+
+    def select():
+        return len(functions.db_select(conn, 'SELECT * FROM events'))
+
+    def iter_rows():
+        return sum(1 for row in functions.db_iter(conn, 'SELECT * FROM events'))
+
+    def iter_columns():
+        return sum(len(batch['id']) for batch in functions.db_iter(conn, 'SELECT * FROM events', columnar=True))
+
+    print '%-40s %12s %10s %10s' % ('select %d rows' % rows, 'rows/sec', 'wall', 'peak MB')
+    for name, fn in [('db_select', select), ('db_iter', iter_rows), ('db_iter columnar', iter_columns)]:
+        count, seconds, peak = measure(fn)
+        print '%-40s %12d %9.2fs %10.1f' % (name, count / seconds, seconds, peak)
+
+
+def bench_csv(rows=1000000):
+    """
+    Reads a gzipped export of rows rows each way, with the peak memory it took.
+    """
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'export.csv.gz')
+        with contextlib.closing(gzip.open(filename, 'wb')) as f:
+            f.write('id,name,score\n')
+            for n in xrange(rows):
+                f.write('%d,"name, %d",%d.5\n' % (n, n % 1000, n))
+
+        def naive():
+            # how read_csv used to work, after decompressing
+            values = []
+            for line in gzip.open(filename):
+                values.append([field.strip('"') for field in line.strip().split(',')])
+            return len(values) - 1
+
+        def read_csv():
+            return len(functions.read_csv(filename)) - 1
+
+        def iter_csv():
+            return sum(1 for row in functions.iter_csv(filename, header=True))
+
+        def iter_csv_typed():
+            types = {'id': int, 'score': float}
+            return sum(1 for row in functions.iter_csv(filename, ['id', 'score'], types, header=True))
+
+        def iter_csv_columns():
+            chunks = functions.iter_csv_columns(filename, ['id', 'score'], {'id': int, 'score': float}, header=True)
+            return sum(len(chunk['id']) for chunk in chunks)
+
+        print '%-40s %12s %10s %10s' % ('%d csv rows, gzipped' % rows, 'rows/sec', 'wall', 'peak MB')
+        for name, fn in [('split lines into a list', naive),
+                         ('read_csv', read_csv),
+                         ('iter_csv', iter_csv),
+                         ('iter_csv, 2 typed columns', iter_csv_typed),
+                         ('iter_csv_columns, 2 typed columns', iter_csv_columns)]:
+            count, seconds, peak = measure(fn)
+            print '%-40s %12d %9.2fs %10.1f' % (name, count / seconds, seconds, peak)
+    finally:
+        shutil.rmtree(path)
+
+
+def main(argv):
+    messages = int(argv[argv.index('--messages') + 1]) if '--messages' in argv else 100000
+    latency = float(argv[argv.index('--latency') + 1]) if '--latency' in argv else 0.01
+    nodes = int(argv[argv.index('--nodes') + 1]) if '--nodes' in argv else 100000
+    rows = int(argv[argv.index('--rows') + 1]) if '--rows' in argv else 500000
+    suites = [arg for arg in argv if arg in ('imap', 'lxml', 'db', 'csv')] or ['imap', 'lxml', 'db', 'csv']
+    if 'imap' in suites:
+        bench_imap(messages, latency)
+        bench_imap_fetch(messages, latency)
+    if 'lxml' in suites:
+        bench_lxml(nodes)
+    if 'db' in suites:
+        bench_db(rows)
+        bench_db_select(rows)
+    if 'csv' in suites:
+        bench_csv(rows)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
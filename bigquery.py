@@ -1,58 +1,607 @@
 """
 Helper functions for interacting with BigQuery via python.
+
+boto, gsutil and the google api client are slow to import, so they're
+imported the first time they are needed rather than with this module.
+
+Every API request records its latency, bytes, rows and retries in
+metrics.registry, see metrics.registry.summary().
 """
+import os
+import re
 import sys
 import uuid
+import gzip
+import array
+import collections
+import contextlib
+import hashlib
+import shutil
+import marshal
+import zlib
+import tempfile
+import urlparse
 from httplib import BadStatusLine
 import json
+import random
 import time
-
-import httplib2
-
-import boto
-import gslib
-boto.UserAgent += ' gsutil/%s (%s)' % (gslib.VERSION, sys.platform)
+import threading
+import Queue
 import logging
 
-import apiclient.discovery
-import boto.exception
-from gslib import util
-from gslib import GSUTIL_DIR
-from gslib import wildcard_iterator
-from gslib.command_runner import CommandRunner
-from gslib.util import GetBotoConfigFileList
-from gslib.util import GetConfigFilePath
-from gslib.util import HasConfiguredCredentials
-from gslib.util import IsRunningInteractively
-import gslib.exception
-import httplib2
-import oauth2client
-
-# We don't use the oauth2 authentication plugin directly; importing it here
-# ensures that it's loaded and available by default when an operation requiring
-# authentication is performed.
-try:
-  from gslib.third_party.oauth2_plugin import oauth2_plugin
-except ImportError:
-  pass
-
-
-from oauth2client.client import SignedJwtAssertionCredentials, AccessTokenRefreshError
-from apiclient.discovery import build
-
-import gslib.command
-import gslib.util
-from gslib.third_party.oauth2_plugin import oauth2_client
-try:
-    util.InitializeMultiprocessingVariables()
-except:
-    pass
-
-oauth2_client.InitializeMultiprocessingVariables()
+import metrics
 
 
 PROJECT_ID = '558172898018'
 DATASET_ID = 'Activity'
+SERVICE_ACCOUNT = '558172898018@developer.gserviceaccount.com'
+SCOPE = 'https://www.googleapis.com/auth/bigquery'
+EXPORT_BUCKET = 'facts'
+UPLOAD_URL = 'https://www.googleapis.com/upload/bigquery/v2/projects/%s/jobs'
+POOL_SIZE = 8
+# seconds a request waits for the server to accept or send data before it fails
+HTTP_TIMEOUT = 120
+
+# local caches go in a directory only the user can read or write
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                         'bigquery')
+
+# the discovery document describing the BigQuery API is cached on disk for a day. it
+# decides where requests, and the credentials with them, are sent, so only documents
+# for the API root are used.
+DISCOVERY_CACHE = os.path.join(CACHE_DIR, 'discovery-v2.json')
+DISCOVERY_TTL = 24 * 60 * 60
+DISCOVERY_ROOT_URL = 'https://www.googleapis.com/'
+
+# [dataset.table], `project.dataset.table` or a plain name after FROM/JOIN
+TABLE_PATTERN = re.compile(r'\[([^\]]+)\]|`([^`]+)`|\b(?:from|join(?:\s+each)?)\s+(?!each\b)([\w.:-]+)', re.I)
+
+_gsutil_initialized = False
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _init_gsutil():
+    """
+    Imports and initializes boto and gsutil the first time storage is used.
+    """
+    global _gsutil_initialized
+    if _gsutil_initialized:
+        return
+
+    import boto
+    import gslib
+    boto.UserAgent += ' gsutil/%s (%s)' % (gslib.VERSION, sys.platform)
+
+    # We don't use the oauth2 authentication plugin directly; importing it here
+    # ensures that it's loaded and available by default when an operation requiring
+    # authentication is performed.
+    try:
+      from gslib.third_party.oauth2_plugin import oauth2_plugin
+    except ImportError:
+      pass
+
+    from gslib import util
+    from gslib.third_party.oauth2_plugin import oauth2_client
+    try:
+        util.InitializeMultiprocessingVariables()
+    except:
+        pass
+
+    oauth2_client.InitializeMultiprocessingVariables()
+    _gsutil_initialized = True
+
+
+def _client(key_file, service_account=SERVICE_ACCOUNT, scope=SCOPE):
+    """
+    Returns (credentials, pool, service) for the service account, where pool
+    is an HttpPool of connections authorized with the credentials.
+
+    They're created the first time they're asked for and then shared by every
+    BigQuery object in the process, so the key is only read and signed once.
+    """
+    key = (key_file, service_account, scope)
+    with _clients_lock:
+        if key not in _clients:
+            from oauth2client.client import SignedJwtAssertionCredentials
+
+            with open(key_file) as f:
+                private_key = f.read()
+
+            credentials = SignedJwtAssertionCredentials(
+                service_account_name=service_account,
+                private_key=private_key,
+                scope=scope)
+
+            pool = HttpPool(credentials, POOL_SIZE)
+            with pool.connection() as http:
+                service = _build_service(http)
+            _clients[key] = (credentials, pool, service)
+        return _clients[key]
+
+
+def _makedirs(path):
+    """
+    Creates the directory, if it doesn't exist, so only the user can read or write it.
+    """
+    try:
+        os.makedirs(path, 0700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _build_service(http):
+    """
+    Builds the BigQuery service from the discovery document cached at
+    DISCOVERY_CACHE, fetching it first if it's missing, older than
+    DISCOVERY_TTL or doesn't send requests to DISCOVERY_ROOT_URL.
+    """
+    from apiclient.discovery import build_from_document, DISCOVERY_URI
+
+    document = None
+    try:
+        if time.time() - os.path.getmtime(DISCOVERY_CACHE) < DISCOVERY_TTL:
+            with open(DISCOVERY_CACHE) as f:
+                document = _check_discovery(f.read())
+    except (IOError, OSError, ValueError):
+        document = None
+
+    if document is None:
+        resp, document = http.request(DISCOVERY_URI.format(api='bigquery', apiVersion='v2'))
+        if resp.status != 200:
+            raise ValueError('could not fetch the BigQuery discovery document: %s' % resp.status)
+        _check_discovery(document)
+        _makedirs(os.path.dirname(DISCOVERY_CACHE))
+        # write to a temporary file first so other processes never read half of it
+        temp_file = '%s.%s' % (DISCOVERY_CACHE, uuid.uuid4())
+        with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), 'w') as f:
+            f.write(document)
+        os.rename(temp_file, DISCOVERY_CACHE)
+
+    return build_from_document(document, http=http)
+
+
+def _check_discovery(document):
+    """
+    Returns the discovery document, or raises ValueError if it isn't JSON or
+    would send requests anywhere but DISCOVERY_ROOT_URL.
+    """
+    description = json.loads(document)
+    root = description.get('rootUrl')
+    urls = [root, description.get('baseUrl', root), urlparse.urljoin(root or '', description.get('servicePath', ''))]
+    if root != DISCOVERY_ROOT_URL or not all((url or '').startswith(DISCOVERY_ROOT_URL) for url in urls):
+        raise ValueError('the discovery document sends requests to %s, not %s' % (root, DISCOVERY_ROOT_URL))
+    return document
+
+
+def query_tables(query):
+    """
+    Returns the ids of the tables a query reads from, without project or dataset.
+    """
+    names = [''.join(match) for match in TABLE_PATTERN.findall(query)]
+    return sorted(set(_table_id(name) for name in names))
+
+
+def _table_id(name):
+    return name.split('.')[-1].split(':')[-1].lower()
+
+
+def _prefetch(iterable, size):
+    """
+    Iterates over iterable in a background thread, keeping up to size items
+    buffered ahead of the consumer.
+
+    If the consumer stops early the background thread is told to stop, and
+    exceptions raised while producing are re-raised in the consumer.
+    """
+    buf = Queue.Queue(maxsize=size)
+    stopped = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                buf.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception:
+            put((done, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = buf.get()
+            if item is done:
+                if error:
+                    raise error[0], error[1], error[2]
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+class HttpPool(object):
+    """
+    A bounded pool of authorized keep-alive HTTP connections.
+
+    httplib2.Http objects aren't thread-safe, so each request checks out a
+    connection for itself and blocks if all size of them are in use. They are
+    all authorized with the same credentials, so a token refreshed by one is
+    used by all of them, and an expired token is refreshed once under a lock
+    rather than by every thread that notices.
+    """
+
+    def __init__(self, credentials, size=POOL_SIZE, timeout=HTTP_TIMEOUT):
+        self.credentials = credentials
+        self.size = size
+        self.timeout = timeout
+        # the most recently used connection is the most likely to still be open
+        self.idle = Queue.LifoQueue()
+        self.available = threading.Semaphore(size)
+        self.refresh_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self, fresh=False):
+        """
+        Checks out a connection for the duration of the with block.
+
+        :param fresh: if True, a new connection is opened for the block and
+            closed after it instead of reusing a pooled one
+        """
+        self.available.acquire()
+        try:
+            http = None
+            if not fresh:
+                try:
+                    http = self.idle.get_nowait()
+                except Queue.Empty:
+                    pass
+            if http is None:
+                import httplib2
+                http = self.credentials.authorize(httplib2.Http(timeout=self.timeout))
+            self._refresh()
+            try:
+                yield http
+            finally:
+                if fresh:
+                    getattr(http, 'close', lambda: None)()
+                else:
+                    self.idle.put(http)
+        finally:
+            self.available.release()
+
+    def _refresh(self):
+        if not self._token_expired():
+            return
+        with self.refresh_lock:
+            if self._token_expired():
+                import httplib2
+                self.credentials.refresh(httplib2.Http())
+
+    def _token_expired(self):
+        # new credentials don't have a token yet and would fetch one on their first request
+        return (getattr(self.credentials, 'access_token_expired', False) or
+                (hasattr(self.credentials, 'access_token') and not self.credentials.access_token))
+
+
+class _CountingHttp(object):
+    """
+    Wraps an HTTP connection to count the bytes of the responses it receives.
+    """
+
+    def __init__(self, http):
+        self.http = http
+        self.received = 0
+
+    def request(self, *args, **kwargs):
+        resp, content = self.http.request(*args, **kwargs)
+        self.received += len(content or '')
+        return resp, content
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+def _rewinding_connection(url):
+    """
+    Returns the httplib2 connection class for the url, changed to rewind a
+    file body before each time it's sent.
+
+    httplib2 sends a request again by itself after a BadStatusLine or a
+    socket error, and a file body would be sent from wherever the last
+    attempt left it, usually the end. The server would then wait forever
+    for the rest of the Content-Length.
+    """
+    import httplib2
+    if url.startswith('https:'):
+        base = httplib2.HTTPSConnectionWithTimeout
+    else:
+        base = httplib2.HTTPConnectionWithTimeout
+
+    class RewindingConnection(base):
+
+        def request(self, method, url, body=None, headers={}):
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            base.request(self, method, url, body, headers)
+
+    return RewindingConnection
+
+
+class _UploadBody(object):
+    """
+    A load job request body that rows are streamed into.
+
+    Rows are buffered and written in chunks of about chunk_size bytes to a
+    temporary file which is kept in memory until it grows past spool_size.
+    httplib sends it in blocks by calling read, and it can be rewound with
+    seek to retry the request without rebuilding it. It must be sent with a
+    _rewinding_connection, since httplib2 may send it again by itself.
+    """
+
+    def __init__(self, header, footer, compress=False, chunk_size=1024 * 1024, spool_size=8 * 1024 * 1024):
+        self.footer = footer
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.out = gzip.GzipFile(fileobj=self.file, mode='wb') if compress else self.file
+        self.out.write(header)
+        self.data_size = 0
+        self.buffer = []
+        self.buffer_size = 0
+        self.size = None
+
+    def write(self, row):
+        self.buffer.append(row)
+        self.buffer_size += len(row) + 1
+        self.data_size += len(row) + 1
+        if self.buffer_size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.buffer.append('')
+            self.out.write('\n'.join(self.buffer))
+            self.buffer = []
+            self.buffer_size = 0
+
+    def close(self):
+        """
+        Finishes the body. No more rows can be written after this.
+        """
+        if self.size is None:
+            self.flush()
+            self.out.write(self.footer)
+            if self.compress:
+                self.out.close()
+            self.size = self.file.tell()
+
+    def discard(self):
+        self.file.close()
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+
+class QueryColumns(object):
+    """
+    Query results decoded column by column using the schema of the reply.
+
+    INTEGER, FLOAT, BOOLEAN and TIMESTAMP (seconds since the epoch) columns are
+    array.array objects, or numpy arrays after to_numpy. Null values in them
+    are stored as 0 (NaN for floats) and their row numbers are listed in nulls.
+    Other columns are lists with equal strings shared, and repeated or record
+    fields are left as they are in the reply.
+    """
+
+    TYPECODES = {'INTEGER': 'l', 'FLOAT': 'd', 'BOOLEAN': 'b', 'TIMESTAMP': 'd'}
+    CONVERTERS = {'INTEGER': int, 'FLOAT': float, 'BOOLEAN': lambda v: v == 'true', 'TIMESTAMP': float}
+    NULLS = {'l': 0, 'd': float('nan'), 'b': 0}
+
+    def __init__(self, schema):
+        fields = schema['fields']
+        self.names = [field['name'] for field in fields]
+        self.types = [field['type'] for field in fields]
+        self.columns = []
+        self.converters = []
+        for field in fields:
+            typecode = self.TYPECODES.get(field['type'])
+            if field.get('mode') == 'REPEATED' or not typecode:
+                self.columns.append([])
+                self.converters.append(None)
+            else:
+                self.columns.append(array.array(typecode))
+                self.converters.append(self.CONVERTERS[field['type']])
+        self.nulls = dict((name, []) for name in self.names)
+        self.length = 0
+        self._strings = {}
+
+    def add_rows(self, rows):
+        """
+        Decodes rows in the {'f': [{'v': value}]} format of a reply and appends them.
+        """
+        for n, column in enumerate(self.columns):
+            values = [row['f'][n]['v'] for row in rows]
+            convert = self.converters[n]
+            if convert is None:
+                strings = self._strings
+                column.extend([strings.setdefault(v, v) if isinstance(v, basestring) else v for v in values])
+                continue
+            if None in values:
+                nulls = self.nulls[self.names[n]]
+                null = self.NULLS[column.typecode]
+                for i, v in enumerate(values):
+                    if v is None:
+                        nulls.append(self.length + i)
+                        values[i] = null
+                column.extend([v if isinstance(v, (int, float)) else convert(v) for v in values])
+            else:
+                column.extend(map(convert, values))
+        self.length += len(rows)
+
+    def to_numpy(self):
+        """
+        Replaces the array.array columns with numpy arrays sharing the same memory.
+        """
+        import numpy
+        dtypes = {'l': numpy.dtype('l'), 'd': numpy.float64, 'b': numpy.bool_}
+        for n, column in enumerate(self.columns):
+            if isinstance(column, array.array):
+                self.columns[n] = numpy.frombuffer(column, dtype=dtypes[column.typecode])
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, name):
+        return self.columns[self.names.index(name)]
+
+    def __iter__(self):
+        return iter(self.names)
+
+
+class QueryCache(object):
+    """
+    Caches query results on local disk, keyed by the normalized SQL text plus
+    the project and dataset it ran in.
+
+    Each result is stored in its own file with a one line JSON header followed
+    by the rows column by column, marshalled and zlib compressed. Entries
+    expire after ttl seconds and the least recently used ones are evicted once
+    the files take up more than max_bytes. The tables each query reads from
+    are recorded so invalidate can drop the results that depend on a table.
+    """
+
+    # string literals, which shouldn't have their whitespace normalized
+    LITERAL_PATTERN = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+
+    def __init__(self, path=None, ttl=60 * 60, max_bytes=1024 * 1024 * 1024):
+        """
+        :param path: directory to store the results in (default: queries in CACHE_DIR)
+        :param ttl: seconds before a cached result expires
+        :param max_bytes: maximum size of the cache on disk
+        """
+        self.path = path or os.path.join(CACHE_DIR, 'queries')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        _makedirs(self.path)
+
+    def key(self, query, project, dataset):
+        """
+        Returns the cache key for the query. Whitespace outside of string literals
+        and a trailing semicolon don't change the key.
+        """
+        parts = self.LITERAL_PATTERN.split(query.strip().rstrip(';'))
+        for n in range(0, len(parts), 2):
+            parts[n] = ' '.join(parts[n].split())
+        normalized = '\n'.join([project, dataset, ''.join(parts)])
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+    def tables(self, query):
+        """
+        Returns the ids of the tables the query reads from.
+        """
+        return query_tables(query)
+
+    def get(self, key):
+        """
+        Returns the cached rows, or None if they aren't cached or have expired.
+        """
+        filename = os.path.join(self.path, key)
+        try:
+            with open(filename, 'rb') as f:
+                header = json.loads(f.readline())
+                if time.time() - header['created'] > self.ttl:
+                    self._remove(filename)
+                    return None
+                columns = marshal.loads(zlib.decompress(f.read()))
+        except (IOError, OSError):
+            return None
+        # the modification time is used as the last access time for eviction
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        if not columns:
+            return [[] for n in range(header['rows'])]
+        return [list(row) for row in zip(*columns)]
+
+    def set(self, key, rows, tables=()):
+        """
+        Stores the rows and evicts old results if the cache has grown too large.
+        """
+        header = {'created': time.time(), 'rows': len(rows), 'tables': list(tables)}
+        columns = [list(column) for column in zip(*rows)]
+        filename = os.path.join(self.path, key)
+        temp_file = '%s.%s.tmp' % (filename, uuid.uuid4())
+        with open(temp_file, 'wb') as f:
+            f.write(json.dumps(header) + '\n')
+            f.write(zlib.compress(marshal.dumps(columns)))
+        os.rename(temp_file, filename)
+        self._evict()
+
+    def invalidate(self, table):
+        """
+        Removes every cached result that read from the table.
+        """
+        table = _table_id(table)
+        for filename in self._files():
+            try:
+                with open(filename, 'rb') as f:
+                    header = json.loads(f.readline())
+            except (IOError, OSError, ValueError):
+                continue
+            if table in header['tables']:
+                self._remove(filename)
+
+    def clear(self):
+        for filename in self._files():
+            self._remove(filename)
+
+    def _files(self):
+        return [os.path.join(self.path, name) for name in os.listdir(self.path)
+                if not name.endswith('.tmp')]
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = []
+        for filename in self._files():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(size for mtime, size, filename in entries)
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(filename)
+            total -= size
 
 
 class BigQuery(object):
@@ -60,39 +609,47 @@ class BigQuery(object):
     Use BigQuery from python like a sane person.
     """
 
-    def __init__(self, project=PROJECT_ID, dataset=DATASET_ID):
+    cache = None
+    storage = None
+    upload_url = UPLOAD_URL
+
+    def __init__(self, project=PROJECT_ID, dataset=DATASET_ID, key_file='key.p12', cache=None,
+                 client=None, storage=None, upload_url=UPLOAD_URL):
+        """
+        :param cache: optional QueryCache used by query for results without a destination table
+        :param client: (credentials, pool, service) to use instead of the ones shared for key_file,
+            e.g. to talk to a local stand-in server
+        :param storage: object with a bucket(name) method to use instead of google storage
+        :param upload_url: url that load jobs are uploaded to, with %s for the project
+        """
         super(BigQuery, self).__init__()
         self.project = project
         self.dataset = dataset
+        self.cache = cache
+        self.storage = storage
+        self.upload_url = upload_url
 
-        key = None
-        with open('key.p12') as f:
-            key = f.read()
-
-        credentials = SignedJwtAssertionCredentials(
-            service_account_name='558172898018@developer.gserviceaccount.com',
-            private_key=key,
-            scope='https://www.googleapis.com/auth/bigquery')
-
-        http = httplib2.Http()
-        http = credentials.authorize(http)
-        self.http = http
-        self.service = build('bigquery', 'v2', http=http)
+        self.credentials, self.pool, self.service = client or _client(key_file)
         self.jobs = self.service.jobs()
 
-    def query(self, query, destination_table=None, timeout=10000, write_disposition='WRITE_EMPTY'):
+    def query(self, query, destination_table=None, timeout=10000, write_disposition='WRITE_EMPTY',
+              use_cache=True):
         """
         Runs a synchronous query and returns the results.
 
+        If the client has a cache, results are read from and stored in it, and
+        writing to a destination table invalidates the results that read from it,
+        both when the job is submitted and when it's seen to finish by
+        wait_for_job or wait_for_jobs.
+
         :param query: SQL statement
         :param timeout: timeout between polling attempts to get the results in ms
         :param write_disposition: supports: WRITE_EMPTY, WRITE_TRUNCATE, WRITE_APPEND
+        :param use_cache: if False, the cache is neither read nor updated
         """
+        from oauth2client.client import AccessTokenRefreshError
         try:
-
-            if not destination_table:
-                data = {'query': query, 'timeoutMs': timeout}
-            else:
+            if destination_table:
                 data = {'configuration': {
                     'query': {
                         'query': query,
@@ -104,46 +661,24 @@ class BigQuery(object):
                         'writeDisposition': write_disposition
                     }
                 }}
-
-            if not destination_table:
-                reply = None
-                error = None
-                for attempt in range(0,5):
-                    try:
-                        reply = self.jobs.query(projectId=self.project, body=data).execute()
-                        break
-                    except BadStatusLine as e:
-                        print 'received a bad status line error'
-                        error = e
-                if not reply:
-                    raise error
-            else:
-                reply = self.jobs.insert(projectId=self.project, body=data).execute()
-
-            jobReference = reply['jobReference']
-
-            if not destination_table:
-                # Timeout exceeded: keep polling until the job is complete.
-                while not reply['jobComplete']:
-                    reply = self.jobs.getQueryResults(projectId=jobReference['projectId'],
-                                                      jobId=jobReference['jobId'],
-                                                      timeoutMs=timeout).execute()
-            else:
+                reply = self._execute(self.jobs.insert(projectId=self.project, body=data))
+                self._invalidate(destination_table)
                 return reply['jobReference']['jobId']
 
+            cache = self.cache if use_cache else None
+            if cache:
+                key = cache.key(query, self.project, self.dataset)
+                results = cache.get(key)
+                if results is not None:
+                    return results
+
+            reply = self._run_query(query, timeout)
             results = []
-            # If the result has rows, print the rows in the reply.
-            if 'rows' in reply:
-                results.extend([[field['v'] for field in row['f']] for row in reply['rows']])
-                currentRow = len(reply['rows'])
-                # Loop through each page of data
-                while 'rows' in reply and currentRow < reply['totalRows']:
-                    reply = self.jobs.getQueryResults(projectId=jobReference['projectId'],
-                                                      jobId=jobReference['jobId'],
-                                                      startIndex=currentRow).execute()
-                    if 'rows' in reply:
-                        results.extend([[field['v'] for field in row['f']] for row in reply['rows']])
-                        currentRow += len(reply['rows'])
+            for page in self._iter_pages(reply):
+                results.extend(page)
+
+            if cache:
+                cache.set(key, results, cache.tables(query))
             return results
 
         except AccessTokenRefreshError:
@@ -151,11 +686,123 @@ class BigQuery(object):
                    "the application to re-authorize")
             raise
 
-    def export_table(self, table, destination_file, print_header=True):
+    def iter_query(self, query, timeout=10000, page_size=None, prefetch=1, batches=False):
+        """
+        Runs a synchronous query and yields the rows as each page arrives.
+
+        Unlike query, the full result set is never held in memory. The next page
+        is fetched in a background thread while the caller consumes the current
+        one, and at most prefetch pages are buffered ahead of the caller.
+
+        :param query: SQL statement
+        :param timeout: timeout between polling attempts to get the results in ms
+        :param page_size: maximum number of rows to request per page
+        :param prefetch: number of pages to fetch ahead, 0 fetches them on demand
+        :param batches: if True, yields a list of rows per page instead of single rows
+        """
+        from oauth2client.client import AccessTokenRefreshError
+        try:
+            reply = self._run_query(query, timeout, page_size)
+            pages = self._iter_pages(reply, page_size)
+            if prefetch:
+                pages = _prefetch(pages, prefetch)
+            for page in pages:
+                if batches:
+                    yield page
+                else:
+                    for row in page:
+                        yield row
+
+        except AccessTokenRefreshError:
+            print ("The credentials have been revoked or expired, please re-run"
+                   "the application to re-authorize")
+            raise
+
+    def query_columns(self, query, timeout=10000, page_size=None, prefetch=1, numpy=False):
+        """
+        Runs a synchronous query and returns the results decoded by column as QueryColumns.
+
+        :param query: SQL statement
+        :param timeout: timeout between polling attempts to get the results in ms
+        :param page_size: maximum number of rows to request per page
+        :param prefetch: number of pages to fetch ahead, 0 fetches them on demand
+        :param numpy: if True, numeric columns are numpy arrays instead of array.array
+        """
+        reply = self._run_query(query, timeout, page_size)
+        result = QueryColumns(reply['schema'])
+        pages = self._iter_pages(reply, page_size, raw=True)
+        if prefetch:
+            pages = _prefetch(pages, prefetch)
+        for rows in pages:
+            result.add_rows(rows)
+        if numpy:
+            result.to_numpy()
+        return result
+
+    def _run_query(self, query, timeout, page_size=None):
+        """
+        Starts a query job and polls until it is complete. Returns the first reply with rows.
         """
-        Exports a table to a file in the google storage facts bucket and returns the job id.
+        data = {'query': query, 'timeoutMs': timeout}
+        if page_size:
+            data['maxResults'] = page_size
+
+        reply = None
+        error = None
+        for attempt in range(0,5):
+            try:
+                reply = self._execute(self.jobs.query(projectId=self.project, body=data))
+                break
+            except BadStatusLine as e:
+                print 'received a bad status line error'
+                metrics.registry.inc('bigquery_retries_total', method='jobs.query')
+                error = e
+        if not reply:
+            raise error
+
+        jobReference = reply['jobReference']
+        # Timeout exceeded: keep polling until the job is complete.
+        while not reply['jobComplete']:
+            reply = self._execute(self.jobs.getQueryResults(projectId=jobReference['projectId'],
+                                                            jobId=jobReference['jobId'],
+                                                            maxResults=page_size,
+                                                            timeoutMs=timeout))
+        return reply
+
+    def _iter_pages(self, reply, page_size=None, raw=False):
+        """
+        Yields the rows of each page of a completed query, starting with the page in reply.
+
+        :param raw: if True, the rows are yielded as they are in the reply rather than as lists of values
+        """
+        jobReference = reply['jobReference']
+        currentRow = 0
+        # Loop through each page of data
+        while 'rows' in reply:
+            if raw:
+                yield reply['rows']
+            else:
+                yield [[field['v'] for field in row['f']] for row in reply['rows']]
+            currentRow += len(reply['rows'])
+            if currentRow >= int(reply['totalRows']):
+                break
+            reply = self._execute(self.jobs.getQueryResults(projectId=jobReference['projectId'],
+                                                            jobId=jobReference['jobId'],
+                                                            startIndex=currentRow,
+                                                            maxResults=page_size))
+
+    def export_table(self, table, destination_file, print_header=True, workers=4, compress=False):
+        """
+        Exports a table to a file in the google storage facts bucket and downloads it to destination_file.
+
+        BigQuery splits large exports into several shards. They're downloaded
+        concurrently into temporary part files next to destination_file, which
+        are then concatenated in shard order.
 
         :param print_header: if True, each file will have a header row with the column names.
+        :param workers: number of shards to download at the same time
+        :param compress: if True, destination_file is gzip compressed. Each shard is
+            compressed as it downloads, so there is never an uncompressed copy on disk.
         """
         temp_file = '%s_%s' % (table, uuid.uuid4())
         data = {
@@ -168,155 +815,477 @@ class BigQuery(object):
                    'datasetId': self.dataset,
                    'tableId': table
                  },
-                'destinationUri': 'gs://facts/%s.*.csv' % temp_file,
+                'destinationUri': 'gs://%s/%s.*.csv' % (EXPORT_BUCKET, temp_file),
                 'destinationFormat': 'CSV'
                }
              }
            }
 
-        job = self.jobs.insert(projectId=self.project, body=data).execute()
+        job = self._execute(self.jobs.insert(projectId=self.project, body=data))
         jobid = job['jobReference']['jobId']
 
         # wait for the export to complete
         self.wait_for_job(jobid, verbose=True)
         # download the file*
         print 'downloading table export to %s' % destination_file
-        with open(destination_file, 'w') as f:
-            uri = boto.storage_uri('facts/', 'gs')
-            for obj in uri.get_bucket():
-                if obj.name.startswith(temp_file):
-                    print 'getting contents of file from %s' % obj.name
-                    try:
-                        obj.get_contents_to_file(f,
-                                                 headers={'x-goog-api-version': '2',
-                                                 'x-goog-project-id': self.project})
-                    finally:
-                        obj.delete()
+        bucket = self._bucket(EXPORT_BUCKET)
+        shards = sorted(bucket.list(prefix=temp_file), key=lambda obj: obj.name)
+        parts = ['%s.%d.part' % (destination_file, n) for n in range(len(shards))]
+        tasks = Queue.Queue()
+        for task in zip(shards, parts):
+            tasks.put(task)
+        errors = []
+
+        def work():
+            while not errors:
+                try:
+                    obj, part = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self._download_shard(obj, part, compress)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=work) for n in range(min(workers, len(shards)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        try:
+            if errors:
+                error = errors[0]
+                raise error[0], error[1], error[2]
+            # gzip files can be concatenated, each part is just another member
+            with open(destination_file, 'wb') as f:
+                for part in parts:
+                    with open(part, 'rb') as p:
+                        shutil.copyfileobj(p, f, 1024 * 1024)
+        finally:
+            for part in parts:
+                if os.path.exists(part):
+                    os.remove(part)
+
+    def _bucket(self, name):
+        """
+        Returns the google storage bucket, or the one from storage if it was given.
+        """
+        if self.storage is not None:
+            return self.storage.bucket(name)
+        _init_gsutil()
+        import boto
+        return boto.storage_uri(name + '/', 'gs').get_bucket()
+
+    def _download_shard(self, obj, filename, compress=False):
+        """
+        Downloads an exported shard to filename and deletes it from storage.
+        """
+        print 'getting contents of file from %s' % obj.name
+        try:
+            with open(filename, 'wb') as f:
+                out = gzip.GzipFile(fileobj=f, mode='wb') if compress else f
+                obj.get_contents_to_file(out,
+                                         headers={'x-goog-api-version': '2',
+                                         'x-goog-project-id': self.project})
+                if compress:
+                    out.close()
+        finally:
+            obj.delete()
 
     def delete_table(self, tablename):
-        self.service.tables().delete(projectId=self.project, datasetId=self.dataset, tableId=tablename).execute()
+        self._execute(self.service.tables().delete(projectId=self.project, datasetId=self.dataset, tableId=tablename))
+        self._invalidate(tablename)
+
+    def _invalidate(self, table):
+        """
+        Drops cached results that read from a table which is being rewritten.
+        """
+        if self.cache:
+            self.cache.invalidate(table)
+
+    def _invalidate_job(self, job):
+        """
+        Drops cached results that read from the table a finished job wrote to.
+
+        Results are also dropped when the job is submitted, but a query run
+        while the job is running would cache the old table again.
+        """
+        configuration = job.get('configuration', {})
+        for kind in ('query', 'load', 'copy'):
+            table = configuration.get(kind, {}).get('destinationTable')
+            if table:
+                self._invalidate(table['tableId'])
+
+    def get_query_results(self, jobid, filename, workers=1, ordered=True, page_size=None):
+        """
+        Writes the results of a finished query job to filename as CSV.
+
+        Once the first page is fetched and the total number of rows is known, the
+        remaining rows are split into page sized ranges. With workers > 1 the ranges
+        are fetched concurrently, each worker using a connection from the pool.
 
-    def get_query_results(self, jobid, filename):
-        reply = self.jobs.getQueryResults(projectId=self.project,
-                                  jobId=jobid,
-                                  startIndex=0).execute()
+        :param jobid: BigQuery job id
+        :param filename: file to write the rows to
+        :param workers: number of pages to fetch at the same time
+        :param ordered: if False, pages are written as they arrive rather than in row order
+        :param page_size: maximum number of rows to request per page
+        """
+        reply = self._execute(self.jobs.getQueryResults(projectId=self.project,
+                                                        jobId=jobid,
+                                                        startIndex=0,
+                                                        maxResults=page_size))
         with open(filename, 'w') as f:
             if 'rows' in reply:
-                results = [[field['v'] for field in row['f']] for row in reply['rows']]
-                for row in results:
-                    f.write(','.join(row))
-                    f.write('\n')
+                self._write_rows(f, [[field['v'] for field in row['f']] for row in reply['rows']])
 
                 currentRow = len(reply['rows'])
+                totalRows = int(reply['totalRows'])
+                ranges = [(start, min(start + currentRow, totalRows))
+                          for start in range(currentRow, totalRows, currentRow)]
+                if workers > 1:
+                    pages = self._fetch_ranges(jobid, ranges, workers, ordered)
+                else:
+                    pages = (self._fetch_range(jobid, start, end) for start, end in ranges)
                 # Loop through each page of data
-                while 'rows' in reply and currentRow < reply['totalRows']:
-                    reply = self.jobs.getQueryResults(projectId=self.project,
-                                                      jobId=jobid,
-                                                      startIndex=currentRow).execute()
-                    if 'rows' in reply:
-                        results = [[field['v'] for field in row['f']] for row in reply['rows']]
-                        for row in results:
-                            f.write(','.join(row))
-                            f.write('\n')
-                        currentRow += len(reply['rows'])
-                        print 'fetched %d of %s rows' % (currentRow, reply['totalRows'])
+                for rows in pages:
+                    self._write_rows(f, rows)
+                    currentRow += len(rows)
+                    print 'fetched %d of %s rows' % (currentRow, totalRows)
 
         return filename
 
-    def update_table(self, table, rows, schema, max_bad_records=0):
+    def _write_rows(self, f, rows):
+        f.write(''.join([','.join(row) + '\n' for row in rows]))
+
+    def _execute(self, request):
+        """
+        Executes an API request on a connection checked out of the pool and
+        records its latency, bytes transferred and rows.
+
+        GET requests are read only, so they're retried up to 5 times on a BadStatusLine.
+        """
+        method = (getattr(request, 'methodId', None) or 'unknown').replace('bigquery.', '')
+        attempts = 5 if getattr(request, 'method', None) == 'GET' else 1
+        for attempt in range(attempts):
+            start = time.time()
+            with self.pool.connection() as http:
+                http = _CountingHttp(http)
+                try:
+                    reply = request.execute(http=http)
+                    break
+                except BadStatusLine:
+                    metrics.registry.inc('bigquery_errors_total', method=method, error='BadStatusLine')
+                    if attempt == attempts - 1:
+                        raise
+                    print 'received a bad status line error'
+                    metrics.registry.inc('bigquery_retries_total', method=method)
+                except Exception as e:
+                    metrics.registry.inc('bigquery_errors_total', method=method, error=type(e).__name__)
+                    raise
+                finally:
+                    metrics.registry.observe('bigquery_request_seconds', time.time() - start, method=method)
+
+        metrics.registry.inc('bigquery_requests_total', method=method)
+        metrics.registry.inc('bigquery_bytes_sent_total', len(getattr(request, 'body', None) or ''), method=method)
+        metrics.registry.inc('bigquery_bytes_received_total', http.received, method=method)
+        if isinstance(reply, dict) and 'rows' in reply:
+            metrics.registry.inc('bigquery_rows_total', len(reply['rows']), method=method)
+            metrics.registry.observe('bigquery_page_rows', len(reply['rows']), metrics.SIZE_BUCKETS, method=method)
+        return reply
+
+    def _fetch_range(self, jobid, start, end):
+        """
+        Returns the rows of a finished query job from start up to but not including end.
+        """
+        rows = []
+        while start + len(rows) < end:
+            reply = self._execute(self.jobs.getQueryResults(projectId=self.project,
+                                                            jobId=jobid,
+                                                            startIndex=start + len(rows),
+                                                            maxResults=end - start - len(rows)))
+            if 'rows' not in reply:
+                break
+            rows.extend([[field['v'] for field in row['f']] for row in reply['rows']])
+        return rows
+
+    def _fetch_ranges(self, jobid, ranges, workers, ordered=True):
+        """
+        Fetches (start, end) row ranges with a pool of worker threads and yields the rows of each.
+
+        If ordered, the ranges are yielded in the order given, otherwise as soon as
+        they arrive. At most 2 * workers ranges are fetched ahead of the consumer.
+        """
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+
+        def work():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                index, (start, end) = task
+                try:
+                    results.put((index, self._fetch_range(jobid, start, end), None))
+                except Exception:
+                    results.put((index, None, sys.exc_info()))
+
+        threads = [threading.Thread(target=work) for n in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        window = 2 * workers
+        submitted = 0
+        consumed = 0
+        pending = {}
+        try:
+            while consumed < len(ranges):
+                while submitted < len(ranges) and submitted - consumed < window:
+                    tasks.put((submitted, ranges[submitted]))
+                    submitted += 1
+                index, rows, error = results.get()
+                if error:
+                    raise error[0], error[1], error[2]
+                if not ordered:
+                    consumed += 1
+                    yield rows
+                    continue
+                pending[index] = rows
+                while consumed in pending:
+                    rows = pending.pop(consumed)
+                    consumed += 1
+                    yield rows
+        finally:
+            # drop any ranges that haven't been started and stop the workers
+            try:
+                while True:
+                    tasks.get_nowait()
+            except Queue.Empty:
+                pass
+            for thread in threads:
+                tasks.put(None)
+
+    def update_table(self, table, rows, schema, max_bad_records=0, compress=False):
         """
         Creates or updates a table with the rows passed in.
 
+        The rows are streamed into the request body in chunks, which is spooled to
+        a temporary file once it gets large rather than being held in memory.
+
+        :param table: name of the table
+        :param rows: iterable of rows of data to update the table with
+        :param schema:
+        :param max_bad_records:
+        :param compress: if True, the request body is gzip compressed
+        """
+        body = self._load_body(table, schema, max_bad_records, compress)
+        for row in rows:
+            body.write(row)
+        self._invalidate(table)
+        return self._upload(body)
+
+    def update_table_chunked(self, table, rows, schema, max_bad_records=0, max_job_bytes=100 * 1024 * 1024,
+                             workers=1, compress=False, wait=False):
+        """
+        Like update_table, but splits the rows into a new load job every max_job_bytes.
+
+        Returns the job ids in the order the rows were split, or (jobid, status)
+        pairs in the order they finished if wait is True.
+
         :param table: name of the table
-        :param rows: rows of data to update the table with
+        :param rows: iterable of rows of data to update the table with
         :param schema:
         :param max_bad_records:
+        :param max_job_bytes: maximum number of uncompressed bytes of rows per load job
+        :param workers: number of load jobs to upload at the same time
+        :param compress: if True, the request bodies are gzip compressed
+        :param wait: if True, waits for all of the load jobs to finish
         """
-        url = "https://www.googleapis.com/upload/bigquery/v2/projects/" + self.project + "/jobs"
+        def bodies():
+            body = None
+            for row in rows:
+                if body is None:
+                    body = self._load_body(table, schema, max_bad_records, compress)
+                body.write(row)
+                if body.data_size >= max_job_bytes:
+                    yield body
+                    body = None
+            if body is not None:
+                yield body
 
+        self._invalidate(table)
+        if workers > 1:
+            jobids = self._upload_parallel(bodies(), workers)
+        else:
+            jobids = [self._upload(body) for body in bodies()]
+
+        if wait:
+            return list(self.wait_for_jobs(jobids))
+        return jobids
+
+    def _load_body(self, table, schema, max_bad_records, compress=False):
+        """
+        Returns an empty multipart load job request body for the table.
+        """
         # Create the body of the request, separated by a boundary of xxx
         # reference on setting up the job with this header:
         # https://developers.google.com/bigquery/docs/reference/v2/jobs#resource
-        newresource = ('--xxx\n' +
-                       'Content-Type: application/json; charset=UTF-8\n' + '\n' +
-                       '{\n' +
-                       '   "configuration": {\n' +
-                       '     "load": {\n' +
-                       '       "schema": {\n'
-                       '         "fields": ' + schema + '\n' +
-                       '      },\n' +
-                       '      "destinationTable": {\n' +
-                       '        "projectId": "' + self.project + '",\n' +
-                       '        "datasetId": "' + self.dataset + '",\n' +
-                       '        "tableId": "' + table + '"\n' +
-                       '      },\n' +
-                       '      "maxBadRecords": ' + str(max_bad_records) + '\n'
-                       '    }\n' +
-                       '  }\n' +
-                       '}\n' +
-                       '--xxx\n' +
-                       'Content-Type: application/octet-stream\n' +
-                       '\n')
+        header = ('--xxx\n' +
+                  'Content-Type: application/json; charset=UTF-8\n' + '\n' +
+                  '{\n' +
+                  '   "configuration": {\n' +
+                  '     "load": {\n' +
+                  '       "schema": {\n'
+                  '         "fields": ' + schema + '\n' +
+                  '      },\n' +
+                  '      "destinationTable": {\n' +
+                  '        "projectId": "' + self.project + '",\n' +
+                  '        "datasetId": "' + self.dataset + '",\n' +
+                  '        "tableId": "' + table + '"\n' +
+                  '      },\n' +
+                  '      "maxBadRecords": ' + str(max_bad_records) + '\n'
+                  '    }\n' +
+                  '  }\n' +
+                  '}\n' +
+                  '--xxx\n' +
+                  'Content-Type: application/octet-stream\n' +
+                  '\n')
+        # Signify the end of the body
+        footer = '\n--xxx--\n'
+        return _UploadBody(header, footer, compress)
 
-        for row in rows:
-            newresource += row + '\n'
+    def _upload(self, body):
+        """
+        Sends a load job request body and returns the job id, retrying up to 5 times.
+        """
+        url = self.upload_url % self.project
+        body.close()
+        headers = {'Content-Type': 'multipart/related; boundary=xxx',
+                   'Content-Length': str(len(body))}
+        if body.compress:
+            headers['Content-Encoding'] = 'gzip'
+        connection_type = _rewinding_connection(url)
 
-        # Signify the end of the body
-        newresource += '\n--xxx--\n'
-        headers = {'Content-Type': 'multipart/related; boundary=xxx'}
-
-        # print 'sending data to BigQuery'
-        for attempt in range(5):
-            resp, content = self.http.request(url, method="POST", body=newresource, headers=headers)
-
-            if resp.status == 200:
-                jsonResponse = json.loads(content)
-                jobid = jsonResponse['jobReference']['jobId']
-                return jobid
-            elif attempt == 4:
-                print resp.status, content
-                raise
+        try:
+            for attempt in range(5):
+                body.seek(0)
+                if attempt:
+                    metrics.registry.inc('bigquery_retries_total', method='upload')
+                start = time.time()
+                try:
+                    # a new connection, whose class is only used for uploads, rather than a
+                    # pooled one that may have gone stale and already has its class
+                    with self.pool.connection(fresh=True) as http:
+                        resp, content = http.request(url, method="POST", body=body, headers=headers,
+                                                     connection_type=connection_type)
+                except BadStatusLine:
+                    print 'received a bad status line error'
+                    metrics.registry.inc('bigquery_errors_total', method='upload', error='BadStatusLine')
+                    if attempt == 4:
+                        raise
+                    continue
+                finally:
+                    metrics.registry.observe('bigquery_request_seconds', time.time() - start, method='upload')
+
+                metrics.registry.inc('bigquery_requests_total', method='upload', status=resp.status)
+                metrics.registry.inc('bigquery_bytes_sent_total', len(body), method='upload')
+                metrics.registry.observe('bigquery_upload_bytes', len(body), metrics.SIZE_BUCKETS)
+                if resp.status == 200:
+                    jsonResponse = json.loads(content)
+                    jobid = jsonResponse['jobReference']['jobId']
+                    return jobid
+                elif attempt == 4:
+                    print resp.status, content
+                    raise ValueError('load job upload failed with status %s' % resp.status)
+        finally:
+            body.discard()
 
+    def _upload_parallel(self, bodies, workers):
+        """
+        Uploads the request bodies with a pool of worker threads and returns the job ids in order.
 
-    def wait_for_job(self, jobid, verbose=False):
+        At most workers bodies wait to be uploaded, so the caller producing them
+        is held back by slow uploads.
+        """
+        tasks = Queue.Queue(maxsize=workers)
+        jobids = {}
+        errors = []
+
+        def work():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                index, body = task
+                try:
+                    jobids[index] = self._upload(body)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=work) for n in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for index, body in enumerate(bodies):
+                if errors:
+                    break
+                tasks.put((index, body))
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            error = errors[0]
+            raise error[0], error[1], error[2]
+        return [jobids[index] for index in sorted(jobids)]
+
+    def wait_for_job(self, jobid, verbose=False, timeout=None, max_checks=100):
         """
         Waits until the job completes and then returns the status.
 
-        Raises an exception if the job is still running after 100 checks.
+        Raises an exception if the job is still running after max_checks checks
+        or timeout seconds.
 
         :param jobid: BigQuery job id
         :param verbose: if True, it will print updates as it pings the service
+        :param timeout: maximum number of seconds to wait
+        :param max_checks: maximum number of times to check the job
         """
-        errors = 0
-        job = None
-        for n in range(100):
-            try:
-                status, job = self.check_job(jobid)
-            except BadStatusLine:
-                errors += 1
-                if errors > 10:
-                    raise
-                time.sleep(5)
-            if status in ('RUNNING', 'PENDING'):
-                print '%s is %s, waiting 10 seconds' % (jobid, status.lower())
-                logging.info('%s is %s, waiting 10 seconds' % (jobid, status.lower()))
-                time.sleep(10)
-            elif status == 'FAILED':
-                for reason in job.get('status', {}).get('errors', []):
-                    if verbose:
-                        print reason['message']
-                    logging.error(reason['message'])
-                return status
-            else:
-                for reason in job.get('status', {}).get('errors', []):
-                    if verbose:
-                        print reason['message']
-                    logging.error(reason['message'])
-                if status == 'UNKNOWN':
-                    print job
-                    logging.error(job)
-                return status
-        raise 'After 100 checks %s has still not finished running on BigQuery' % jobid
+        for jobid, status in self.wait_for_jobs([jobid], verbose=verbose, timeout=timeout,
+                                                max_checks=max_checks):
+            return status
+
+    def wait_for_jobs(self, jobids, verbose=False, timeout=None, **kwargs):
+        """
+        Waits on all of the jobs at once and yields (jobid, status) as each one completes.
+
+        Takes the same keyword arguments as JobWaiter.
+
+        :param jobids: BigQuery job ids
+        :param verbose: if True, it will print the errors of failed jobs
+        :param timeout: maximum number of seconds to wait for all of the jobs
+        """
+        waiter = JobWaiter(self, verbose=verbose, timeout=timeout, **kwargs)
+        for jobid in jobids:
+            waiter.add(jobid)
+        return iter(waiter)
+
+    def _report_job(self, jobid, status, job, verbose=False):
+        """
+        Logs the errors of a finished job.
+        """
+        for reason in job.get('status', {}).get('errors', []):
+            if verbose:
+                print reason['message']
+            logging.error(reason['message'])
+        if status == 'UNKNOWN':
+            print job
+            logging.error(job)
 
     def check_job(self, jobid):
         """
@@ -325,7 +1294,7 @@ class BigQuery(object):
         :param jobid: the BigQuery job id
         :return: the status of the job
         """
-        job = self.jobs.get(projectId=self.project, jobId=jobid).execute()
+        job = self._execute(self.jobs.get(projectId=self.project, jobId=jobid))
         if job['status']['state'] == 'RUNNING':
             return 'RUNNING', job
         elif job['status']['state'] == 'PENDING':
@@ -340,6 +1309,250 @@ class BigQuery(object):
 
 
 
+class JobWaiter(object):
+    """
+    Waits on several BigQuery jobs at once, yielding each one as it finishes.
+
+    Each job is polled on its own schedule. The delay between checks doubles
+    every time (with jitter, up to max_delay) so it stays roughly proportional
+    to how long the job has been running: short jobs are noticed within a
+    second or two and long ones aren't polled needlessly. Jobs can be added
+    while iterating.
+    """
+
+    def __init__(self, bigquery, verbose=False, timeout=None, max_checks=None,
+                 initial_delay=1, max_delay=30, max_errors=10):
+        """
+        :param bigquery: BigQuery client used to check the jobs
+        :param verbose: if True, it will print the errors of failed jobs
+        :param timeout: maximum number of seconds to wait for all of the jobs
+        :param max_checks: maximum number of times to check any one job
+        :param initial_delay: seconds to wait after the first check of a job
+        :param max_delay: maximum seconds between two checks of a job
+        :param max_errors: number of BadStatusLine errors to tolerate
+        """
+        self.bigquery = bigquery
+        self.verbose = verbose
+        self.timeout = timeout
+        self.max_checks = max_checks
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_errors = max_errors
+        self.errors = 0
+        self.pending = {}
+
+    def add(self, jobid):
+        """
+        Starts waiting on the job.
+        """
+        now = time.time()
+        self.pending[jobid] = {'started': now,
+                               'next_check': now,
+                               'delay': self.initial_delay,
+                               'checks': 0,
+                               'status': None}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __iter__(self):
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        while self.pending:
+            now = time.time()
+            due = [jobid for jobid, state in self.pending.items() if state['next_check'] <= now]
+            for jobid in due:
+                result = self._check(jobid)
+                if result:
+                    yield result
+
+            if not self.pending:
+                break
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                raise RuntimeError('After %s seconds %s have still not finished running on BigQuery' %
+                                   (self.timeout, ', '.join(self.pending)))
+            wake = min(state['next_check'] for state in self.pending.values())
+            if deadline is not None:
+                wake = min(wake, deadline)
+            if wake > now:
+                time.sleep(wake - now)
+
+    def _check(self, jobid):
+        """
+        Checks the job once, returning (jobid, status) if it has finished.
+        """
+        state = self.pending[jobid]
+        try:
+            status, job = self.bigquery.check_job(jobid)
+        except BadStatusLine:
+            self.errors += 1
+            metrics.registry.inc('bigquery_retries_total', method='jobs.get')
+            if self.errors > self.max_errors:
+                raise
+            self._reschedule(state)
+            return None
+
+        if status != state['status']:
+            metrics.registry.inc('bigquery_job_states_total', state=status)
+
+        if status in ('RUNNING', 'PENDING'):
+            if status != state['status']:
+                print '%s is %s' % (jobid, status.lower())
+                logging.info('%s is %s' % (jobid, status.lower()))
+            state['status'] = status
+            state['checks'] += 1
+            if self.max_checks is not None and state['checks'] >= self.max_checks:
+                raise RuntimeError('After %d checks %s has still not finished running on BigQuery' %
+                                   (state['checks'], jobid))
+            self._reschedule(state)
+            return None
+
+        del self.pending[jobid]
+        if status == 'SUCCESS':
+            self.bigquery._invalidate_job(job)
+        elapsed = time.time() - state['started']
+        metrics.registry.observe('bigquery_job_seconds', elapsed, status=status)
+        metrics.registry.inc('bigquery_job_checks_total', state['checks'] + 1)
+        logging.info('%s finished with %s after %.1f seconds' % (jobid, status, elapsed))
+        self.bigquery._report_job(jobid, status, job, self.verbose)
+        return jobid, status
+
+    def _reschedule(self, state):
+        state['next_check'] = time.time() + random.uniform(state['delay'] / 2.0, state['delay'])
+        state['delay'] = min(self.max_delay, state['delay'] * 2)
+
+
+
+class Pipeline(object):
+    """
+    Runs queries that write to tables, each as soon as the tables it reads are ready.
+
+    Every step reads some tables and writes one. A step is submitted once all of
+    the steps writing its inputs have succeeded, with at most max_concurrent
+    jobs running at once. Failed steps are retried, temporary tables are deleted
+    once every step reading them is done, and the submit and finish times of
+    each step are kept in timings.
+    """
+
+    def __init__(self, bigquery, max_concurrent=4, retries=1, verbose=False, initial_delay=1):
+        """
+        :param bigquery: BigQuery client to run the steps with
+        :param max_concurrent: maximum number of jobs to run at the same time
+        :param retries: number of times to retry a failed step
+        :param verbose: if True, it will print the errors of failed jobs
+        :param initial_delay: seconds to wait after the first check of a job
+        """
+        self.bigquery = bigquery
+        self.max_concurrent = max_concurrent
+        self.retries = retries
+        self.verbose = verbose
+        self.initial_delay = initial_delay
+        self.steps = collections.OrderedDict()
+        self.timings = {}
+
+    def add(self, name, query, output, inputs=None, temporary=False, write_disposition='WRITE_TRUNCATE'):
+        """
+        Adds a step that runs the query and writes the results to the output table.
+
+        :param name: name of the step
+        :param query: SQL statement
+        :param output: table the results are written to
+        :param inputs: tables the query reads, by default they're found in the query
+        :param temporary: if True, the output table is deleted once it's no longer needed
+        :param write_disposition: supports: WRITE_EMPTY, WRITE_TRUNCATE, WRITE_APPEND
+        """
+        if inputs is None:
+            inputs = query_tables(query)
+        self.steps[name] = {'query': query,
+                            'output': output,
+                            'inputs': set(_table_id(table) for table in inputs),
+                            'temporary': temporary,
+                            'write_disposition': write_disposition}
+
+    def dependencies(self):
+        """
+        Returns the names of the steps each step has to wait for.
+        """
+        writers = dict((_table_id(step['output']), name) for name, step in self.steps.items())
+        return dict((name, set(writers[table] for table in step['inputs']
+                               if table in writers and writers[table] != name))
+                    for name, step in self.steps.items())
+
+    def run(self):
+        """
+        Runs every step and raises a ValueError if one fails more than retries times.
+        """
+        dependencies = self.dependencies()
+        waiter = JobWaiter(self.bigquery, verbose=self.verbose, initial_delay=self.initial_delay)
+        running = {}
+        done = set()
+        deleted = set()
+        attempts = collections.Counter()
+        self.timings = {}
+
+        def submit():
+            for name, step in self.steps.items():
+                if len(running) >= self.max_concurrent:
+                    return
+                if name in done or name in running.values() or not dependencies[name] <= done:
+                    continue
+                jobid = self.bigquery.query(step['query'], step['output'],
+                                            write_disposition=step['write_disposition'])
+                logging.info('starting %s step job: %s' % (name, jobid))
+                waiter.add(jobid)
+                running[jobid] = name
+                self.timings.setdefault(name, {'submitted': time.time()})
+
+        def cleanup(finished=False):
+            for name, step in self.steps.items():
+                if not step['temporary'] or name not in done or name in deleted:
+                    continue
+                readers = [reader for reader, needs in dependencies.items() if name in needs]
+                if finished or all(reader in done for reader in readers):
+                    self.bigquery.delete_table(step['output'])
+                    deleted.add(name)
+
+        try:
+            submit()
+            for jobid, status in waiter:
+                name = running.pop(jobid)
+                if status == 'SUCCESS':
+                    done.add(name)
+                    self.timings[name]['finished'] = time.time()
+                    cleanup()
+                else:
+                    attempts[name] += 1
+                    if attempts[name] > self.retries:
+                        raise ValueError('%s step failed' % name)
+                    logging.info('retrying %s step' % name)
+                submit()
+
+            if len(done) < len(self.steps):
+                raise ValueError('steps can never run: %s' %
+                                 ', '.join(name for name in self.steps if name not in done))
+        finally:
+            cleanup(finished=True)
+
+        for name, timing in self.timings.items():
+            timing['duration'] = timing['finished'] - timing['submitted']
+            timing['attempts'] = attempts[name] + 1
+
+    def critical_path(self):
+        """
+        Returns the names of the steps on the path that determined how long the last run took.
+
+        Starting from the step that finished last, it follows whichever dependency
+        finished last back to a step with none.
+        """
+        if not self.timings:
+            return []
+        dependencies = self.dependencies()
+        path = [max(self.timings, key=lambda name: self.timings[name]['finished'])]
+        while dependencies[path[-1]]:
+            path.append(max(dependencies[path[-1]], key=lambda name: self.timings[name]['finished']))
+        return list(reversed(path))
+
+
 def update_recent_snapshots():
     """
     Uses the user_snapshots table taking the most recent entry for each user storing them in current_user_snapshots.
@@ -364,14 +1577,7 @@ def update_recent_snapshots():
               JOIN EACH [Activity._latest] as t2
               ON t1.uuid = t2.uuid AND t1.date = t2.snapshot_date AND t1.lastLoggedIn = t2.lastLoggedIn;
             """
-    service = BigQuery()
-
-    jobid = service.query(latest_query, '_latest', write_disposition='WRITE_TRUNCATE')
-    logging.info('starting _latest table creation job: %s' % jobid)
-    if service.wait_for_job(jobid) != 'SUCCESS':
-        raise ValueError('_latest job failed')
-    jobid = service.query(snapshot_query, tablename, write_disposition='WRITE_TRUNCATE')
-    logging.info('starting snapshot table creation job: %s' % jobid)
-    if service.wait_for_job(jobid) != 'SUCCESS':
-        raise ValueError('snapshot job failed')
-    service.delete_table('_latest')
+    pipeline = Pipeline(BigQuery())
+    pipeline.add('latest', latest_query, '_latest', temporary=True)
+    pipeline.add('snapshot', snapshot_query, tablename)
+    pipeline.run()
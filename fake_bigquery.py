@@ -0,0 +1,458 @@
+"""
+A local stand-in for the parts of the BigQuery and google storage APIs that
+bigquery.py uses, for tests and benchmarks that shouldn't touch GCP.
+
+    with FakeBigQueryServer(rows=100000, page_size=10000) as server:
+        client = server.client()
+        rows = client.query('select id, name, score from [d.generated]')
+
+It serves jobs.query, jobs.getQueryResults, jobs.insert (query, extract),
+jobs.get, tables.delete and multipart load job uploads over HTTP. Queries
+return the rows of the first table they read that the server knows about,
+or rows it generates. Extract jobs write CSV shards into an in-memory
+bucket. Latency, page sizes, job run times and dropped connections (which
+the client sees as BadStatusLine) are all configurable.
+"""
+import BaseHTTPServer
+import SocketServer
+import gzip
+import json
+import re
+import socket
+import threading
+import time
+import urlparse
+import uuid
+from StringIO import StringIO
+
+import bigquery
+
+GENERATED_SCHEMA = {'fields': [{'name': 'id', 'type': 'INTEGER'},
+                               {'name': 'name', 'type': 'STRING'},
+                               {'name': 'score', 'type': 'FLOAT'}]}
+
+
+def generated_row(n):
+    return [str(n), 'name%d' % (n % 1000), '%d.5' % n]
+
+
+class FakeObject(object):
+    """
+    An object in a FakeBucket with the parts of the boto key interface export_table uses.
+    """
+
+    def __init__(self, bucket, name, content):
+        self.bucket = bucket
+        self.name = name
+        self.content = content
+
+    def get_contents_to_file(self, f, headers=None):
+        f.write(self.content)
+
+    def delete(self):
+        with self.bucket.lock:
+            self.bucket.objects.pop(self.name, None)
+
+
+class FakeBucket(object):
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, content):
+        with self.lock:
+            self.objects[name] = FakeObject(self, name, content)
+
+    def list(self, prefix=''):
+        with self.lock:
+            return [obj for name, obj in self.objects.items() if name.startswith(prefix)]
+
+
+class FakeStorage(object):
+    """
+    In-memory google storage, usable as the storage of a BigQuery client.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, name):
+        with self.lock:
+            return self.buckets.setdefault(name, FakeBucket())
+
+
+class NoCredentials(object):
+    """
+    Credentials for the stand-in server, which doesn't check them.
+    """
+
+    access_token = 'fake'
+
+    def authorize(self, http):
+        return http
+
+
+class FakeBigQueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A threaded HTTP server on localhost standing in for BigQuery.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, rows=1000, page_size=10000, latency=0, job_seconds=0, fault_every=0,
+                 shard_rows=100000, port=0):
+        """
+        :param rows: number of rows generated for queries that don't read a known table
+        :param page_size: maximum number of rows in a page of query results
+        :param latency: seconds to wait before answering each request
+        :param job_seconds: seconds each job runs for before it's done
+        :param fault_every: if set, every nth request and the retry after it are dropped
+            without a response, which the client sees as a BadStatusLine
+        :param shard_rows: number of rows in each shard of a table export
+        :param port: port to listen on, by default any free one
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.rows = rows
+        self.page_size = page_size
+        self.latency = latency
+        self.job_seconds = job_seconds
+        self.fault_every = fault_every
+        self.shard_rows = shard_rows
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.storage = FakeStorage()
+        self.tables = {}
+        self.jobs = {}
+        self.requests = 0
+        # number of the next uploads to drop without a response, after reading them
+        self.drop_uploads = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        # open keep-alive connections and the threads handling them
+        self.connections = {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            connections = self.connections.items()
+        for connection, thread in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def client(self, project='project', dataset='dataset', pool_size=bigquery.POOL_SIZE, **kwargs):
+        """
+        Returns a BigQuery client that talks to this server.
+        """
+        from apiclient.discovery import build_from_document
+        pool = bigquery.HttpPool(NoCredentials(), pool_size)
+        with pool.connection() as http:
+            service = build_from_document(self.discovery_document(), http=http)
+        return bigquery.BigQuery(project, dataset, client=(pool.credentials, pool, service),
+                                 storage=self.storage, upload_url=self.url + '/upload/bigquery/v2/projects/%s/jobs',
+                                 **kwargs)
+
+    def discovery_document(self):
+        """
+        Returns a discovery document describing the methods the server implements.
+        """
+        def param(type, location='query', required=False, format=None):
+            p = {'type': type, 'location': location}
+            if required:
+                p['required'] = True
+            if format:
+                p['format'] = format
+            return p
+
+        def method(id, path, http_method, params, request=False):
+            order = [name for name, p in params.items() if p.get('required')]
+            desc = {'id': 'bigquery.%s' % id, 'path': path, 'httpMethod': http_method,
+                    'parameters': params, 'parameterOrder': sorted(order)}
+            if request:
+                desc['request'] = {'$ref': 'Object'}
+            if http_method != 'DELETE':
+                desc['response'] = {'$ref': 'Object'}
+            return desc
+
+        project = param('string', 'path', True)
+        return json.dumps({
+            'kind': 'discovery#restDescription',
+            'discoveryVersion': 'v1',
+            'id': 'bigquery:v2',
+            'name': 'bigquery',
+            'version': 'v2',
+            'rootUrl': self.url + '/',
+            'servicePath': 'bigquery/v2/',
+            'baseUrl': self.url + '/bigquery/v2/',
+            'batchPath': 'batch',
+            'parameters': {'alt': param('string')},
+            'schemas': {'Object': {'id': 'Object', 'type': 'object'}},
+            'resources': {
+                'jobs': {'methods': {
+                    'query': method('jobs.query', 'projects/{projectId}/queries', 'POST',
+                                    {'projectId': project}, request=True),
+                    'getQueryResults': method('jobs.getQueryResults', 'projects/{projectId}/queries/{jobId}',
+                                              'GET', {'projectId': project,
+                                                      'jobId': param('string', 'path', True),
+                                                      'startIndex': param('string', format='uint64'),
+                                                      'maxResults': param('integer', format='uint32'),
+                                                      'timeoutMs': param('integer', format='uint32')}),
+                    'insert': method('jobs.insert', 'projects/{projectId}/jobs', 'POST',
+                                     {'projectId': project}, request=True),
+                    'get': method('jobs.get', 'projects/{projectId}/jobs/{jobId}', 'GET',
+                                  {'projectId': project, 'jobId': param('string', 'path', True)}),
+                }},
+                'tables': {'methods': {
+                    'delete': method('tables.delete', 'projects/{projectId}/datasets/{datasetId}/tables/{tableId}',
+                                     'DELETE', {'projectId': project,
+                                                'datasetId': param('string', 'path', True),
+                                                'tableId': param('string', 'path', True)}),
+                }},
+            },
+        })
+
+    def drop_request(self):
+        """
+        Counts a request and returns True if it should be dropped to simulate a fault.
+        """
+        with self.lock:
+            self.requests += 1
+            count = self.requests
+        return bool(self.fault_every) and count % self.fault_every in (0, 1) and count > 1
+
+    def drop_upload(self):
+        """
+        Returns True if an upload should be dropped, counting it against drop_uploads.
+        """
+        with self.lock:
+            if self.drop_uploads:
+                self.drop_uploads -= 1
+                return True
+        return False
+
+    # jobs
+
+    def new_job(self, kind, rows=None, schema=None, destination=None, write_disposition=None):
+        jobid = 'job_%s' % uuid.uuid4().hex
+        job = {'id': jobid, 'kind': kind, 'rows': rows, 'schema': schema, 'destination': destination,
+               'write_disposition': write_disposition, 'done_at': time.time() + self.job_seconds,
+               'finished': False, 'error': None}
+        with self.lock:
+            self.jobs[jobid] = job
+        return job
+
+    def finish(self, job):
+        """
+        Returns True if the job is done, applying its effects the first time.
+        """
+        if time.time() < job['done_at']:
+            return False
+        with self.lock:
+            if job['finished']:
+                return True
+            job['finished'] = True
+            table = job['destination']
+            if job['kind'] == 'extract':
+                self._extract(job)
+            elif table and job['write_disposition'] == 'WRITE_EMPTY' and self.tables.get(table, {}).get('rows'):
+                job['error'] = {'reason': 'duplicate', 'message': 'Table %s already exists' % table}
+            elif table and job['write_disposition'] in ('WRITE_APPEND', None) and table in self.tables:
+                self.tables[table]['rows'].extend(job['rows'])
+            elif table:
+                self.tables[table] = {'rows': list(job['rows']), 'schema': job['schema']}
+        return True
+
+    def _extract(self, job):
+        table = self.tables.get(job['source'])
+        if table is None:
+            job['error'] = {'reason': 'notFound', 'message': 'Not found: Table %s' % job['source']}
+            return
+        bucket_name, prefix = re.match(r'gs://([^/]+)/(.*)\*\.csv$', job['destination_uri']).groups()
+        bucket = self.storage.bucket(bucket_name)
+        header = ','.join(field['name'] for field in table['schema']['fields']) + '\n'
+        rows = table['rows']
+        for n, start in enumerate(range(0, max(len(rows), 1), self.shard_rows)):
+            content = ''.join(','.join(row) + '\n' for row in rows[start:start + self.shard_rows])
+            bucket.add('%s%012d.csv' % (prefix, n), (header if job['print_header'] else '') + content)
+
+    def query_rows(self, query):
+        """
+        Returns the rows and schema a query produces.
+        """
+        for table in bigquery.query_tables(query):
+            if table in self.tables:
+                return list(self.tables[table]['rows']), self.tables[table]['schema']
+        return [generated_row(n) for n in range(self.rows)], GENERATED_SCHEMA
+
+    def query_reply(self, job, start=0, max_results=None):
+        reply = {'kind': 'bigquery#queryResponse',
+                 'jobReference': {'projectId': 'project', 'jobId': job['id']},
+                 'jobComplete': self.finish(job)}
+        if not reply['jobComplete']:
+            return reply
+        size = min(self.page_size, max_results or self.page_size)
+        rows = job['rows'][start:start + size]
+        reply['totalRows'] = str(len(job['rows']))
+        reply['schema'] = job['schema']
+        if rows:
+            reply['rows'] = [{'f': [{'v': v} for v in row]} for row in rows]
+        return reply
+
+    def job_resource(self, job):
+        status = {'state': 'DONE' if self.finish(job) else 'RUNNING'}
+        if status['state'] == 'DONE' and job['error']:
+            status['errorResult'] = job['error']
+            status['errors'] = [job['error']]
+        resource = {'kind': 'bigquery#job', 'id': job['id'], 'jobReference': {'jobId': job['id']}, 'status': status}
+        if job['destination'] and job['kind'] in ('query', 'load'):
+            resource['configuration'] = {job['kind']: {'destinationTable': {
+                'projectId': 'project', 'datasetId': 'dataset', 'tableId': job['destination']}}}
+        return resource
+
+    def load(self, body, encoding=None):
+        """
+        Creates a load job from a multipart upload body.
+        """
+        if encoding == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        parts = body.split('--xxx')
+        config = json.loads(parts[1].split('\n\n', 1)[1])['configuration']['load']
+        data = parts[2].split('\n\n', 1)[1]
+        rows = [line.split(',') for line in data.split('\n') if line]
+        table = config['destinationTable']['tableId']
+        return self.new_job('load', rows, {'fields': config['schema']['fields']}, table)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [('POST', r'/bigquery/v2/projects/([^/]+)/queries$', 'jobs_query'),
+              ('GET', r'/bigquery/v2/projects/([^/]+)/queries/([^/]+)$', 'get_query_results'),
+              ('POST', r'/bigquery/v2/projects/([^/]+)/jobs$', 'jobs_insert'),
+              ('GET', r'/bigquery/v2/projects/([^/]+)/jobs/([^/]+)$', 'jobs_get'),
+              ('DELETE', r'/bigquery/v2/projects/([^/]+)/datasets/([^/]+)/tables/([^/]+)$', 'tables_delete'),
+              ('POST', r'/upload/bigquery/v2/projects/([^/]+)/jobs$', 'upload')]
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections[self.connection] = threading.current_thread()
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.pop(self.connection, None)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        server = self.server
+        length = int(self.headers.get('content-length') or 0)
+        self.body = self.rfile.read(length) if length else ''
+        if server.drop_request() or (self.path.startswith('/upload/') and server.drop_upload()):
+            self.close_connection = True
+            return
+        if server.latency:
+            time.sleep(server.latency)
+
+        url = urlparse.urlparse(self.path)
+        self.query = dict((name, values[0]) for name, values in urlparse.parse_qs(url.query).items())
+        for route_method, pattern, handler in self.ROUTES:
+            match = re.match(pattern, url.path)
+            if match and route_method == method:
+                status, reply = getattr(self, handler)(*match.groups())
+                return self.respond(status, reply)
+        self.respond(404, {'error': {'code': 404, 'message': 'Not found: %s' % url.path}})
+
+    def respond(self, status, reply):
+        content = json.dumps(reply) if reply is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def not_found(self, what):
+        return 404, {'error': {'code': 404, 'message': 'Not found: %s' % what,
+                               'errors': [{'reason': 'notFound', 'message': 'Not found: %s' % what}]}}
+
+    def jobs_query(self, project):
+        server = self.server
+        data = json.loads(self.body)
+        rows, schema = server.query_rows(data['query'])
+        job = server.new_job('query', rows, schema)
+        if server.job_seconds:
+            time.sleep(min(server.job_seconds, data.get('timeoutMs', 10000) / 1000.0))
+        return 200, server.query_reply(job, 0, data.get('maxResults'))
+
+    def get_query_results(self, project, jobid):
+        server = self.server
+        job = server.jobs.get(jobid)
+        if job is None:
+            return self.not_found('Job %s' % jobid)
+        if not server.finish(job) and 'timeoutMs' in self.query:
+            time.sleep(min(max(0, job['done_at'] - time.time()), int(self.query['timeoutMs']) / 1000.0))
+        start = int(self.query.get('startIndex', 0))
+        max_results = int(self.query['maxResults']) if 'maxResults' in self.query else None
+        return 200, server.query_reply(job, start, max_results)
+
+    def jobs_insert(self, project):
+        server = self.server
+        configuration = json.loads(self.body)['configuration']
+        if 'query' in configuration:
+            config = configuration['query']
+            rows, schema = server.query_rows(config['query'])
+            job = server.new_job('query', rows, schema, config['destinationTable']['tableId'],
+                                 config.get('writeDisposition', 'WRITE_EMPTY'))
+        elif 'extract' in configuration:
+            config = configuration['extract']
+            job = server.new_job('extract')
+            job['source'] = config['sourceTable']['tableId']
+            job['destination_uri'] = config['destinationUri']
+            job['print_header'] = config.get('printHeader', True)
+        else:
+            return 400, {'error': {'code': 400, 'message': 'Unsupported job configuration'}}
+        return 200, server.job_resource(job)
+
+    def jobs_get(self, project, jobid):
+        job = self.server.jobs.get(jobid)
+        if job is None:
+            return self.not_found('Job %s' % jobid)
+        return 200, self.server.job_resource(job)
+
+    def tables_delete(self, project, dataset, table):
+        with self.server.lock:
+            if self.server.tables.pop(table, None) is None:
+                return self.not_found('Table %s' % table)
+        return 204, None
+
+    def upload(self, project):
+        job = self.server.load(self.body, self.headers.get('content-encoding'))
+        return 200, self.server.job_resource(job)
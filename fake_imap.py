@@ -0,0 +1,268 @@
+"""
+A local stand-in IMAP server for tests and benchmarks of the imap functions.
+
+    with FakeImapServer(messages=100000, latency=0.005) as server:
+        imap = functions.imap_login('127.0.0.1', 'user', 'password', port=server.port, ssl=False)
+        imap.select('INBOX')
+
+It has one mailbox of generated messages and understands CAPABILITY, LOGIN,
+SELECT, EXAMINE, NOOP, SEARCH ALL, FETCH, STORE, EXPUNGE, CLOSE and LOGOUT,
+plus the UID forms of SEARCH, FETCH and STORE. Commands are read and answered
+in order as soon as they arrive, but every response is held back by latency
+seconds, like a network round trip, so pipelined commands overlap the way
+they would against a real server.
+"""
+import Queue
+import SocketServer
+import bisect
+import collections
+import re
+import socket
+import threading
+import time
+
+
+def generated_message(n):
+    return ('From: sender%d@example.com\r\nTo: user@example.com\r\nSubject: message %d\r\n\r\n'
+            'This is the body of message %d.\r\n' % (n % 100, n, n))
+
+
+class FakeImapServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    A threaded IMAP server on localhost with one mailbox.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages=1000, latency=0, port=0):
+        """
+        :param messages: number of generated messages in the mailbox
+        :param latency: seconds each response is delayed by
+        :param port: port to listen on, by default any free one
+        """
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.thread = None
+        # open connections and the threads handling them
+        self.connections = {}
+        self.reset(messages)
+
+    def reset(self, messages):
+        """
+        Replaces the mailbox with messages generated messages, with UIDs 1 to messages.
+        """
+        with self.lock:
+            # [uid, flags, message] in UID order, so a message's sequence number is its index + 1
+            self.mailbox = [[n, set(), generated_message(n)] for n in range(1, messages + 1)]
+            self.mailbox_uids = range(1, messages + 1)
+            self.next_uid = messages + 1
+            # number of each command received and bytes of commands received
+            self.commands = collections.Counter()
+            self.bytes_received = 0
+
+    def uids(self):
+        with self.lock:
+            return list(self.mailbox_uids)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            connections = self.connections.items()
+        for connection, thread in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def positions(self, sequence_set, uid=False):
+        """
+        Returns the indexes in the mailbox of the messages in the sequence set. The lock must be held.
+        """
+        uids = self.mailbox_uids
+        if uid:
+            largest = uids[-1] if uids else 0
+        else:
+            largest = len(self.mailbox)
+        positions = set()
+        for part in sequence_set.split(','):
+            bounds = [largest if value == '*' else int(value) for value in part.split(':')]
+            low, high = min(bounds), max(bounds)
+            if uid:
+                positions.update(range(bisect.bisect_left(uids, low), bisect.bisect_right(uids, high)))
+            else:
+                positions.update(range(max(low, 1) - 1, min(high, largest)))
+        return sorted(positions)
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    COMMAND_PATTERN = re.compile(r'(\S+) (\S+)(?: (.*))?$')
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        # like real servers, don't hold back the end of a response waiting for an ack
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections[self.connection] = threading.current_thread()
+        # (time to send, data) for the writer thread
+        self.outgoing = Queue.Queue()
+        self.writer = threading.Thread(target=self.write_responses)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def finish(self):
+        self.outgoing.put(None)
+        self.writer.join()
+        with self.server.lock:
+            self.server.connections.pop(self.connection, None)
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def write_responses(self):
+        while True:
+            response = self.outgoing.get()
+            if response is None:
+                return
+            due, data = response
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except socket.error:
+                return
+
+    def send(self, lines):
+        self.outgoing.put((time.time() + self.server.latency, ''.join(line + '\r\n' for line in lines)))
+
+    def handle(self):
+        self.send(['* OK fake IMAP4rev1 server ready'])
+        while True:
+            try:
+                line = self.rfile.readline()
+            except socket.error:
+                return
+            if not line:
+                return
+            match = self.COMMAND_PATTERN.match(line.rstrip('\r\n'))
+            if match is None:
+                self.send(['* BAD unparseable command'])
+                continue
+            tag, name, args = match.group(1), match.group(2).upper(), match.group(3) or ''
+            uid = name == 'UID'
+            if uid:
+                name, _, args = args.partition(' ')
+                name = name.upper()
+            with self.server.lock:
+                self.server.commands[('UID ' if uid else '') + name] += 1
+                self.server.bytes_received += len(line)
+            method = getattr(self, 'do_' + name, None)
+            if method is None or (uid and name not in ('SEARCH', 'FETCH', 'STORE')):
+                self.send(['%s BAD unknown command %s' % (tag, name)])
+                continue
+            lines = method(args, uid) or []
+            self.send(lines + ['%s OK %s completed' % (tag, name)])
+            if name == 'LOGOUT':
+                return
+
+    def do_CAPABILITY(self, args, uid):
+        return ['* CAPABILITY IMAP4rev1 UIDPLUS']
+
+    def do_LOGIN(self, args, uid):
+        pass
+
+    def do_NOOP(self, args, uid):
+        pass
+
+    def do_SELECT(self, args, uid):
+        with self.server.lock:
+            return ['* %d EXISTS' % len(self.server.mailbox),
+                    '* 0 RECENT',
+                    '* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)',
+                    '* OK [UIDVALIDITY 1] UIDs valid',
+                    '* OK [UIDNEXT %d] next UID' % self.server.next_uid]
+
+    do_EXAMINE = do_SELECT
+
+    def do_LOGOUT(self, args, uid):
+        return ['* BYE logging out']
+
+    def do_SEARCH(self, args, uid):
+        with self.server.lock:
+            values = [message[0] if uid else n + 1 for n, message in enumerate(self.server.mailbox)]
+        return ['* SEARCH' + ''.join(' %d' % value for value in values)]
+
+    def do_FETCH(self, args, uid):
+        sequence_set, _, items = args.partition(' ')
+        items = items.upper()
+        lines = []
+        with self.server.lock:
+            for n in self.server.positions(sequence_set, uid):
+                message_uid, flags, message = self.server.mailbox[n]
+                parts = []
+                if uid or 'UID' in items:
+                    parts.append('UID %d' % message_uid)
+                if 'FLAGS' in items:
+                    parts.append('FLAGS (%s)' % ' '.join(sorted(flags)))
+                if 'HEADER' in items:
+                    header = message[:message.index('\r\n\r\n') + 4]
+                    parts.append('BODY[HEADER] {%d}\r\n%s' % (len(header), header))
+                elif 'RFC822' in items or 'BODY' in items:
+                    name = 'RFC822' if 'RFC822' in items else 'BODY[]'
+                    parts.append('%s {%d}\r\n%s' % (name, len(message), message))
+                lines.append('* %d FETCH (%s)' % (n + 1, ' '.join(parts)))
+        return lines
+
+    def do_STORE(self, args, uid):
+        sequence_set, operation, flags = args.split(' ', 2)
+        operation = operation.upper()
+        flags = set(flags.strip('()').split())
+        lines = []
+        with self.server.lock:
+            for n in self.server.positions(sequence_set, uid):
+                message = self.server.mailbox[n]
+                if operation.startswith('+'):
+                    message[1] |= flags
+                elif operation.startswith('-'):
+                    message[1] -= flags
+                else:
+                    message[1] = set(flags)
+                if not operation.endswith('.SILENT'):
+                    lines.append('* %d FETCH (%sFLAGS (%s))' %
+                                 (n + 1, 'UID %d ' % message[0] if uid else '', ' '.join(sorted(message[1]))))
+        return lines
+
+    def do_EXPUNGE(self, args, uid):
+        lines = []
+        with self.server.lock:
+            mailbox = self.server.mailbox
+            # from the end, so each sequence number is right when the client reads it
+            for n in range(len(mailbox) - 1, -1, -1):
+                if '\\Deleted' in mailbox[n][1]:
+                    lines.append('* %d EXPUNGE' % (n + 1))
+            self.server.mailbox = [message for message in mailbox if '\\Deleted' not in message[1]]
+            self.server.mailbox_uids = [message[0] for message in self.server.mailbox]
+        return lines
+
+    def do_CLOSE(self, args, uid):
+        self.do_EXPUNGE(args, uid)
@@ -2,31 +2,224 @@
 
 from StringIO import StringIO
 import collections
+import contextlib
+import cPickle
+import hashlib
+import os
+import re
+import sqlite3
 import functools
 from datetime import timedelta, datetime, date
 import time
 import sys
+import threading
+import traceback
+import weakref
+
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses evictions maxsize currsize')
+
+# separates the positional from the keyword arguments in a cache key
+_kwargs_mark = object()
+_missing = object()
+
 
 class memoize(object):
     """
     Memoization decorator.
 
+    With no options every result is kept forever. Give it a maxsize to keep
+    only the most recently used results and a ttl to drop results older than
+    that many seconds:
+
+        @memoize(maxsize=1000, ttl=60)
+        def lookup(name): ...
+
+    It's safe to call from threads. Two threads that miss on the same
+    arguments at the same time will both call the function; the later
+    result wins.
+
+    On a method the instance is part of the key, so the cache keeps every
+    instance alive. Use per_instance=True to give each instance its own cache
+    (with its own maxsize) that goes away when the instance does:
+
+        class Client(object):
+            @memoize(maxsize=100, per_instance=True)
+            def get(self, url): ...
+
+    A backend such as SqliteCache shares results between processes and
+    keeps them across restarts. The in-memory cache is still checked first.
+    The backend's keys don't include the instance, so it can't be used with
+    per_instance:
+
+        @memoize(maxsize=1000, backend=SqliteCache(ttl=86400))
+        def lookup(name): ...
+
     Based on: https://wiki.python.org/moin/PythonDecoratorLibrary#Memoize
-    """
-    def __init__(self, func):
-        self.func = func
-        self.cache = {}
 
-    def __call__(self, *args):
+    :param maxsize: the most results to keep, or None for no limit
+    :param ttl: seconds a result is kept, or None to keep it until it's evicted
+    :param typed: if True, arguments of different types are cached separately (e.g., 1 and 1.0)
+    :param per_instance: if True, a method gets a separate cache for each instance
+    :param backend: a second level cache with get(key, default) and set(key, value), e.g., SqliteCache
+    """
+    def __new__(cls, func=None, maxsize=None, ttl=None, typed=False, per_instance=False, backend=None):
+        if func is None:
+            return functools.partial(cls, maxsize=maxsize, ttl=ttl, typed=typed,
+                                     per_instance=per_instance, backend=backend)
+        return super(memoize, cls).__new__(cls)
+
+    def __init__(self, func, maxsize=None, ttl=None, typed=False, per_instance=False, backend=None):
+        if maxsize is not None and maxsize < 1:
+            raise ValueError('maxsize must be at least 1: %r' % maxsize)
+        if per_instance and backend is not None:
+            raise ValueError('per_instance and backend can\'t be used together')
+        self.func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.typed = typed
+        self.per_instance = per_instance
+        self.backend = backend
+        # id(instance) -> (weak reference to the instance, its memoize), when
+        # per_instance is set. instances are told apart by identity, not __eq__.
+        self.instances = {}
+        # key -> result, in least to most recently used order when there's a maxsize
+        self.cache = collections.OrderedDict() if maxsize else {}
+        # key -> time the result expires, when there's a ttl. the ttl is fixed,
+        # so insertion order is also the order they expire in.
+        self.expires = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def key(self, args, kwargs):
+        """
+        Returns the cache key for the arguments.
+        """
+        key = args
+        if kwargs:
+            items = sorted(kwargs.items())
+            key += (_kwargs_mark,) + tuple(items)
+        if self.typed:
+            key += tuple(type(arg) for arg in args)
+            if kwargs:
+                key += tuple(type(value) for name, value in items)
+        return key
+
+    def __call__(self, *args, **kwargs):
         """
         Check to see if the arguments are already in cache. If not call the fn.
         """
-        # if the arguments are no hashable then just call on the function
-        if not isinstance(args, collections.Hashable):
-            return self.func(*args)
-        if args not in self.cache:
-            self.cache[args] = self.func(*args)
-        return self.cache[args]
+        key = self.key(args, kwargs)
+        try:
+            hash(key)
+        except TypeError:
+            # if the arguments are not hashable then just call on the function
+            return self.func(*args, **kwargs)
+
+        if self.maxsize is None and self.ttl is None:
+            # nothing is reordered or expired, so reads don't need the lock. the
+            # hit count can miss an increment when threads race on it.
+            value = self.cache.get(key, _missing)
+            if value is not _missing:
+                self.hits += 1
+                return value
+        else:
+            with self.lock:
+                value = self.cache.get(key, _missing)
+                if value is not _missing and self.ttl is not None and self.expires[key] <= time.time():
+                    self._remove(key)
+                    value = _missing
+                if value is not _missing:
+                    if self.maxsize is not None:
+                        # move it to the most recently used end
+                        del self.cache[key]
+                        self.cache[key] = value
+                    self.hits += 1
+                    return value
+
+        value = self._load(args, kwargs)
+        with self.lock:
+            self.misses += 1
+            if self.ttl is not None:
+                now = time.time()
+                self._purge(now)
+            if key in self.cache:
+                del self.cache[key]
+                self.expires.pop(key, None)
+            elif self.maxsize is not None and len(self.cache) >= self.maxsize:
+                self._remove(next(iter(self.cache)))
+            self.cache[key] = value
+            if self.ttl is not None:
+                self.expires[key] = now + self.ttl
+        return value
+
+    def backend_key(self, args, kwargs):
+        """
+        Returns the backend key for the arguments: a hash of the function's module,
+        name and the pickled arguments. Returns None if the arguments can't be
+        pickled or the function is a lambda, which has no name to tell it apart.
+        """
+        if self.func.__name__ == '<lambda>':
+            return None
+        key = (self.func.__module__, self.func.__name__, args, sorted(kwargs.items()))
+        if self.typed:
+            key += (tuple(type(arg) for arg in args), sorted((name, type(value)) for name, value in kwargs.items()))
+        try:
+            return hashlib.sha1(cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL)).hexdigest()
+        except (cPickle.PicklingError, TypeError):
+            return None
+
+    def _load(self, args, kwargs):
+        """
+        Returns the result from the backend, or calls the function and stores it there.
+        """
+        key = self.backend_key(args, kwargs) if self.backend is not None else None
+        if key is not None:
+            value = self.backend.get(key, _missing)
+            if value is not _missing:
+                return value
+        value = self.func(*args, **kwargs)
+        if key is not None:
+            try:
+                self.backend.set(key, value)
+            except (cPickle.PicklingError, TypeError):
+                pass
+        return value
+
+    def _remove(self, key):
+        """
+        Evicts the key. The lock must be held.
+        """
+        del self.cache[key]
+        self.expires.pop(key, None)
+        self.evictions += 1
+
+    def _purge(self, now):
+        """
+        Evicts the results that have expired, so keys that aren't asked for
+        again don't pile up. The lock must be held.
+        """
+        while self.expires:
+            key, expires = next(self.expires.iteritems())
+            if expires > now:
+                break
+            self._remove(key)
+
+    def cache_info(self):
+        """
+        Returns a CacheInfo of the hits, misses, evictions, maxsize and current size.
+        """
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self.cache))
+
+    def cache_clear(self):
+        """
+        Removes every result and resets the stats, including the caches of every instance.
+        """
+        with self.lock:
+            self.cache.clear()
+            self.expires.clear()
+            self.hits = self.misses = self.evictions = 0
+            self.instances.clear()
 
     def __repr__(self):
         """
@@ -38,52 +231,405 @@ class memoize(object):
         """
         Instance method calls.
         """
-        return functools.partial(self.__call__, obj)
+        if obj is None:
+            return self
+        if not self.per_instance:
+            return functools.partial(self.__call__, obj)
+        key = id(obj)
+        entry = self.instances.get(key)
+        if entry is not None and entry[0]() is obj:
+            return entry[1]
+        instances = self.instances
+
+        def forget(ref):
+            # runs when the instance is collected, maybe while this thread
+            # holds the lock, so it doesn't take it
+            entry = instances.get(key)
+            if entry is not None and entry[0] is ref:
+                instances.pop(key, None)
+
+        try:
+            ref = weakref.ref(obj, forget)
+        except TypeError:
+            # the instance can't be weakly referenced (e.g., it has __slots__
+            # without __weakref__), so keep its cache on the instance itself
+            if not hasattr(obj, '__dict__'):
+                raise TypeError('per_instance needs instances that are weakly referenceable or have a __dict__')
+            name = '_memoize_%d' % id(self)
+            bound = obj.__dict__.get(name)
+            if bound is None:
+                bound = obj.__dict__[name] = self._bind(lambda: obj)
+            return bound
+        with self.lock:
+            entry = self.instances.get(key)
+            if entry is None or entry[0]() is not obj:
+                entry = self.instances[key] = (ref, self._bind(ref))
+        return entry[1]
+
+    def _bind(self, ref):
+        """
+        Returns a memoize of the method for the instance ref() returns.
+
+        It only holds the instance through ref, so a weak reference lets the
+        instance and its cache be collected together.
+        """
+        func = self.func
+
+        @functools.wraps(func)
+        def method(*args, **kwargs):
+            return func(ref(), *args, **kwargs)
+        return memoize(method, maxsize=self.maxsize, ttl=self.ttl, typed=self.typed)
+
+
+def _user_cache_dir(name):
+    """
+    Returns the directory name in the user's cache directory ($XDG_CACHE_HOME
+    or ~/.cache), creating it so only the user can read or write it.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(base, name)
+    try:
+        os.makedirs(path, 0700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+class SqliteCache(object):
+    """
+    A cache in a SQLite database that processes on the same machine can share.
+
+    Values are pickled with the highest protocol, so anyone who can write
+    the database can run code in the processes reading it. Keep it where only
+    its users can write. The database is in WAL mode so readers don't wait on
+    a writer, and writers wait up to timeout seconds for each other. Entries
+    expire after ttl seconds and the least recently used ones are evicted
+    once the values take up more than max_bytes.
+    """
+
+    # seconds between updates of an entry's last access time, so most reads don't write
+    ACCESS_RESOLUTION = 60
+    # totalling the sizes scans the table, so it's only done once this fraction of
+    # max_bytes has been written since the last time. the cache can go over by that much.
+    SIZE_CHECK_FRACTION = 0.01
+
+    def __init__(self, path=None, ttl=None, max_bytes=256 * 1024 * 1024, timeout=30):
+        """
+        :param path: the database file, created if it doesn't exist (default:
+            memoize/cache.db in the user's cache directory)
+        :param ttl: seconds before an entry expires, or None to keep it until it's evicted
+        :param max_bytes: maximum size of the pickled values, or None for no limit
+        :param timeout: seconds to wait for another process's write to finish
+        """
+        self.path = path or os.path.join(_user_cache_dir('memoize'), 'cache.db')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.local = threading.local()
+        # bytes this process has stored since it last checked the size
+        self.unchecked = 0
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, '
+                         'size INTEGER, expires REAL, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+
+    def _connection(self):
+        """
+        Returns this thread's connection, opening a new one after a fork.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value, or default if it isn't cached or has expired.
+        """
+        conn = self._connection()
+        row = conn.execute('SELECT value, expires, accessed FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        value, expires, accessed = row
+        now = time.time()
+        if expires is not None and expires <= now:
+            with conn:
+                conn.execute('DELETE FROM cache WHERE key = ? AND expires <= ?', (key, now))
+            return default
+        if now - accessed > self.ACCESS_RESOLUTION:
+            with conn:
+                conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        return cPickle.loads(str(value))
+
+    def set(self, key, value):
+        """
+        Stores the value and evicts old entries if the cache has grown too large.
+        """
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else None
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+                         (key, sqlite3.Binary(data), len(data), expires, now))
+            self._evict(conn, now, len(data))
+
+    def delete(self, key):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM cache')
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def _evict(self, conn, now, written):
+        """
+        Removes expired entries, then the least recently used until the values
+        fit in max_bytes if it's time to check.
+
+        :param written: bytes just stored
+        """
+        conn.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+        if self.max_bytes is None:
+            return
+        self.unchecked += written
+        if self.unchecked < self.max_bytes * self.SIZE_CHECK_FRACTION:
+            return
+        self.unchecked = 0
+        excess = self._total_size(conn) - self.max_bytes
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in conn.execute('SELECT key, size FROM cache ORDER BY accessed'):
+            keys.append(key)
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany('DELETE FROM cache WHERE key = ?', [(key,) for key in keys])
 
+    def _total_size(self, conn):
+        return conn.execute('SELECT TOTAL(size) FROM cache').fetchone()[0]
 
-def imap_login(host, username, password):
+
+# longest sequence set to put in one command. RFC 7162 asks clients to keep
+# command lines under 8192 octets.
+IMAP_MAX_SEQUENCE_SET = 8000
+
+_IMAP_UID_PATTERN = re.compile(r'UID (\d+)')
+
+
+def imap_login(host, username, password, port=None, ssl=True):
     """
     Logs in and returns an imaplib.IMAP4_SSL object.
 
     :param host: imap hosts (e.g., imap.gmail.com)
     :param username:
     :param password:
+    :param port: port to connect to, by default 993 with ssl and 143 without
+    :param ssl: if False, an unencrypted imaplib.IMAP4 is returned instead
     """
     import imaplib
-    server = imaplib.IMAP4_SSL(host)
+    if ssl:
+        server = imaplib.IMAP4_SSL(host, port or imaplib.IMAP4_SSL_PORT)
+    else:
+        server = imaplib.IMAP4(host, port or imaplib.IMAP4_PORT)
     server.login(username, password)
     return server
 
 
-def imap_get_message_ids(imap):
+def imap_get_message_ids(imap, uid=False):
     """
     Retrieves all the message ids in the current mailbox.
 
     :param imap: a valid imaplib.IMAP4_SSL object logged in.
+    :param uid: if True, the UIDs of the messages are returned rather than
+        their sequence numbers, which change as messages are expunged
     """
     if imap.state == 'AUTH':
         raise ValueError('A mailbox must be selected: (e.g., imap.select("Inbox"))')
-    result, data = imap.search(None, 'ALL')
+    if uid:
+        result, data = imap.uid('SEARCH', None, 'ALL')
+    else:
+        result, data = imap.search(None, 'ALL')
     assert result == 'OK'
     msg_ids = data[0].split()
     return msg_ids
 
 
-def imap_delete_messages(imap, message_ids, verbose=False):
+def imap_fetch_messages(connect, mailbox='INBOX', message_ids=None, uid=False, connections=4,
+                        batch_size=500, headers_only=False):
+    """
+    Fetches messages in batches over a pool of connections and yields
+    (uid, email.message.Message) as each batch arrives, in no particular order.
+
+    Each connection fetches a different range of messages at once. At most
+    two batches per connection are fetched ahead of the messages taken, so
+    it can stream through millions of messages. Messages are fetched with
+    BODY.PEEK, so they aren't marked as seen.
+
+    :param connect: function returning a new logged in imaplib.IMAP4_SSL object,
+        e.g., functools.partial(imap_login, host, username, password)
+    :param mailbox: the mailbox to fetch from, which is opened read only
+    :param message_ids: ids of the messages to fetch (all of them by default)
+    :param uid: if True, message_ids are UIDs (see imap_get_message_ids)
+    :param connections: number of connections fetching at once
+    :param batch_size: messages fetched by each FETCH command
+    :param headers_only: if True only the headers of the messages are fetched
+    """
+    import Queue
+    import email.parser
+    items = '(UID BODY.PEEK[HEADER])' if headers_only else '(UID BODY.PEEK[])'
+    idle = Queue.Queue()
+    opened = []
+
+    def open_connection():
+        imap = connect()
+        opened.append(imap)
+        result, data = imap.select(mailbox, readonly=True)
+        if result != 'OK':
+            raise imap.error('SELECT %s failed: %s' % (mailbox, data))
+        return imap, int(data[0])
+
+    def fetch(sequence_set):
+        try:
+            imap = idle.get_nowait()
+        except Queue.Empty:
+            imap = open_connection()[0]
+        if uid:
+            result, data = imap.uid('FETCH', sequence_set, items)
+        else:
+            result, data = imap.fetch(sequence_set, items)
+        if result != 'OK':
+            raise imap.error('FETCH %s failed: %s' % (sequence_set, data))
+        idle.put(imap)
+        parser = email.parser.Parser()
+        messages = []
+        for part in data:
+            # each message is a (response, literal) tuple followed by a closing ')'
+            if isinstance(part, tuple):
+                match = _IMAP_UID_PATTERN.search(part[0])
+                messages.append((int(match.group(1)) if match else None, parser.parsestr(part[1], headers_only)))
+        return messages
+
+    try:
+        if message_ids is None:
+            # fetch by sequence number from 1 to the number of messages, rather than
+            # searching for every id up front
+            imap, count = open_connection()
+            idle.put(imap)
+            uid = False
+            batches = ('%d:%d' % (start, min(start + batch_size - 1, count))
+                       for start in xrange(1, count + 1, batch_size))
+        else:
+            batches = (imap_sequence_set(batch) for batch in seq_batch(message_ids, batch_size))
+        for sequence_set, messages, error in _ParallelMap(batches, fetch, connections):
+            if error is not None:
+                _reraise(error)
+            for message in messages:
+                yield message
+    finally:
+        for imap in opened:
+            try:
+                imap.logout()
+            except Exception:
+                pass
+
+
+def _imap_sequence_sets(message_ids, max_length):
+    """
+    Yields (sequence set, number of ids in it) for imap_sequence_sets.
+    """
+    ids = sorted(set(int(message_id) for message_id in message_ids))
+    parts = []
+    length = count = 0
+    n = 0
+    while n < len(ids):
+        # extend the run of consecutive ids starting at n
+        end = n
+        while end + 1 < len(ids) and ids[end + 1] == ids[end] + 1:
+            end += 1
+        part = str(ids[n]) if end == n else '%d:%d' % (ids[n], ids[end])
+        if parts and length + len(part) + 1 > max_length:
+            yield ','.join(parts), count
+            parts = []
+            length = count = 0
+        parts.append(part)
+        length += len(part) + 1
+        count += end - n + 1
+        n = end + 1
+    if parts:
+        yield ','.join(parts), count
+
+
+def imap_sequence_sets(message_ids, max_length=IMAP_MAX_SEQUENCE_SET):
+    """
+    Collapses message ids into IMAP sequence sets of ranges: e.g.,
+    [1, 2, 3, 5, 7, 8] becomes '1:3,5,7:8'. Yields as many sets as it takes
+    to keep each one under max_length characters.
+
+    :param message_ids: message sequence numbers or UIDs, as ints or strings
+    :param max_length: longest sequence set to yield
+    """
+    for sequence_set, count in _imap_sequence_sets(message_ids, max_length):
+        yield sequence_set
+
+
+def imap_sequence_set(message_ids):
+    """
+    Collapses message ids into one IMAP sequence set of ranges (e.g., '1:3,5,7:8').
+    """
+    return ','.join(imap_sequence_sets(message_ids, sys.maxint))
+
+
+def imap_delete_messages(imap, message_ids, verbose=False, uid=False, pipeline=16):
     """
     Deletes the messages and expunges them.
 
-    This will automatically batch every 1,000 messages processed.
+    The ids are collapsed into sequence sets of ranges, and up to pipeline
+    STORE commands are sent before waiting for the first reply, so deleting
+    a large mailbox takes a few round trips rather than one per batch.
 
     :param imap:  a valid imaplib.IMAP4_SSL object logged in.
     :param message_ids: array of ids
     :param verbose: if True then logging to stdout happens
+    :param uid: if True, message_ids are UIDs (see imap_get_message_ids)
+    :param pipeline: most STORE commands waiting for a reply at once
     """
-    # TODO: do the batches as CSV rather than individual ids
+    name = 'UID' if uid else 'STORE'
+    # (tag, ids in the command) of the commands waiting for a reply
+    waiting = collections.deque()
     count = 0
-    for batch in seq_batch(message_ids, 1000):
-        imap.store(','.join(batch), '+FLAGS', '\\Deleted')
-        count += len(batch)
+
+    def complete():
+        tag, ids = waiting.popleft()
+        result, data = imap._command_complete(name, tag)
+        if result != 'OK':
+            raise imap.error('STORE failed: %s' % data)
+        return ids
+
+    for sequence_set, ids in _imap_sequence_sets(message_ids, IMAP_MAX_SEQUENCE_SET):
+        # +FLAGS.SILENT, so the server doesn't send back every message's flags
+        args = (sequence_set, '+FLAGS.SILENT', '(\\Deleted)')
+        if uid:
+            tag = imap._command('UID', 'STORE', *args)
+        else:
+            tag = imap._command('STORE', *args)
+        waiting.append((tag, ids))
+        if len(waiting) >= pipeline:
+            count += complete()
+            if verbose:
+                print '%d deleted' % count
+    while waiting:
+        count += complete()
         if verbose:
             print '%d deleted' % count
     imap.expunge()
@@ -94,7 +640,21 @@ def imap_delete_messages(imap, message_ids, verbose=False):
 def seq_batch(seq, batchsize):
     """
     Create batches of batchsize elements from seq.
-    """
+
+    Bytes and bytearrays are batched as memoryviews of seq, so nothing is
+    copied. Other sequences (lists, tuples, arrays, numpy arrays) are
+    batched as slices of seq, the same type as seq. Anything else is read
+    one item at a time into lists.
+    """
+    if isinstance(seq, (str, bytearray)):
+        view = memoryview(seq)
+        for start in xrange(0, len(seq), batchsize):
+            yield view[start:start + batchsize]
+        return
+    if _sliceable(seq):
+        for start in xrange(0, len(seq), batchsize):
+            yield seq[start:start + batchsize]
+        return
     batch = []
     for x in seq:
         batch.append(x)
@@ -105,17 +665,221 @@ def seq_batch(seq, batchsize):
         yield batch
 
 
-def get_text_from_url(url):
+def _sliceable(seq):
     """
-    Gets the text from this url. Raises an exception if the status is bad.
+    Returns True if seq can be sliced into batches.
+    """
+    import array
+    if isinstance(seq, xrange):
+        return False
+    return (isinstance(seq, (collections.Sequence, array.array)) or
+            hasattr(seq, '__array_interface__'))
+
+
+def batch_map(fn, seq, size, workers=1, mode='thread', queue_size=None):
+    """
+    Calls fn on batches of size items from seq with a pool of threads or
+    processes, and yields (batch, result) as each call finishes.
+
+    Batches are made by seq_batch. Only queue_size batches are read ahead of
+    the results that have been taken, so seq can be a generator too big to
+    hold in memory. The first exception fn raises stops the pool and is raised.
+    In process mode fn and the batches must be picklable, which memoryviews
+    of bytes aren't.
+
+    :param fn: function to call on each batch
+    :param seq: the items to batch
+    :param size: items in each batch
+    :param workers: number of threads or processes calling fn at once
+    :param mode: 'thread' or 'process'
+    :param queue_size: batches read ahead of those taken (default: 2 per worker)
+    """
+    for batch, result, error in _ParallelMap(seq_batch(seq, size), fn, workers, mode, queue_size):
+        if error is not None:
+            _reraise(error)
+        yield batch, result
+
+
+# seconds to wait for a server to connect or send data
+HTTP_TIMEOUT = 30
+
+# (scheme, host) -> requests.Session
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def http_session(url, pool_size=10):
+    """
+    Returns the requests.Session shared by every request to the url's host, so
+    its connections are kept alive and reused.
+
+    :param pool_size: connections kept open to the host, the first time it's seen
     """
     import requests
-    resp = requests.get(url)
+    from urlparse import urlparse
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.netloc)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('%s://' % parsed.scheme, adapter)
+                session = _sessions[key] = session
+    return session
+
+
+def http_close_sessions():
+    """
+    Closes the sessions http_session has opened, and their connections.
+    """
+    with _sessions_lock:
+        sessions = _sessions.values()
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+class HttpCache(object):
+    """
+    Caches responses on local disk for conditional requests.
+
+    A refetch sends the cached ETag and Last-Modified, and if the server
+    answers 304 Not Modified the cached body is used, so pages that haven't
+    changed cost a round trip but no download. Each response is stored in
+    its own file with a one line JSON header followed by the body.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: directory to store the responses in (default: http-cache
+            in the user's cache directory)
+        """
+        self.path = path or _user_cache_dir('http-cache')
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            if not os.path.isdir(self.path):
+                raise
+
+    def _filename(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(url).hexdigest())
+
+    def get(self, url):
+        """
+        Returns (header dict, body) for the url, or None if it isn't cached.
+        """
+        import json
+        try:
+            with open(self._filename(url), 'rb') as f:
+                return json.loads(f.readline()), f.read()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, url, headers, body):
+        """
+        Stores the body if the response can be revalidated.
+
+        :param headers: the response headers
+        """
+        import json
+        import uuid
+        header = {'etag': headers.get('etag'),
+                  'last-modified': headers.get('last-modified'),
+                  'content-type': headers.get('content-type', '')}
+        if not header['etag'] and not header['last-modified']:
+            return
+        filename = self._filename(url)
+        temp_file = '%s.%s.tmp' % (filename, uuid.uuid4())
+        with open(temp_file, 'wb') as f:
+            f.write(json.dumps(header) + '\n')
+            f.write(body)
+        os.rename(temp_file, filename)
+
+    def headers(self, url):
+        """
+        Returns the conditional request headers for the url.
+        """
+        cached = self.get(url)
+        headers = {}
+        if cached is not None:
+            if cached[0].get('etag'):
+                headers['If-None-Match'] = cached[0]['etag']
+            if cached[0].get('last-modified'):
+                headers['If-Modified-Since'] = cached[0]['last-modified']
+        return headers
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+def _decode(content, content_type):
+    if 'charset=utf-8' in content_type:
+        return content.decode('utf-8', 'replace')
+    return content.decode('utf-8')
+
+
+def get_text_from_url(url, timeout=HTTP_TIMEOUT, cache=None):
+    """
+    Gets the text from this url. Raises an exception if the status is bad.
+
+    :param timeout: seconds to wait for the server to connect or send data
+    :param cache: an HttpCache to make a conditional request with
+    """
+    headers = cache.headers(url) if cache is not None else {}
+    resp = http_session(url).get(url, headers=headers, timeout=timeout)
+    if resp.status_code == 304 and cache is not None:
+        cached = cache.get(url)
+        if cached is not None:
+            return _decode(cached[1], cached[0]['content-type'])
+        # removed since the request was made, so fetch it again unconditionally
+        resp = http_session(url).get(url, timeout=timeout)
     resp.raise_for_status()
-    if 'charset=utf-8' in resp.headers.get('content-type', ''):
-        return resp.text
-    else:
-        return resp.content.decode('utf-8')
+    if cache is not None:
+        cache.set(url, resp.headers, resp.content)
+    return _decode(resp.content, resp.headers.get('content-type', ''))
+
+
+def fetch_urls(urls, workers=16, per_host=4, timeout=HTTP_TIMEOUT, cache=None):
+    """
+    Gets the text from many urls at once and yields (url, text, error) as
+    each one completes, in no particular order. error is None or the
+    exception get_text_from_url raised, in which case text is None.
+
+    Only two urls per worker are read ahead of the results taken, so urls
+    can be a generator and a slow reader holds only that many pages in
+    memory. Requests to the same host share keep-alive connections.
+
+    :param urls: the urls to get
+    :param workers: most requests at once
+    :param per_host: most requests at once to any one host
+    :param timeout: seconds to wait for a server to connect or send data
+    :param cache: an HttpCache to make conditional requests with
+    """
+    from urlparse import urlparse
+    # host -> semaphore limiting the requests to it
+    limits = collections.defaultdict(lambda: threading.Semaphore(per_host))
+    limits_lock = threading.Lock()
+
+    def fetch(url):
+        host = urlparse(url).netloc
+        with limits_lock:
+            limit = limits[host]
+        with limit:
+            # sizes the host's connection pool the first time it's seen
+            http_session(url, per_host)
+            return get_text_from_url(url, timeout, cache)
+
+    for url, text, error in _ParallelMap(urls, fetch, workers):
+        yield url, text, error[1] if error is not None else None
 
 
 def parse_xml(text):
@@ -144,6 +908,139 @@ def parse_html(html):
     from lxml import etree
     return etree.HTML(html)
 
+
+def iterparse_xml(source, tag=None, path=None, chunk_size=64 * 1024):
+    """
+    Parses an XML document incrementally and yields each element that matches
+    tag or path once its end tag has been read.
+
+    After the next element is asked for, the one yielded is cleared and it
+    and its earlier siblings are removed from the tree, along with the earlier
+    siblings of the elements wrapping it, so memory stays bounded on documents
+    of any size. Use or copy each element before moving
+    on, and don't match elements that contain each other.
+
+    The source can be a filename, a file object or an iterator of byte or
+    unicode chunks. Bytes are handed to the parser as they are, so it reads
+    the document's encoding declaration. Unicode chunks have the declaration
+    dropped, since lxml would decode them again by it.
+
+    :param source: filename, file object or iterator of chunks
+    :param tag: tag to match, e.g., 'Item' or '{namespace}Item'
+    :param path: '/' separated tags the elements and their ancestors must end
+        with, e.g., 'Items/Item', or all of them with a leading '/'. A '*'
+        matches any tag and tags without a namespace match any namespace.
+    :param chunk_size: bytes read at a time from a file
+    """
+    from lxml import etree
+    return _iterparse(etree.XMLPullParser, source, tag, path, chunk_size)
+
+
+def iterparse_html(source, tag=None, path=None, chunk_size=64 * 1024):
+    """
+    Parses an HTML document incrementally. See iterparse_xml.
+    """
+    from lxml import etree
+    return _iterparse(etree.HTMLPullParser, source, tag, path, chunk_size)
+
+
+def _chunks(source, chunk_size):
+    """
+    Yields the chunks of a filename, file object or iterator of chunks.
+    """
+    if isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            for chunk in _chunks(f, chunk_size):
+                yield chunk
+    elif hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in source:
+            yield chunk
+
+
+def _without_declaration(chunks):
+    """
+    Drops an XML declaration from the start of unicode chunks.
+    """
+    head = None
+    for chunk in chunks:
+        if head is None and not isinstance(chunk, unicode):
+            # bytes, which the parser decodes by the declaration
+            head = ''
+        if head is not None and not head:
+            yield chunk
+            continue
+        head = (head or u'') + chunk
+        stripped = head.lstrip()
+        if len(stripped) < 5 or (stripped.startswith(u'<?xml') and u'?>' not in stripped):
+            # not enough to tell yet
+            continue
+        if stripped.startswith(u'<?xml'):
+            head = stripped[stripped.index(u'?>') + 2:]
+        yield head
+        head = ''
+    if head:
+        yield head
+
+
+def _tag_matches(pattern, tag):
+    if pattern == '*' or pattern == tag:
+        return True
+    # without a namespace it matches the local name
+    return not pattern.startswith('{') and isinstance(tag, basestring) and tag.rpartition('}')[2] == pattern
+
+
+def _iterparse(parser_class, source, tag, path, chunk_size):
+    if tag is not None and path is not None:
+        raise ValueError('Only one of tag and path can be given')
+    parts = path.strip('/').split('/') if path else None
+    anchored = path is not None and path.startswith('/')
+    if parts is None:
+        parser = parser_class(events=('end',), tag=tag)
+    else:
+        parser = parser_class(events=('start', 'end'))
+    # tags of the open elements, when matching a path
+    stack = []
+
+    def matches(events):
+        for event, element in events:
+            if parts is not None:
+                if event == 'start':
+                    stack.append(element.tag)
+                    continue
+                found = len(stack) == len(parts) if anchored else len(stack) >= len(parts)
+                found = found and all(_tag_matches(part, name) for part, name in zip(parts, stack[-len(parts):]))
+                stack.pop()
+                if not found:
+                    continue
+            yield element
+            element.clear()
+            parent = element.getparent()
+            if parent is not None:
+                # drop it and its earlier siblings, which are all finished
+                while element.getprevious() is not None:
+                    del parent[0]
+                del parent[0]
+                # and the finished siblings of each element wrapping it
+                ancestor = parent
+                while ancestor.getparent() is not None:
+                    while ancestor.getprevious() is not None:
+                        del ancestor.getparent()[0]
+                    ancestor = ancestor.getparent()
+
+    for chunk in _without_declaration(_chunks(source, chunk_size)):
+        parser.feed(chunk)
+        for element in matches(parser.read_events()):
+            yield element
+    parser.close()
+    for element in matches(parser.read_events()):
+        yield element
+
 def lxml_pretty_print(el_or_els):
     """
     Pretty prints the lxml element or elements.
@@ -162,6 +1059,30 @@ def lxml_pretty_print(el_or_els):
             print ']'
 
 
+# most compiled XPath expressions kept by lxml_xpath
+XPATH_CACHE_SIZE = 512
+
+
+@memoize(maxsize=XPATH_CACHE_SIZE)
+def _compile_xpath(path, namespaces):
+    from lxml import etree
+    # plain strings, so attribute values don't keep their element alive
+    return etree.XPath(path, namespaces=dict(namespaces) if namespaces else None, smart_strings=False)
+
+
+def lxml_xpath(selector, ns=None):
+    """
+    Returns a compiled etree.XPath selecting './selector' from a node.
+
+    The compiled expressions are cached by selector and namespaces, so
+    applying the same selector to many nodes only compiles it once.
+
+    :param selector: xpath relative to the node, e.g., 'Item/Title' or '@id'
+    :param ns: dict of namespace prefixes to uris
+    """
+    return _compile_xpath('./%s' % selector, tuple(sorted(ns.items())) if ns else None)
+
+
 def lxml_get_child(node, selector, ns):
     """
     Returns child node found with the xpath selector.
@@ -172,7 +1093,7 @@ def lxml_get_child(node, selector, ns):
     if not selector:
         raise ValueError('xpath selector must be specified')
 
-    children = node.xpath('./%s' % selector, namespaces=ns)
+    children = lxml_xpath(selector, ns)(node)
     if not children:
         return None
     expect(1, len(children), 'should only be one child with tag name: "%s"' % selector)
@@ -197,6 +1118,48 @@ def lxml_get_attribute(node, selector, attribute, ns=None):
     return child.attrib.get(attribute) if child is not None else None
 
 
+def lxml_extract(nodes, spec, ns=None):
+    """
+    Extracts fields from each node and yields them as namedtuples.
+
+    The spec maps field names to selectors relative to the node. A selector
+    that finds an element gives its text, one that finds an attribute (e.g.,
+    'Offer/@id') gives its value, and one that finds nothing gives None. If
+    it finds several, the first is used. Each selector is compiled once for
+    all of the nodes, and nodes can be a generator such as iterparse_xml.
+
+        for item in lxml_extract(items, {'asin': 'ASIN', 'title': 'ItemAttributes/Title'}):
+            print item.asin, item.title
+
+    :param nodes: elements to extract from
+    :param spec: dict (or sequence of pairs) of field name to xpath selector.
+        A dict's fields are in sorted order.
+    :param ns: dict of namespace prefixes to uris
+    """
+    if isinstance(spec, dict) and not isinstance(spec, collections.OrderedDict):
+        spec = sorted(spec.items())
+    spec = list(spec)
+    Record = collections.namedtuple('Record', [name for name, selector in spec], rename=True)
+    xpaths = [lxml_xpath(selector, ns) for name, selector in spec]
+    for node in nodes:
+        values = []
+        for xpath in xpaths:
+            found = xpath(node)
+            if not found:
+                values.append(None)
+            else:
+                value = found[0]
+                values.append(value if isinstance(value, basestring) else value.text)
+        yield Record._make(values)
+
+
+@memoize(maxsize=256)
+def _insert_sql(table, fields, verb='INSERT'):
+    if not fields:
+        raise ValueError('There must be at least one field to insert')
+    return '%s INTO %s (%s) VALUES (%s)' % (verb, table, ','.join(fields), ','.join('?' * len(fields)))
+
+
 def db_insert(conn, table, value):
     """
     Inserts a dict-based record into the table. Commit is not called.
@@ -207,38 +1170,158 @@ def db_insert(conn, table, value):
     :param table: string name of table
     :param value: dict representing the record to insert
     """
-    fields = []
-    placeholders = []
-    values = []
-    for name, val in value.items():
-        fields.append(name)
-        values.append(val)
-        placeholders.append('?')
-    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, ','.join(fields), ','.join(placeholders))
-    conn.execute(sql, values)
+    conn.execute(_insert_sql(table, tuple(value.keys())), value.values())
 
 
-def db_select(conn, sql):
+@contextlib.contextmanager
+def _db_transaction(conn):
+    """
+    Runs the block in a transaction on a connection whose isolation_level is
+    None, committing it if the block succeeds and rolling it back if not.
+    """
+    conn.execute('BEGIN')
+    try:
+        yield
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def db_bulk_insert(conn, table, rows, fields=None, chunk_size=50000, pragmas=None, defer_indexes=False,
+                   replace=False, verbose=False):
+    """
+    Inserts many rows into the table and returns the number inserted.
+
+    The rows are inserted chunk_size at a time with executemany and each
+    chunk is committed in one transaction, which is begun explicitly so it
+    holds with any isolation_level, including None. If a chunk fails it's
+    rolled back and the error is raised; the chunks before it stay
+    committed. The connection must not be in the middle of a transaction.
+
+        db_bulk_insert(conn, 'events', iter_events(), pragmas={'synchronous': 'OFF'}, defer_indexes=True)
+
+    :param conn: sqlite3 connection
+    :param table: string name of table
+    :param rows: iterable of dicts or tuples. Each dict must have the fields
+        (other keys are ignored) and each tuple must have their values in order.
+    :param fields: the columns to insert, by default the keys of the first dict
+        or, for tuples, every column of the table
+    :param chunk_size: rows per executemany and transaction
+    :param pragmas: dict of PRAGMAs to set while loading (e.g., {'journal_mode':
+        'WAL', 'synchronous': 'OFF'}). They are set back afterwards.
+    :param defer_indexes: if True the table's indexes are dropped while loading
+        and created again afterwards, which is faster than updating them row by row
+    :param replace: if True, INSERT OR REPLACE is used
+    :param verbose: if True the rows inserted and rows/sec are reported to stdout
+    """
+    import itertools
+    import operator
+    rows = iter(rows)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return 0
+    if fields is None:
+        if isinstance(first, dict):
+            fields = tuple(first.keys())
+        else:
+            fields = tuple(row[1] for row in conn.execute('PRAGMA table_info(%s)' % table))
+    fields = tuple(fields)
+    rows = itertools.chain([first], rows)
+    if isinstance(first, dict):
+        getter = operator.itemgetter(*fields)
+        rows = itertools.imap(getter if len(fields) > 1 else lambda row: (getter(row),), rows)
+    sql = _insert_sql(table, fields, 'INSERT OR REPLACE' if replace else 'INSERT')
+
+    # the transactions are begun and ended here rather than by the sqlite3 module
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    previous = {}
+    indexes = []
+    count = 0
+    start = time.time()
+    try:
+        for name, value in (pragmas or {}).items():
+            previous[name] = conn.execute('PRAGMA %s' % name).fetchone()[0]
+            conn.execute('PRAGMA %s = %s' % (name, value))
+        if defer_indexes:
+            # indexes sqlite made for constraints have no sql and can't be dropped
+            indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                                   "AND sql IS NOT NULL", (table,)).fetchall()
+            with _db_transaction(conn):
+                for name, index_sql in indexes:
+                    conn.execute('DROP INDEX %s' % name)
+
+        for chunk in seq_batch(rows, chunk_size):
+            with _db_transaction(conn):
+                conn.executemany(sql, chunk)
+            count += len(chunk)
+            if verbose:
+                elapsed = time.time() - start
+                sys.stdout.write('\r%d rows inserted, %.0f rows/sec' % (count, count / elapsed if elapsed else 0.0))
+                sys.stdout.flush()
+    finally:
+        try:
+            if indexes:
+                with _db_transaction(conn):
+                    for name, index_sql in indexes:
+                        conn.execute(index_sql)
+            for name, value in previous.items():
+                conn.execute('PRAGMA %s = %s' % (name, value))
+        finally:
+            conn.isolation_level = isolation_level
+    if verbose:
+        elapsed = time.time() - start
+        sys.stdout.write('\nFinished. %d rows inserted in %.1fs (%.0f rows/sec)\n' %
+                         (count, elapsed, count / elapsed if elapsed else 0.0))
+    return count
+
+
+def db_select(conn, sql, params=()):
     """
     Executes a select statement and returns the values as dicts.
 
-    TODO: just a temporary ghetto parsing of select statements.
-    Doesn't support * yet and 'from' in a select statement.
+    :param conn: sqlite3 connection
+    :param sql: the select statement
+    :param params: values for the statement's placeholders
+    """
+    cursor = conn.execute(sql, params)
+    fields = [column[0] for column in cursor.description]
+    return [dict(zip(fields, result)) for result in cursor]
+
 
-    :param conn:
-    :param sql:
+def db_iter(conn, sql, params=(), batch_size=1000, columnar=False):
     """
-    expect_that('select' in sql.lower())
-    expect_that('from' in sql.lower())
+    Executes a select statement and yields its rows as they're read.
 
-    def extract_fields():
-        s = sql.lower()
-        start = s.index('select ') + 7
-        end = s.index(' from')
-        return [v.strip() for v in sql[start:end].split(',')]
+    Rows are namedtuples whose fields are the column names from the cursor
+    (names that aren't identifiers, like count(*), become _0, _1, ...).
+    Rows are fetched batch_size at a time, so a large result is never all
+    in memory.
 
-    fields = extract_fields()
-    return [dict(zip(fields, result)) for result in conn.execute(sql).fetchall()]
+    :param conn: sqlite3 connection (or any DB-API connection with execute)
+    :param sql: the select statement
+    :param params: values for the statement's placeholders
+    :param batch_size: rows fetched at a time
+    :param columnar: if True, each batch is yielded as an OrderedDict of
+        column name to a tuple of its values rather than row by row
+    """
+    cursor = conn.execute(sql, params)
+    try:
+        fields = [column[0] for column in cursor.description]
+        Row = collections.namedtuple('Row', fields, rename=True)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            if columnar:
+                yield collections.OrderedDict(zip(fields, zip(*rows)))
+            else:
+                for row in rows:
+                    yield Row._make(row)
+    finally:
+        cursor.close()
 
 
 def expect(expected, actual, error_message=None):
@@ -482,25 +1565,217 @@ def diff_counters(c1, c2):
     return c3
 
 
-def do_each(seq, fn, report_every=100):
+def _call(fn, item):
+    """
+    Calls fn(item) in a pool process and returns (item, result, error). The
+    traceback can't be pickled, so error is (type, value, formatted traceback).
+    """
+    try:
+        return item, fn(item), None
+    except Exception:
+        exc_type, value = sys.exc_info()[:2]
+        return item, None, (exc_type, value, traceback.format_exc())
+
+
+def _reraise(error):
+    """
+    Raises the (type, value, traceback) _ParallelMap yields for a failed call.
+    """
+    if isinstance(error[2], basestring):
+        # from another process, where the traceback was formatted
+        sys.stderr.write(error[2])
+        raise error[1]
+    raise error[0], error[1], error[2]
+
+
+class _ParallelMap(object):
+    """
+    Calls fn on each item with a pool of threads or processes and yields
+    (item, result, exc_info) as each call finishes, in no particular order.
+    exc_info is None if the call succeeded.
+
+    Only queue_size items are read from seq ahead of the results that have
+    been taken, however slowly they're taken, so seq can be a generator too
+    big to hold in memory. Stopping the iteration early stops the pool.
+    """
+
+    def __init__(self, seq, fn, workers=1, mode='thread', queue_size=None):
+        if mode not in ('thread', 'process'):
+            raise ValueError('mode must be "thread" or "process": %r' % mode)
+        self.seq = seq
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.mode = mode
+        self.queue_size = queue_size or self.workers * 2
+        # items read from seq and items whose calls have finished
+        self.started = 0
+        self.finished = 0
+
+    @property
+    def in_flight(self):
+        return self.started - self.finished
+
+    def __iter__(self):
+        if self.workers == 1 and self.mode == 'thread':
+            return self._iter_serial()
+        if self.mode == 'thread':
+            return self._iter_threads()
+        return self._iter_processes()
+
+    def _iter_serial(self):
+        for item in self.seq:
+            self.started += 1
+            try:
+                result, error = self.fn(item), None
+            except Exception:
+                result, error = None, sys.exc_info()
+            self.finished += 1
+            yield item, result, error
+
+    def _admit(self, room, stop):
+        """
+        Yields the items of seq, reading each one only once room has been
+        acquired for it. The consumer releases room as it takes each result.
+        """
+        items = iter(self.seq)
+        while True:
+            room.acquire()
+            if stop.is_set():
+                return
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            self.started += 1
+            yield item
+
+    def _iter_threads(self):
+        import Queue
+        # the queues are bounded by room, which is only released as results are taken
+        room = threading.Semaphore(self.queue_size)
+        items = Queue.Queue()
+        results = Queue.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def feed():
+            try:
+                for item in self._admit(room, stop):
+                    items.put(item)
+            except Exception:
+                # seq itself failed, which ends the iteration
+                results.put((done, None, sys.exc_info()))
+            for n in range(self.workers):
+                items.put(done)
+
+        def work():
+            while True:
+                item = items.get()
+                if item is done:
+                    results.put((done, None, None))
+                    return
+                if stop.is_set():
+                    continue
+                try:
+                    results.put((item, self.fn(item), None))
+                except Exception:
+                    results.put((item, None, sys.exc_info()))
+
+        threads = [threading.Thread(target=feed)] + [threading.Thread(target=work) for n in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        running = self.workers
+        try:
+            while running:
+                item, result, error = results.get()
+                if item is done:
+                    if error is not None:
+                        raise error[0], error[1], error[2]
+                    running -= 1
+                    continue
+                self.finished += 1
+                room.release()
+                yield item, result, error
+        finally:
+            # wake the feeding thread if it's waiting for room
+            stop.set()
+            room.release()
+
+    def _iter_processes(self):
+        import multiprocessing
+        # the pool reads the whole iterable as fast as it can, so hold it back
+        # until there's room in the queue
+        room = threading.Semaphore(self.queue_size)
+        stop = threading.Event()
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            for item, result, error in pool.imap_unordered(functools.partial(_call, self.fn),
+                                                           self._admit(room, stop)):
+                self.finished += 1
+                room.release()
+                yield item, result, error
+            pool.close()
+        finally:
+            # wake the pool's feeding thread if it's waiting for room
+            stop.set()
+            room.release()
+            pool.terminate()
+            pool.join()
+
+
+def do_each(seq, fn, report_every=100, workers=1, mode='thread', errors='raise', queue_size=None, total=None):
     """
     Runs a fn on each item in the sequence and reports to console every n items.
 
     I'm sick of writing the same code over and over again to keep count in
     a for-each loop and printing to the console.
 
+    With more than one worker the items are run in a pool of threads (for I/O,
+    like IMAP, HTTP or BigQuery calls) or processes (for CPU bound work, where
+    fn and the items must be picklable) and finish in no particular order.
+    The report shows the items per second, how many are in flight and, if
+    the total is known, the time left.
+
     :param seq: the items to iterate over
     :param fn: function to run
     :param report_every: update console after this many have been processed
-    """
+    :param workers: number of threads or processes running fn at once
+    :param mode: 'thread' or 'process'
+    :param errors: 'raise' to stop and raise the first exception fn raises,
+        or 'collect' to carry on and return a list of (item, exception)
+    :param queue_size: items read ahead of those finished (default: 2 per worker)
+    :param total: number of items, for the time left, if seq has no len()
+    """
+    if errors not in ('raise', 'collect'):
+        raise ValueError('errors must be "raise" or "collect": %r' % errors)
+    if total is None and hasattr(seq, '__len__'):
+        total = len(seq)
+    failed = []
     count = 0
-    for item in seq:
-        fn(item)
+    start = time.time()
+    running = _ParallelMap(seq, fn, workers, mode, queue_size)
+    for item, result, error in running:
         count += 1
+        if error is not None:
+            if errors == 'raise':
+                sys.stdout.write('\n')
+                _reraise(error)
+            failed.append((item, error[1]))
         if count % report_every == 0:
-            sys.stdout.write('\r%d items processed' % count)
+            elapsed = time.time() - start
+            rate = count / elapsed if elapsed else 0.0
+            status = '\r%d items processed, %.1f/sec, %d in flight' % (count, rate, running.in_flight)
+            if total and rate:
+                status += ', %s left' % timedelta(seconds=int((total - count) / rate))
+            sys.stdout.write(status)
             sys.stdout.flush()
-    sys.stdout.write('Finished. %d items processed\n' % count)
+    elapsed = time.time() - start
+    sys.stdout.write('Finished. %d items processed in %.1fs (%.1f/sec)%s\n' %
+                     (count, elapsed, count / elapsed if elapsed else 0.0,
+                      ', %d failed' % len(failed) if failed else ''))
+    if errors == 'collect':
+        return failed
 
 
 def read_csv(path):
@@ -509,8 +1784,186 @@ def read_csv(path):
 
     :param path: path to the csv file
     """
-    values = []
-    with open(path) as f:
-        for line in f:
-            values.append([field.strip('"') for field in line.strip().split(',')])
-    return values
+    return list(iter_csv(path))
+
+
+# converters iter_csv accepts by name
+CSV_TYPES = {'int': int, 'float': float, 'date': todate, 'datetime': parsedate, 'str': None}
+
+# array.array typecodes for the converters iter_csv_columns stores in arrays
+_ARRAY_TYPECODES = {int: 'l', float: 'd'}
+
+
+def _open_csv(path):
+    """
+    Opens a filename for reading, decompressing it if it's gzipped.
+    """
+    import gzip
+    import io
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == '\x1f\x8b'
+    if gzipped:
+        # GzipFile's own line reading is slow, buffering it halves the time
+        return io.BufferedReader(gzip.open(path, 'rb'), 1024 * 1024)
+    return open(path, 'rb')
+
+
+def _iter_csv(source, columns, types, header, delimiter, repeated_headers=False, convert=True):
+    """
+    Returns (the keys of the columns, their converters, an iterator of the rows)
+    for iter_csv and iter_csv_columns. The keys are the selected columns, the
+    header's names or None.
+
+    :param convert: if False the rows' values are left as strings
+    """
+    import csv
+    import operator
+    reader = csv.reader(source, delimiter=delimiter)
+    names = (next(reader, None) or []) if header else None
+    if header and repeated_headers:
+        reader = (row for row in reader if row != names)
+
+    keys = names
+    if columns is not None:
+        indexes = []
+        for column in columns:
+            if isinstance(column, basestring):
+                if names is None:
+                    raise ValueError('Columns can only be selected by name if there is a header: %r' % column)
+                indexes.append(names.index(column))
+            else:
+                indexes.append(column)
+        keys = list(columns)
+        getter = operator.itemgetter(*indexes)
+        if len(indexes) == 1:
+            reader = ([getter(row)] for row in reader)
+        else:
+            reader = (list(getter(row)) for row in reader)
+
+    converters = None
+    if isinstance(types, dict):
+        if keys is None:
+            converters = [types.get(n) for n in range(max(types) + 1)] if types else []
+        else:
+            converters = [types.get(key, types.get(indexes[n] if columns is not None else n))
+                          for n, key in enumerate(keys)]
+    elif types:
+        converters = list(types)
+    if converters is not None:
+        converters = [CSV_TYPES[converter] if isinstance(converter, basestring) else converter
+                      for converter in converters]
+        if convert and any(converters):
+            reader = _convert_rows(reader, converters)
+    return keys, converters, reader
+
+
+def _convert_rows(rows, converters):
+    pairs = [(n, converter) for n, converter in enumerate(converters) if converter is not None]
+    for row in rows:
+        for n, converter in pairs:
+            value = row[n]
+            row[n] = converter(value) if value != '' else None
+        yield row
+
+
+def iter_csv(source, columns=None, types=None, header=False, delimiter=',', repeated_headers=False):
+    """
+    Reads a CSV file with the csv module and yields its rows as lists.
+
+    Quoted fields can contain delimiters, quotes and newlines. Gzipped files
+    are decompressed as they're read, so a large export (e.g., from
+    BigQuery.export_table with compress=True) is never all in memory.
+
+        for id, day, score in iter_csv('export.csv.gz', ['id', 'day', 'score'],
+                                       {'id': int, 'day': 'date', 'score': float}, header=True):
+
+    :param source: a filename, which may be gzipped, or a file object
+    :param columns: the columns to yield, in order, by index or, if there's a
+        header, by name. By default every column.
+    :param types: converters for the values of the columns: a dict of column
+        (by name or index) to converter, or a list with one per yielded column.
+        A converter is a function or one of 'int', 'float', 'date', 'datetime'
+        and 'str'. Empty values are converted to None.
+    :param header: if True the first row is the column names and isn't yielded
+    :param delimiter: the field delimiter
+    :param repeated_headers: if True, later rows equal to the header are skipped
+        too, for files joined from several shards that each start with it (like
+        BigQuery's exports). A data row whose values all equal the names would be
+        skipped as well.
+    """
+    if isinstance(source, basestring):
+        with contextlib.closing(_open_csv(source)) as f:
+            for row in iter_csv(f, columns, types, header, delimiter, repeated_headers):
+                yield row
+        return
+    keys, converters, rows = _iter_csv(source, columns, types, header, delimiter, repeated_headers)
+    for row in rows:
+        yield row
+
+
+def iter_csv_columns(source, columns=None, types=None, header=False, chunk_size=100000, numpy=False,
+                     delimiter=',', repeated_headers=False):
+    """
+    Reads a CSV file like iter_csv but yields it chunk_size rows at a time,
+    column by column, as an OrderedDict of column (as selected, otherwise its
+    name if there's a header or its index) to values.
+
+    int and float columns are packed into array.arrays (or numpy arrays if
+    numpy is True, which share the arrays' memory) and other columns are
+    lists, so a chunk takes a fraction of the memory of its rows. Empty
+    values in float columns become NaN; int columns can't have any. Every row
+    must have as many values as the first (or the header), otherwise a
+    ValueError names the one that doesn't.
+
+    :param chunk_size: rows in each chunk
+    :param numpy: if True the columns are numpy arrays
+    See iter_csv for the other parameters.
+    """
+    import array
+    if isinstance(source, basestring):
+        with contextlib.closing(_open_csv(source)) as f:
+            for chunk in iter_csv_columns(f, columns, types, header, chunk_size, numpy, delimiter,
+                                          repeated_headers):
+                yield chunk
+        return
+    if numpy:
+        import numpy as np
+
+    # the values are converted a whole column at a time, which is faster than row by row
+    keys, converters, rows = _iter_csv(source, columns, types, header, delimiter, repeated_headers,
+                                       convert=False)
+    width = len(keys) if keys is not None else None
+    count = 0
+    for batch in seq_batch(rows, chunk_size):
+        if width is None:
+            width = len(batch[0])
+        # zip would silently truncate every column to the shortest row
+        if len(set(map(len, batch))) > 1 or len(batch[0]) != width:
+            n = next(n for n, row in enumerate(batch) if len(row) != width)
+            raise ValueError('Data row %d has %d values, not %d' % (count + n + 1, len(batch[n]), width))
+        count += len(batch)
+        chunk = collections.OrderedDict()
+        for n, values in enumerate(zip(*batch)):
+            key = keys[n] if keys is not None else n
+            converter = converters[n] if converters is not None and n < len(converters) else None
+            if converter is not None:
+                if '' in values:
+                    values = [converter(value) if value != '' else None for value in values]
+                else:
+                    values = map(converter, values)
+            typecode = _ARRAY_TYPECODES.get(converter)
+            if typecode == 'd' and None in values:
+                values = [float('nan') if value is None else value for value in values]
+            elif typecode == 'l' and None in values:
+                raise ValueError('Column %r has empty values, which an int column can\'t hold. '
+                                 'Convert it with float instead.' % key)
+            if typecode:
+                values = array.array(typecode, values)
+                if numpy:
+                    values = np.frombuffer(values, np.dtype(typecode))
+            elif numpy:
+                values = np.array(values, dtype=object)
+            else:
+                values = list(values)
+            chunk[key] = values
+        yield chunk
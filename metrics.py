@@ -0,0 +1,150 @@
+"""
+A small in-process metrics registry of counters and histograms.
+
+Recording a value takes one lock and a bisect, so it's cheap enough to leave
+on. The registry can print a summary or export everything in the prometheus
+text format.
+"""
+import bisect
+import contextlib
+import threading
+import time
+
+# seconds
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# bytes or rows: 1k to 1g by powers of 4
+SIZE_BUCKETS = tuple(1024 * 4 ** n for n in range(11))
+
+
+class Histogram(object):
+    """
+    Counts observed values into buckets by upper bound.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # the last count is for values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """
+        Returns an estimate of the pth percentile: the upper bound of the bucket it falls in.
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics(object):
+    """
+    A thread-safe registry of counters and histograms identified by name and labels.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds value to a counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Records a value in a histogram, creating it with buckets the first time.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Records the seconds spent in the with block in a histogram.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def summary(self):
+        """
+        Returns a human readable summary of every counter and histogram.
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('%s%s %s' % (name, _format_labels(labels), value))
+            for (name, labels), h in sorted(self.histograms.items()):
+                lines.append('%s%s count=%d mean=%.4g p50=%.4g p90=%.4g p99=%.4g max=%.4g' %
+                             (name, _format_labels(labels), h.count, h.mean(), h.percentile(50),
+                              h.percentile(90), h.percentile(99), h.max))
+        return '\n'.join(lines)
+
+    def export_text(self):
+        """
+        Returns every metric in the prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('%s%s %s' % (name, _format_labels(labels), value))
+            for (name, labels), h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', bound),)), cumulative))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), h.sum))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in labels)
+
+
+# the registry used by the other modules
+registry = Metrics()
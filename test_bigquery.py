@@ -0,0 +1,653 @@
+import array
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+import unittest
+
+try:
+    import bigquery
+except ImportError:
+    bigquery = None
+
+
+class FakeRequest(object):
+
+    def __init__(self, fn, methodId=None):
+        self.fn = fn
+        self.methodId = methodId
+
+    def execute(self, http=None):
+        return self.fn()
+
+
+class FakeJobs(object):
+    """
+    Serves query pages for a table of rows like the BigQuery jobs resource.
+    """
+
+    def __init__(self, rows, page_size, schema=None):
+        self.rows = rows
+        self.page_size = page_size
+        self.schema = schema
+        self.requests = []
+
+    def page(self, start, max_results=None):
+        size = min(self.page_size, max_results or self.page_size)
+        reply = {'jobReference': {'projectId': 'p', 'jobId': 'job1'},
+                 'jobComplete': True,
+                 'totalRows': str(len(self.rows))}
+        if self.schema:
+            reply['schema'] = self.schema
+        page = self.rows[start:start + size]
+        if page:
+            reply['rows'] = [{'f': [{'v': v} for v in row]} for row in page]
+        return reply
+
+    def query(self, projectId, body):
+        return FakeRequest(lambda: self.page(0, body.get('maxResults')))
+
+    def getQueryResults(self, projectId, jobId, startIndex=0, maxResults=None, timeoutMs=None):
+        self.requests.append(startIndex)
+        return FakeRequest(lambda: self.page(startIndex, maxResults), 'bigquery.jobs.getQueryResults')
+
+
+class FakeJobStates(object):
+    """
+    Reports each job as running for a given number of checks before it's done.
+    """
+
+    def __init__(self, checks, failed=()):
+        self.checks = dict(checks)
+        self.failed = failed
+
+    def get(self, projectId, jobId):
+        def job():
+            self.checks[jobId] -= 1
+            if self.checks[jobId] > 0:
+                return {'status': {'state': 'RUNNING'}}
+            elif jobId in self.failed:
+                return {'status': {'state': 'DONE', 'errorResult': {},
+                                   'errors': [{'message': 'failed'}]}}
+            return {'status': {'state': 'DONE'}}
+        return FakeRequest(job)
+
+
+class FakeResponse(object):
+
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeUploads(object):
+    """
+    Records the rows of each load job request like the BigQuery upload endpoint.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def request(self, url, method='GET', body=None, headers=None, connection_type=None):
+        content = body.read()
+        assert len(content) == int(headers['Content-Length'])
+        if headers.get('Content-Encoding') == 'gzip':
+            content = gzip.GzipFile(fileobj=StringIO(content)).read()
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                return FakeResponse(503), ''
+            jobid = 'job%d' % len(self.jobs)
+            data = content.split('Content-Type: application/octet-stream\n\n')[1]
+            self.jobs[jobid] = data[:-len('\n--xxx--\n')].split('\n')[:-1]
+        return FakeResponse(200), json.dumps({'jobReference': {'jobId': jobid}})
+
+
+class FakeObject(object):
+
+    def __init__(self, bucket, name, content):
+        self.bucket = bucket
+        self.name = name
+        self.content = content
+
+    def get_contents_to_file(self, f, headers=None):
+        f.write(self.content)
+
+    def delete(self):
+        del self.bucket.objects[self.name]
+
+
+class FakeBucket(object):
+    """
+    An in memory google storage bucket.
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def add(self, name, content):
+        self.objects[name] = FakeObject(self, name, content)
+
+    def list(self, prefix=''):
+        return [obj for name, obj in self.objects.items() if name.startswith(prefix)]
+
+
+class FakeExportJobs(object):
+    """
+    Exports a table to shards in a FakeBucket as soon as the extract job is inserted.
+    """
+
+    def __init__(self, bucket, shards):
+        self.bucket = bucket
+        self.shards = shards
+
+    def insert(self, projectId, body):
+        uri = body['configuration']['extract']['destinationUri']
+        prefix = uri[len('gs://facts/'):-len('*.csv')]
+        # in reverse so listing order doesn't match shard order
+        for n in reversed(range(len(self.shards))):
+            self.bucket.add('%s%012d.csv' % (prefix, n), self.shards[n])
+        return FakeRequest(lambda: {'jobReference': {'jobId': 'export'}})
+
+    def get(self, projectId, jobId):
+        return FakeRequest(lambda: {'status': {'state': 'DONE'}})
+
+
+class FakePipelineJobs(object):
+    """
+    Runs each query job for a number of checks and records the tables written and deleted.
+    """
+
+    def __init__(self, checks, failures=()):
+        self.checks = checks
+        self.failures = list(failures)
+        self.jobs = {}
+        self.events = []
+
+    def insert(self, projectId, body):
+        table = body['configuration']['query']['destinationTable']['tableId']
+        jobid = '%s%d' % (table, len(self.jobs))
+        self.jobs[jobid] = self.checks.get(table, 1)
+        self.events.append(('insert', table))
+        return FakeRequest(lambda: {'jobReference': {'jobId': jobid}})
+
+    def get(self, projectId, jobId):
+        def job():
+            self.jobs[jobId] -= 1
+            if self.jobs[jobId] > 0:
+                return {'status': {'state': 'RUNNING'}}
+            table = jobId.rstrip('0123456789')
+            self.events.append(('done', table))
+            if table in self.failures:
+                self.failures.remove(table)
+                return {'status': {'state': 'DONE', 'errorResult': {}}}
+            return {'status': {'state': 'DONE'}}
+        return FakeRequest(job)
+
+    def delete(self, projectId, datasetId, tableId):
+        self.events.append(('delete', tableId))
+        return FakeRequest(lambda: None)
+
+
+class FakeCredentials(object):
+
+    def authorize(self, http):
+        return None
+
+
+def fake_client(jobs):
+    client = bigquery.BigQuery.__new__(bigquery.BigQuery)
+    client.project = 'p'
+    client.dataset = 'd'
+    client.jobs = jobs
+    client.credentials = FakeCredentials()
+    client.pool = bigquery.HttpPool(client.credentials, 4)
+    return client
+
+
+@unittest.skipIf(bigquery is None, 'bigquery dependencies are not installed')
+class TestBigQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [[str(n), 'name%d' % n] for n in range(25)]
+
+    def test_query(self):
+        client = fake_client(FakeJobs(self.rows, 10))
+        self.assertEqual(self.rows, client.query('select'))
+
+    def test_iter_query(self):
+        jobs = FakeJobs(self.rows, 10)
+        client = fake_client(jobs)
+        self.assertEqual(self.rows, list(client.iter_query('select', prefetch=2)))
+        self.assertEqual([10, 20], jobs.requests)
+
+    def test_iter_query_batches(self):
+        client = fake_client(FakeJobs(self.rows, 100))
+        pages = list(client.iter_query('select', page_size=7, batches=True))
+        self.assertEqual([7, 7, 7, 4], [len(page) for page in pages])
+
+    def test_iter_query_stops_early(self):
+        client = fake_client(FakeJobs(self.rows, 5))
+        rows = client.iter_query('select', prefetch=1)
+        self.assertEqual(self.rows[0], next(rows))
+        rows.close()
+
+    def read_results(self, client, **kwargs):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            client.get_query_results('job1', filename, **kwargs)
+            with open(filename) as f:
+                return [line.strip().split(',') for line in f]
+        finally:
+            os.remove(filename)
+
+    def test_get_query_results(self):
+        client = fake_client(FakeJobs(self.rows, 4))
+        self.assertEqual(self.rows, self.read_results(client))
+
+    def test_get_query_results_parallel(self):
+        client = fake_client(FakeJobs(self.rows, 4))
+        self.assertEqual(self.rows, self.read_results(client, workers=3))
+
+    def test_get_query_results_unordered(self):
+        client = fake_client(FakeJobs(self.rows, 4))
+        self.assertEqual(sorted(self.rows), sorted(self.read_results(client, workers=3, ordered=False)))
+
+    def test_wait_for_jobs(self):
+        client = fake_client(FakeJobStates({'slow': 4, 'fast': 1, 'bad': 2}, failed=['bad']))
+        finished = list(client.wait_for_jobs(['slow', 'fast', 'bad'], initial_delay=0.001))
+        self.assertEqual([('fast', 'SUCCESS'), ('bad', 'FAILED'), ('slow', 'SUCCESS')], finished)
+
+    def test_wait_for_jobs_checks_at_once(self):
+        client = fake_client(FakeJobStates({'quick': 1}))
+        start = time.time()
+        self.assertEqual([('quick', 'SUCCESS')], list(client.wait_for_jobs(['quick'], initial_delay=10)))
+        self.assertLess(time.time() - start, 1)
+
+    def test_wait_for_job_timeout(self):
+        client = fake_client(FakeJobStates({'slow': 100}))
+        self.assertRaises(RuntimeError, client.wait_for_job, 'slow', timeout=0.01)
+
+    def test_update_table(self):
+        uploads = FakeUploads(failures=2)
+        client = fake_client(None)
+        client.credentials.authorize = lambda http: uploads
+        rows = ('%d,name%d' % (n, n) for n in range(1000))
+        jobid = client.update_table('t', rows, '[]', compress=True)
+        self.assertEqual(['%d,name%d' % (n, n) for n in range(1000)], uploads.jobs[jobid])
+
+    def test_update_table_chunked(self):
+        uploads = FakeUploads()
+        client = fake_client(None)
+        client.credentials.authorize = lambda http: uploads
+        rows = ['%04d' % n for n in range(1000)]
+        jobids = client.update_table_chunked('t', iter(rows), '[]', max_job_bytes=1000, workers=3)
+        self.assertEqual(5, len(jobids))
+        self.assertEqual(rows, sum([uploads.jobs[jobid] for jobid in jobids], []))
+
+    def test_query_metrics(self):
+        metrics = bigquery.metrics.registry
+        metrics.reset()
+        client = fake_client(FakeJobs(self.rows, 10))
+        client.query('select')
+        self.assertEqual(2, metrics.counter('bigquery_requests_total', method='jobs.getQueryResults'))
+        self.assertEqual(15, metrics.counter('bigquery_rows_total', method='jobs.getQueryResults'))
+        self.assertEqual(2, metrics.histogram('bigquery_request_seconds', method='jobs.getQueryResults').count)
+
+    def test_query_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            jobs = FakeJobs(self.rows, 10)
+            client = fake_client(jobs)
+            client.cache = bigquery.QueryCache(path)
+            self.assertEqual(self.rows, client.query('select a from [d.t]'))
+            self.assertEqual(self.rows, client.query('select a\n  from [d.t];'))
+            self.assertEqual([10, 20], jobs.requests)
+            client.cache.invalidate('t')
+            self.assertEqual(self.rows, client.query('select a from [d.t]'))
+            self.assertEqual([10, 20, 10, 20], jobs.requests)
+        finally:
+            shutil.rmtree(path)
+
+    def test_query_columns(self):
+        schema = {'fields': [{'name': 'id', 'type': 'INTEGER'},
+                             {'name': 'name', 'type': 'STRING'},
+                             {'name': 'score', 'type': 'FLOAT'},
+                             {'name': 'active', 'type': 'BOOLEAN'},
+                             {'name': 'tags', 'type': 'STRING', 'mode': 'REPEATED'}]}
+        rows = [[str(n), u'name%d' % (n % 3), None if n == 5 else '%d.5' % n, 'true' if n % 2 else 'false',
+                 [{'v': 'a'}]] for n in range(25)]
+        client = fake_client(FakeJobs(rows, 10, schema))
+        result = client.query_columns('select')
+        self.assertEqual(25, len(result))
+        self.assertEqual(['id', 'name', 'score', 'active', 'tags'], list(result))
+        self.assertEqual(array.array('l', range(25)), result['id'])
+        self.assertEqual(3.5, result['score'][3])
+        self.assertEqual([5], result.nulls['score'])
+        self.assertEqual([False, True], list(result['active'][:2]))
+        self.assertEqual(u'name1', result['name'][4])
+        self.assertTrue(result['name'][1] is result['name'][4])
+        self.assertEqual([{'v': 'a'}], result['tags'][0])
+
+    def test_query_columns_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        schema = {'fields': [{'name': 'id', 'type': 'INTEGER'}, {'name': 'score', 'type': 'FLOAT'}]}
+        rows = [[str(n), '%d.5' % n] for n in range(25)]
+        client = fake_client(FakeJobs(rows, 10, schema))
+        result = client.query_columns('select', numpy=True)
+        self.assertEqual(300, result['id'].sum())
+        self.assertEqual(numpy.float64, result['score'].dtype)
+
+    def export(self, shards, **kwargs):
+        bucket = FakeBucket()
+        bucket.add('other_table.000000000000.csv', 'other\n')
+        client = fake_client(FakeExportJobs(bucket, shards))
+        client._bucket = lambda name: bucket
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            client.export_table('table', filename, **kwargs)
+            self.assertEqual(['other_table.000000000000.csv'], bucket.objects.keys())
+            self.assertEqual([], [name for name in os.listdir(os.path.dirname(filename))
+                                  if name.startswith(os.path.basename(filename) + '.')])
+            if kwargs.get('compress'):
+                return gzip.open(filename).read()
+            return open(filename).read()
+        finally:
+            os.remove(filename)
+
+    def test_export_table(self):
+        shards = ['%d,a\n%d,b\n' % (n, n) for n in range(12)]
+        self.assertEqual(''.join(shards), self.export(shards, workers=3))
+
+    def test_export_table_compressed(self):
+        shards = ['%d,a\n%d,b\n' % (n, n) for n in range(5)]
+        self.assertEqual(''.join(shards), self.export(shards, compress=True))
+
+    def pipeline(self, jobs, **kwargs):
+        client = fake_client(jobs)
+        client.service = jobs
+        client.service.tables = lambda: jobs
+        pipeline = bigquery.Pipeline(client, initial_delay=0.001, **kwargs)
+        pipeline.add('a', 'select x from [d.source]', 'a')
+        pipeline.add('b', 'select x from [d.source]', 'b', temporary=True)
+        pipeline.add('c', 'select x from [d.a] join each [d.b] on x', 'c')
+        pipeline.add('d', 'select x from [d.c]', 'd')
+        return pipeline
+
+    def test_pipeline(self):
+        jobs = FakePipelineJobs({'a': 3, 'b': 1})
+        pipeline = self.pipeline(jobs)
+        pipeline.run()
+        events = jobs.events
+        self.assertEqual([('insert', 'a'), ('insert', 'b')], events[:2])
+        self.assertTrue(events.index(('done', 'a')) < events.index(('insert', 'c')))
+        self.assertTrue(events.index(('done', 'c')) < events.index(('delete', 'b')))
+        self.assertEqual(('done', 'd'), events[-1])
+        self.assertEqual(['a', 'c', 'd'], pipeline.critical_path())
+        self.assertEqual(1, pipeline.timings['c']['attempts'])
+
+    def test_pipeline_retries(self):
+        jobs = FakePipelineJobs({}, failures=['c'])
+        pipeline = self.pipeline(jobs, max_concurrent=1)
+        pipeline.run()
+        self.assertEqual(2, pipeline.timings['c']['attempts'])
+        self.assertEqual(2, jobs.events.count(('insert', 'c')))
+
+    def test_pipeline_failure_cleans_up(self):
+        jobs = FakePipelineJobs({}, failures=['c', 'c'])
+        self.assertRaises(ValueError, self.pipeline(jobs).run)
+        self.assertIn(('delete', 'b'), jobs.events)
+        self.assertNotIn(('insert', 'd'), jobs.events)
+
+    def test_import_is_lazy(self):
+        self.assertNotIn('boto', sys.modules)
+        self.assertNotIn('gslib', sys.modules)
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        if bigquery is None:
+            self.skipTest('bigquery dependencies are not installed')
+        self.path = tempfile.mkdtemp()
+        self.cache = bigquery.QueryCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_default_path(self):
+        original = bigquery.CACHE_DIR
+        bigquery.CACHE_DIR = os.path.join(self.path, 'bigquery')
+        try:
+            cache = bigquery.QueryCache()
+        finally:
+            bigquery.CACHE_DIR = original
+        # not the shared temp directory, where anyone could plant results
+        self.assertEqual(os.path.join(self.path, 'bigquery', 'queries'), cache.path)
+        self.assertEqual(0700, os.stat(cache.path).st_mode & 0777)
+
+    def test_key(self):
+        key = self.cache.key("select a, 'x  y' from t", 'p', 'd')
+        self.assertEqual(key, self.cache.key("select a,\n 'x  y'\nfrom t;", 'p', 'd'))
+        self.assertNotEqual(key, self.cache.key("select a, 'x y' from t", 'p', 'd'))
+        self.assertNotEqual(key, self.cache.key("select a, 'x  y' from t", 'p', 'other'))
+
+    def test_tables(self):
+        self.assertEqual(['_latest', 'user_snapshots'], self.cache.tables(
+            'SELECT * FROM [Activity.user_snapshots] JOIN EACH [Activity._latest] ON x'))
+        self.assertEqual(['t'], self.cache.tables('select a from d.t'))
+
+    def test_get_set(self):
+        self.assertEqual(None, self.cache.get('k'))
+        self.cache.set('k', [[u'1', None], [u'2', u'b']])
+        self.assertEqual([[u'1', None], [u'2', u'b']], self.cache.get('k'))
+        self.cache.set('empty', [])
+        self.assertEqual([], self.cache.get('empty'))
+
+    def test_ttl(self):
+        self.cache.ttl = -1
+        self.cache.set('k', [['1']])
+        self.assertEqual(None, self.cache.get('k'))
+
+    def test_eviction(self):
+        self.cache.max_bytes = 200
+        for n in range(10):
+            self.cache.set('k%d' % n, [[str(n)]])
+            os.utime(os.path.join(self.path, 'k%d' % n), (n, n))
+        self.assertEqual(None, self.cache.get('k0'))
+        self.assertEqual([['9']], self.cache.get('k9'))
+
+
+class RefreshingCredentials(object):
+
+    def __init__(self):
+        self.access_token = None
+        self.refreshes = 0
+        self.lock = threading.Lock()
+
+    def authorize(self, http):
+        return http
+
+    def refresh(self, http):
+        with self.lock:
+            self.refreshes += 1
+        self.access_token = 'token'
+
+
+@unittest.skipIf(bigquery is None, 'bigquery dependencies are not installed')
+class TestHttpPool(unittest.TestCase):
+
+    def test_connections_are_reused(self):
+        pool = bigquery.HttpPool(RefreshingCredentials(), 2)
+        with pool.connection() as first:
+            with pool.connection() as second:
+                self.assertFalse(first is second)
+        with pool.connection() as http:
+            self.assertTrue(http is first)
+
+    def test_timeout(self):
+        pool = bigquery.HttpPool(RefreshingCredentials(), 2, timeout=5)
+        with pool.connection() as http:
+            self.assertEqual(5, http.timeout)
+        with pool.connection(fresh=True) as http:
+            self.assertEqual(5, http.timeout)
+
+    def test_concurrent_use(self):
+        credentials = RefreshingCredentials()
+        pool = bigquery.HttpPool(credentials, 3)
+        in_use = set()
+        errors = []
+
+        def work():
+            for n in range(50):
+                with pool.connection() as http:
+                    if id(http) in in_use or len(in_use) >= 3:
+                        errors.append(http)
+                    in_use.add(id(http))
+                    in_use.discard(id(http))
+
+        threads = [threading.Thread(target=work) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(1, credentials.refreshes)
+        self.assertTrue(pool.idle.qsize() <= 3)
+
+
+@unittest.skipIf(bigquery is None, 'bigquery dependencies are not installed')
+class TestFakeServer(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import apiclient.discovery
+            import fake_bigquery
+        except ImportError:
+            self.skipTest('apiclient is not installed')
+        self.server = fake_bigquery.FakeBigQueryServer(rows=250, page_size=100).start()
+        self.client = self.server.client()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_query(self):
+        rows = self.client.query('select id, name, score')
+        self.assertEqual(250, len(rows))
+        self.assertEqual([u'249', u'name249', u'249.5'], rows[-1])
+
+    def test_load_and_query(self):
+        jobid = self.client.update_table('t', ('%d,x' % n for n in range(10)), '[]')
+        self.assertEqual('SUCCESS', self.client.wait_for_job(jobid))
+        self.assertEqual([[str(n), 'x'] for n in range(10)], self.client.query('select * from [dataset.t]'))
+        self.client.delete_table('t')
+        self.assertEqual({}, self.server.tables)
+
+    def test_cache_invalidated_when_job_finishes(self):
+        path = tempfile.mkdtemp()
+        try:
+            client = self.server.client(cache=bigquery.QueryCache(path))
+            client.wait_for_job(client.update_table('t', ['1,old'], '[]'))
+            self.assertEqual([['1', 'old']], client.query('select * from [dataset.t]'))
+            self.server.job_seconds = 0.5
+            jobid = client.query("select 2, 'new' from [dataset.u]", 't', write_disposition='WRITE_TRUNCATE')
+            # read while the job runs, which caches the old rows again
+            self.assertEqual([['1', 'old']], client.query('select * from [dataset.t]'))
+            self.assertEqual('SUCCESS', client.wait_for_job(jobid))
+            self.assertEqual(250, len(client.query('select * from [dataset.t]')))
+        finally:
+            shutil.rmtree(path)
+
+    def test_dropped_upload(self):
+        self.server.drop_uploads = 1
+        jobids = []
+        thread = threading.Thread(target=lambda: jobids.append(
+            self.client.update_table('t', ('%d,x' % n for n in range(100)), '[]')))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        # the upload is sent again in full rather than hanging on an empty retry
+        self.assertFalse(thread.is_alive())
+        self.assertEqual('SUCCESS', self.client.wait_for_job(jobids[0]))
+        self.assertEqual(100, len(self.server.tables['t']['rows']))
+
+    def test_faults(self):
+        self.server.fault_every = 4
+        for n in range(3):
+            self.assertEqual(250, len(self.client.query('select 1')))
+
+
+class FakeDiscovery(object):
+
+    document = json.dumps({'kind': 'discovery#restDescription', 'name': 'bigquery', 'version': 'v2',
+                           'rootUrl': 'https://www.googleapis.com/', 'servicePath': 'bigquery/v2/',
+                           'resources': {'jobs': {'methods': {}}}})
+
+    def __init__(self):
+        self.requests = 0
+
+    def request(self, uri, *args, **kwargs):
+        self.requests += 1
+        return FakeResponse(200), self.document
+
+
+@unittest.skipIf(bigquery is None, 'bigquery dependencies are not installed')
+class TestDiscoveryCache(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import apiclient.discovery
+        except ImportError:
+            self.skipTest('apiclient is not installed')
+        self.original = bigquery.DISCOVERY_CACHE
+        self.path = tempfile.mkdtemp()
+        bigquery.DISCOVERY_CACHE = os.path.join(self.path, 'bigquery', 'discovery.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        bigquery.DISCOVERY_CACHE = self.original
+
+    def test_discovery_document_is_cached(self):
+        http = FakeDiscovery()
+        bigquery._build_service(http)
+        service = bigquery._build_service(http)
+        self.assertEqual(1, http.requests)
+        self.assertTrue(hasattr(service, 'jobs'))
+        # only this user can read or write it
+        self.assertEqual(0700, os.stat(os.path.dirname(bigquery.DISCOVERY_CACHE)).st_mode & 0777)
+        self.assertEqual(0600, os.stat(bigquery.DISCOVERY_CACHE).st_mode & 0777)
+
+    def test_planted_document_is_replaced(self):
+        planted = json.loads(FakeDiscovery.document)
+        planted['rootUrl'] = 'https://attacker.example.com/'
+        os.makedirs(os.path.dirname(bigquery.DISCOVERY_CACHE))
+        with open(bigquery.DISCOVERY_CACHE, 'w') as f:
+            json.dump(planted, f)
+        http = FakeDiscovery()
+        bigquery._build_service(http)
+        self.assertEqual(1, http.requests)
+        with open(bigquery.DISCOVERY_CACHE) as f:
+            self.assertEqual(FakeDiscovery.document, f.read())
+
+    def test_other_root_url(self):
+        http = FakeDiscovery()
+        for root, service_path in [('https://attacker.example.com/', 'bigquery/v2/'),
+                                   ('https://www.googleapis.com/', 'https://attacker.example.com/bigquery/v2/')]:
+            http.document = json.dumps({'rootUrl': root, 'servicePath': service_path})
+            self.assertRaises(ValueError, bigquery._build_service, http)
+        self.assertFalse(os.path.exists(bigquery.DISCOVERY_CACHE))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,941 @@
+import BaseHTTPServer
+import SocketServer
+import array
+import contextlib
+import gc
+import gzip
+import math
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import weakref
+from datetime import datetime
+from StringIO import StringIO
+
+import fake_imap
+import functions
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TestMemoize(unittest.TestCase):
+
+    def test_unbounded(self):
+        calls = []
+
+        @functions.memoize
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual(4, square(2))
+        self.assertEqual(4, square(2))
+        self.assertEqual(9, square(3))
+        self.assertEqual([2, 3], calls)
+        self.assertEqual(functions.CacheInfo(1, 2, 0, None, 2), square.cache_info())
+
+    def test_kwargs(self):
+        calls = []
+
+        @functions.memoize()
+        def add(x, y=0):
+            calls.append((x, y))
+            return x + y
+
+        self.assertEqual(3, add(1, y=2))
+        self.assertEqual(3, add(1, y=2))
+        self.assertEqual(1, add(1))
+        self.assertEqual([(1, 2), (1, 0)], calls)
+
+    def test_unhashable(self):
+        total = functions.memoize(sum)
+        self.assertEqual(6, total([1, 2, 3]))
+        self.assertEqual(0, total.cache_info().currsize)
+
+    def test_lru(self):
+        calls = []
+
+        @functions.memoize(maxsize=2)
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        double(1)
+        double(2)
+        double(1)
+        double(3)  # evicts 2, the least recently used
+        double(1)
+        double(2)
+        self.assertEqual([1, 2, 3, 2], calls)
+        info = double.cache_info()
+        self.assertEqual((2, 4, 2, 2, 2), info)
+
+    def test_ttl(self):
+        calls = []
+
+        @functions.memoize(ttl=0.05)
+        def identity(x):
+            calls.append(x)
+            return x
+
+        identity(1)
+        identity(1)
+        time.sleep(0.06)
+        identity(1)
+        self.assertEqual([1, 1], calls)
+        self.assertEqual(1, identity.cache_info().evictions)
+
+    def test_ttl_purges(self):
+        identity = functions.memoize(lambda x: x, ttl=0.05)
+        for n in range(1000):
+            identity(n)
+        time.sleep(0.06)
+        # storing a result drops the ones that have expired, even if they're never asked for
+        identity('new')
+        self.assertEqual((0, 1001, 1000, None, 1), identity.cache_info())
+
+    def test_typed(self):
+        @functions.memoize(typed=True)
+        def kind(x):
+            return type(x)
+
+        self.assertEqual(int, kind(1))
+        self.assertEqual(float, kind(1.0))
+
+    def test_cache_clear(self):
+        square = functions.memoize(lambda x: x * x, maxsize=10)
+        square(2)
+        square.cache_clear()
+        self.assertEqual((0, 0, 0, 10, 0), square.cache_info())
+
+    def test_method(self):
+        class Counter(object):
+            def __init__(self):
+                self.calls = 0
+
+            @functions.memoize
+            def value(self, x):
+                self.calls += 1
+                return x
+
+        counter = Counter()
+        counter.value(1)
+        counter.value(1)
+        self.assertEqual(1, counter.calls)
+
+    def test_per_instance(self):
+        class Client(object):
+            def __init__(self, name):
+                self.name = name
+                self.calls = 0
+
+            @functions.memoize(maxsize=2, per_instance=True)
+            def get(self, x):
+                self.calls += 1
+                return '%s%s' % (self.name, x)
+
+        a, b = Client('a'), Client('b')
+        self.assertEqual('a1', a.get(1))
+        self.assertEqual('a1', a.get(1))
+        self.assertEqual('b1', b.get(1))
+        self.assertEqual((1, 1, 0, 2, 1), a.get.cache_info())
+        self.assertEqual(1, b.calls)
+
+        a.get(2)
+        a.get(3)
+        self.assertEqual(1, a.get.cache_info().evictions)
+
+        ref = weakref.ref(a)
+        del a
+        gc.collect()
+        self.assertEqual(None, ref())
+        self.assertEqual(1, len(Client.get.instances))
+
+    def test_per_instance_equal(self):
+        class Person(object):
+            def __init__(self, id, name):
+                self.id = id
+                self.name = name
+
+            def __eq__(self, other):
+                return self.id == other.id
+
+            def __hash__(self):
+                return hash(self.id)
+
+            @functions.memoize(per_instance=True)
+            def greet(self, greeting):
+                return '%s %s' % (greeting, self.name)
+
+        a, b = Person(1, 'a'), Person(1, 'b')
+        self.assertEqual('hi a', a.greet('hi'))
+        # b is equal to a, but it's a different instance with its own cache
+        self.assertEqual('hi b', b.greet('hi'))
+        self.assertEqual(2, len(Person.greet.instances))
+        del a, b
+        gc.collect()
+        self.assertEqual(0, len(Person.greet.instances))
+
+    def test_per_instance_slots(self):
+        class Point(object):
+            __slots__ = ('x', '__dict__')
+
+            def __init__(self, x):
+                self.x = x
+
+            @functions.memoize(per_instance=True)
+            def scaled(self, n):
+                return self.x * n
+
+        point = Point(2)
+        self.assertEqual(6, point.scaled(3))
+        self.assertEqual(6, point.scaled(3))
+        self.assertEqual(1, point.scaled.cache_info().hits)
+
+    def test_threads(self):
+        @functions.memoize(maxsize=50)
+        def square(x):
+            return x * x
+
+        def run():
+            for n in range(1000):
+                self.assertEqual((n % 100) ** 2, square(n % 100))
+
+        threads = [threading.Thread(target=run) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        info = square.cache_info()
+        self.assertEqual(8000, info.hits + info.misses)
+        self.assertEqual(50, info.currsize)
+
+
+
+def slow_square(x):
+    with open(os.environ['SQUARE_LOG'], 'a') as f:
+        f.write('%d\n' % x)
+    return x * x
+
+
+def square_in_process(args):
+    path, x = args
+    return functions.memoize(slow_square, backend=functions.SqliteCache(path))(x)
+
+
+class TestSqliteCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = functions.SqliteCache(os.path.join(self.path, 'cache.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_set(self):
+        self.assertEqual(None, self.cache.get('a'))
+        self.cache.set('a', {'rows': [1, 2]})
+        self.cache.set('b', None)
+        self.assertEqual({'rows': [1, 2]}, self.cache.get('a'))
+        self.assertEqual(None, self.cache.get('b', 'missing'))
+        self.cache.delete('a')
+        self.assertEqual('missing', self.cache.get('a', 'missing'))
+
+    def test_ttl(self):
+        cache = functions.SqliteCache(self.cache.path, ttl=0.05)
+        cache.set('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        time.sleep(0.06)
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_max_bytes(self):
+        cache = functions.SqliteCache(self.cache.path, max_bytes=3000)
+        for n in range(5):
+            cache.set(n, 'x' * 1000)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(None, cache.get(0))
+        self.assertEqual('x' * 1000, cache.get(4))
+
+    def test_size_checks(self):
+        class CountingCache(functions.SqliteCache):
+            checks = 0
+
+            def _total_size(self, conn):
+                self.checks += 1
+                return functions.SqliteCache._total_size(self, conn)
+
+        cache = CountingCache(self.cache.path, max_bytes=100000)
+        for n in range(2000):
+            cache.set(n, 'x' * 100)
+        # the table is only totalled after each 1% of max_bytes written, not on every set
+        self.assertTrue(cache.checks <= 2000 * 120 / 1000 + 1)
+        size = cache._connection().execute('SELECT TOTAL(size) FROM cache').fetchone()[0]
+        self.assertTrue(size <= 100000 * 1.01)
+
+    def test_memoize(self):
+        calls = []
+
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        first = functions.memoize(square, backend=self.cache)
+        self.assertEqual(4, first(2))
+        # a new memoize, like one in another process, finds it in the backend
+        second = functions.memoize(square, maxsize=10, backend=self.cache)
+        self.assertEqual(4, second(2))
+        self.assertEqual(4, second(2))
+        self.assertEqual([2], calls)
+        self.assertEqual((1, 1, 0, 10, 1), second.cache_info())
+
+    def test_default_path(self):
+        cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.path
+        try:
+            cache = functions.SqliteCache()
+        finally:
+            if cache_home is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = cache_home
+        # in a directory only this user can get into, not the shared temp directory
+        self.assertEqual(os.path.join(self.path, 'memoize', 'cache.db'), cache.path)
+        self.assertEqual(0700, os.stat(os.path.dirname(cache.path)).st_mode & 0777)
+
+    def test_per_instance(self):
+        self.assertRaises(ValueError, functions.memoize, len, per_instance=True, backend=self.cache)
+
+    def test_unpicklable(self):
+        def new_lock(name):
+            return threading.Lock()
+
+        lock = functions.memoize(new_lock, backend=self.cache)
+        lock('a')
+        square = functions.memoize(lambda x: x * x, backend=self.cache)
+        self.assertEqual(4, square(2))
+        self.assertEqual(0, len(self.cache))
+
+    def test_processes(self):
+        os.environ['SQUARE_LOG'] = os.path.join(self.path, 'calls')
+        pool = multiprocessing.Pool(4)
+        try:
+            args = [(self.cache.path, n % 10) for n in range(200)]
+            self.assertEqual([(n % 10) ** 2 for n in range(200)], pool.map(square_in_process, args, 10))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(10, len(self.cache))
+        with open(os.environ['SQUARE_LOG']) as f:
+            # a process only calls it when no other process has stored the result yet
+            self.assertTrue(len(f.readlines()) <= 40)
+
+
+
+def cube(x):
+    if x == 13:
+        raise ValueError('unlucky')
+    return x ** 3
+
+
+
+
+class TestImap(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fake_imap.FakeImapServer(messages=100).start()
+        self.imap = functions.imap_login('127.0.0.1', 'user', 'password', port=self.server.port, ssl=False)
+        self.imap.select('INBOX')
+
+    def tearDown(self):
+        self.imap.logout()
+        self.server.stop()
+
+    def test_sequence_sets(self):
+        self.assertEqual('1:3,5,7:9', functions.imap_sequence_set(['9', 1, 2, 3, 5, 7, '8', 3]))
+        self.assertEqual('', functions.imap_sequence_set([]))
+        sets = list(functions.imap_sequence_sets(range(1, 40, 2), max_length=10))
+        self.assertEqual(['1,3,5,7,9', '11,13,15', '17,19,21', '23,25,27', '29,31,33', '35,37,39'], sets)
+        self.assertTrue(all(len(s) <= 10 for s in sets))
+
+    def test_message_ids(self):
+        self.assertEqual([str(n) for n in range(1, 101)], functions.imap_get_message_ids(self.imap))
+        self.assertEqual([str(n) for n in range(1, 101)], functions.imap_get_message_ids(self.imap, uid=True))
+
+    def test_delete_messages(self):
+        functions.imap_delete_messages(self.imap, [str(n) for n in range(1, 51)])
+        self.assertEqual(1, self.server.commands['STORE'])
+        self.assertEqual(range(51, 101), self.server.uids())
+
+    def test_delete_uids(self):
+        functions.imap_delete_messages(self.imap, [str(n) for n in range(2, 101, 2)], uid=True)
+        functions.imap_delete_messages(self.imap, ['1', '99'], uid=True)
+        self.assertEqual(range(3, 99, 2), self.server.uids())
+        self.assertEqual(['3', '5'], functions.imap_get_message_ids(self.imap, uid=True)[:2])
+
+    def test_pipeline(self):
+        sets = list(functions.imap_sequence_sets(range(1, 101, 2), 20))
+        original = functions.IMAP_MAX_SEQUENCE_SET
+        functions.IMAP_MAX_SEQUENCE_SET = 20
+        try:
+            functions.imap_delete_messages(self.imap, range(1, 101, 2), pipeline=3)
+        finally:
+            functions.IMAP_MAX_SEQUENCE_SET = original
+        self.assertEqual(len(sets), self.server.commands['STORE'])
+        self.assertEqual(range(2, 101, 2), self.server.uids())
+
+
+    def connect(self):
+        return functions.imap_login('127.0.0.1', 'user', 'password', port=self.server.port, ssl=False)
+
+    def test_fetch_messages(self):
+        messages = list(functions.imap_fetch_messages(self.connect, connections=3, batch_size=7))
+        self.assertEqual(range(1, 101), sorted(uid for uid, message in messages))
+        for uid, message in messages:
+            self.assertEqual('message %d' % uid, message['Subject'])
+            self.assertEqual('This is the body of message %d.\r\n' % uid, message.get_payload())
+        self.assertEqual(15, self.server.commands['FETCH'])
+        self.assertEqual(3, self.server.commands['LOGIN'] - 1)
+
+    def test_fetch_messages_bounded(self):
+        messages = functions.imap_fetch_messages(self.connect, connections=2, batch_size=5)
+        next(messages)
+        time.sleep(0.2)
+        # two batches per connection, plus the one taken
+        self.assertTrue(self.server.commands['FETCH'] <= 2 * 2 + 1)
+        self.assertEqual(99, sum(1 for message in messages))
+        self.assertEqual(20, self.server.commands['FETCH'])
+
+    def test_fetch_uids(self):
+        functions.imap_delete_messages(self.imap, range(1, 51))
+        messages = functions.imap_fetch_messages(self.connect, message_ids=['60', '61', '99'], uid=True,
+                                                 headers_only=True)
+        messages = sorted(messages)
+        self.assertEqual([60, 61, 99], [uid for uid, message in messages])
+        self.assertEqual('sender61@example.com', messages[1][1]['From'])
+        self.assertEqual('', messages[1][1].get_payload())
+
+
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves /<n> as 'page <n>' with an ETag, after a short pause, and answers
+    conditional requests with 304.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.running += 1
+            server.most = max(server.most, server.running)
+        try:
+            time.sleep(0.01)
+            if self.path == '/missing':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            etag = '"%s"' % self.path.strip('/')
+            if self.headers.get('If-None-Match') == etag:
+                with server.lock:
+                    server.not_modified += 1
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = u'page %s \u2713' % self.path.strip('/')
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.running -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class PageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), PageHandler)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.requests = self.running = self.most = self.not_modified = 0
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+
+class TestFetchUrls(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PageServer()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        functions.http_close_sessions()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def test_get_text_from_url(self):
+        self.assertEqual(u'page 1 \u2713', functions.get_text_from_url(self.server.url + '/1'))
+
+    def test_fetch_urls(self):
+        urls = ['%s/%d' % (self.server.url, n) for n in range(20)] + [self.server.url + '/missing']
+        results = sorted(functions.fetch_urls(iter(urls), workers=8, per_host=3))
+        self.assertEqual(21, len(results))
+        url, text, error = results[0]
+        self.assertEqual((urls[0], u'page 0 \u2713', None), (url, text, error))
+        url, text, error = [result for result in results if result[0].endswith('missing')][0]
+        self.assertEqual(None, text)
+        self.assertEqual(404, error.response.status_code)
+        self.assertEqual(3, self.server.most)
+
+    def test_fetch_urls_bounded(self):
+        urls = ('%s/%d' % (self.server.url, n) for n in range(100))
+        results = functions.fetch_urls(urls, workers=4)
+        next(results)
+        time.sleep(0.2)
+        # two per worker, plus the one taken
+        self.assertTrue(self.server.requests <= 4 * 2 + 1)
+        self.assertEqual(99, sum(1 for result in results))
+
+    def test_default_path(self):
+        cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.path
+        try:
+            cache = functions.HttpCache()
+        finally:
+            if cache_home is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = cache_home
+        # not the shared temp directory, where anyone could read pages or plant them
+        self.assertEqual(os.path.join(self.path, 'http-cache'), cache.path)
+        self.assertEqual(0700, os.stat(cache.path).st_mode & 0777)
+
+    def test_cache(self):
+        cache = functions.HttpCache(self.path)
+        urls = ['%s/%d' % (self.server.url, n) for n in range(5)]
+        first = sorted(functions.fetch_urls(urls, cache=cache))
+        second = sorted(functions.fetch_urls(urls, cache=cache))
+        self.assertEqual(first, second)
+        self.assertEqual(u'page 4 \u2713', second[4][1])
+        self.assertEqual(10, self.server.requests)
+        self.assertEqual(5, self.server.not_modified)
+
+
+class TestSeqBatch(unittest.TestCase):
+
+    def test_iterator(self):
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6]], list(functions.seq_batch(iter(range(7)), 3)))
+        self.assertEqual([[0, 1], [2]], list(functions.seq_batch(xrange(3), 2)))
+        self.assertEqual([], list(functions.seq_batch(iter([]), 3)))
+
+    def test_slices(self):
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6]], list(functions.seq_batch(range(7), 3)))
+        self.assertEqual([(0, 1), (2,)], list(functions.seq_batch((0, 1, 2), 2)))
+        batches = list(functions.seq_batch(array.array('i', range(5)), 2))
+        self.assertEqual([array.array('i', [0, 1]), array.array('i', [2, 3]), array.array('i', [4])], batches)
+
+    def test_bytes(self):
+        data = bytearray('abcdefg')
+        batches = list(functions.seq_batch(data, 3))
+        self.assertEqual(['abc', 'def', 'g'], [batch.tobytes() for batch in batches])
+        # the batches are views of data, not copies
+        data[0] = 'z'
+        self.assertEqual('zbc', batches[0].tobytes())
+        self.assertEqual(['ab', 'c'], [batch.tobytes() for batch in functions.seq_batch('abc', 2)])
+
+    def test_batch_map(self):
+        results = functions.batch_map(sum, iter(range(100)), 10, workers=4)
+        self.assertEqual(sum(range(100)), sum(result for batch, result in results))
+        results = list(functions.batch_map(len, range(25), 10, workers=2, mode='process'))
+        self.assertEqual([5, 10, 10], sorted(result for batch, result in results))
+
+    def test_batch_map_bounded(self):
+        read = []
+
+        def items():
+            for n in xrange(100000):
+                read.append(n)
+                yield n
+
+        results = functions.batch_map(len, items(), 10, workers=4, queue_size=3)
+        next(results)
+        time.sleep(0.1)
+        # the batch taken and three read ahead
+        self.assertTrue(len(read) <= 4 * 10)
+        self.assertEqual(9999, sum(1 for result in results))
+
+    def test_batch_map_error(self):
+        def check(batch):
+            if 13 in batch:
+                raise ValueError('unlucky')
+
+        self.assertRaises(ValueError, list, functions.batch_map(check, range(100), 10, workers=4))
+
+
+
+class TestIterparse(unittest.TestCase):
+
+    FEED = ('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+            '<feed xmlns="http://example.com/feed"><header><item>not this one</item></header><items>%s</items></feed>')
+
+    def feed(self, count):
+        return self.FEED % ''.join('<item id="%d">caf\xe9 %d</item>' % (n, n) for n in range(count))
+
+    def test_chunks(self):
+        doc = self.feed(1000)
+        chunks = (doc[n:n + 100] for n in range(0, len(doc), 100))
+        texts = []
+        for element in functions.iterparse_xml(chunks, path='items/item'):
+            texts.append(element.text)
+            # earlier items have been removed
+            self.assertEqual(None, element.getprevious())
+        self.assertEqual(1000, len(texts))
+        self.assertEqual(u'caf\xe9 999', texts[-1])
+
+    def test_unicode(self):
+        doc = self.feed(10).decode('latin-1')
+        chunks = [doc[:3], doc[3:30], doc[30:]]
+        texts = [element.text for element in functions.iterparse_xml(iter(chunks), path='/feed/items/item')]
+        self.assertEqual([u'caf\xe9 %d' % n for n in range(10)], texts)
+
+    def test_file(self):
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'feed.xml')
+            with open(filename, 'wb') as f:
+                f.write(self.feed(5))
+            tag = '{http://example.com/feed}item'
+            ids = [element.get('id') for element in functions.iterparse_xml(filename, tag=tag, chunk_size=16)]
+            self.assertEqual([None, '0', '1', '2', '3', '4'], ids)
+            with open(filename, 'rb') as f:
+                self.assertEqual(5, sum(1 for element in functions.iterparse_xml(f, path='/*/items/item')))
+        finally:
+            shutil.rmtree(path)
+
+    def test_wrapped_records(self):
+        doc = '<root>%s</root>' % ''.join('<group><item>%d</item></group>' % n for n in range(5000))
+        chunks = (doc[n:n + 500] for n in range(0, len(doc), 500))
+        root = None
+        count = 0
+        for element in functions.iterparse_xml(chunks, tag='item'):
+            root = element.getroottree().getroot()
+            self.assertEqual(str(count), element.text)
+            count += 1
+        self.assertEqual(5000, count)
+        # finished groups have been removed, leaving only the last one
+        self.assertTrue(len(root) <= 1)
+
+    def test_html(self):
+        html = '<html><body><ul>%s</ul><p>done</p>' % ''.join('<li>%d</li>' % n for n in range(50))
+        items = [element.text for element in functions.iterparse_html(iter([html[:40], html[40:]]), tag='li')]
+        self.assertEqual([str(n) for n in range(50)], items)
+
+
+
+class TestLxml(unittest.TestCase):
+
+    DOC = ('<items xmlns:a="http://example.com/a">%s</items>' %
+           ''.join('<item id="%d"><a:title>title %d</a:title><price currency="USD">%d.99</price></item>' % (n, n, n)
+                   for n in range(20)))
+    NS = {'a': 'http://example.com/a'}
+
+    def setUp(self):
+        self.items = functions.parse_xml(self.DOC).findall('item')
+
+    def test_xpath_cache(self):
+        self.assertTrue(functions.lxml_xpath('a:title', self.NS) is functions.lxml_xpath('a:title', dict(self.NS)))
+        self.assertFalse(functions.lxml_xpath('a:title', self.NS) is functions.lxml_xpath('a:title'))
+
+    def test_get_child(self):
+        item = self.items[3]
+        self.assertEqual('title 3', functions.lxml_get_child_value(item, 'a:title', self.NS))
+        self.assertEqual('USD', functions.lxml_get_attribute(item, 'price', 'currency'))
+        self.assertEqual(None, functions.lxml_get_child_value(item, 'missing'))
+        root = item.getparent()
+        self.assertRaises(ValueError, functions.lxml_get_child, root, 'item', None)
+
+    def test_extract(self):
+        spec = [('id', '@id'), ('title', 'a:title'), ('price', 'price'), ('currency', 'price/@currency'),
+                ('missing', 'missing')]
+        records = list(functions.lxml_extract(self.items, spec, self.NS))
+        self.assertEqual(20, len(records))
+        self.assertEqual(('5', 'title 5', '5.99', 'USD', None), records[5])
+        self.assertEqual('title 5', records[5].title)
+        self.assertEqual(str, type(records[5].id))
+        records = functions.lxml_extract(self.items, {'price': 'price', 'id': '@id'})
+        self.assertEqual(('id', 'price'), next(records)._fields)
+
+
+
+class TestDb(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE events (id INTEGER PRIMARY KEY, name TEXT, score REAL)')
+        self.conn.execute('CREATE INDEX events_name ON events (name)')
+
+    def test_insert(self):
+        functions.db_insert(self.conn, 'events', {'id': 1, 'name': 'a', 'score': 1.5})
+        functions.db_insert(self.conn, 'events', {'name': 'b', 'id': 2})
+        self.assertEqual([(1, 'a', 1.5), (2, 'b', None)], self.conn.execute('SELECT * FROM events').fetchall())
+
+    def test_bulk_dicts(self):
+        rows = ({'id': n, 'name': 'name%d' % n, 'score': n / 2.0, 'ignored': 1} for n in range(1000))
+        self.assertEqual(1000, functions.db_bulk_insert(self.conn, 'events', rows, fields=['id', 'name', 'score'],
+                                                        chunk_size=300))
+        self.assertEqual((999, 'name999', 499.5), self.conn.execute('SELECT * FROM events WHERE id = 999').fetchone())
+
+    def test_bulk_tuples(self):
+        rows = ((n, 'name%d' % n, None) for n in range(10))
+        self.assertEqual(10, functions.db_bulk_insert(self.conn, 'events', rows))
+        names = [('x',), ('y',)]
+        self.assertEqual(2, functions.db_bulk_insert(self.conn, 'events', names, fields=['name']))
+        self.assertEqual(12, self.conn.execute('SELECT COUNT(*) FROM events').fetchone()[0])
+        self.assertEqual(0, functions.db_bulk_insert(self.conn, 'events', []))
+
+    def test_bulk_options(self):
+        rows = [(n, 'name%d' % (n % 3), 0) for n in range(100)]
+        functions.db_bulk_insert(self.conn, 'events', rows, pragmas={'synchronous': 'OFF'}, defer_indexes=True)
+        self.assertEqual(2, self.conn.execute('PRAGMA synchronous').fetchone()[0])
+        indexes = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+        self.assertEqual([('events_name',)], indexes)
+        functions.db_bulk_insert(self.conn, 'events', [(1, 'replaced', 0)], replace=True)
+        self.assertEqual('replaced', self.conn.execute('SELECT name FROM events WHERE id = 1').fetchone()[0])
+
+    def test_select(self):
+        functions.db_bulk_insert(self.conn, 'events', [(1, 'a', 1.5), (2, 'b', 2.5)])
+        self.assertEqual([{'id': 1, 'name': 'a', 'score': 1.5}, {'id': 2, 'name': 'b', 'score': 2.5}],
+                         functions.db_select(self.conn, 'SELECT * FROM events ORDER BY id'))
+        self.assertEqual([{'total': 4.0}],
+                         functions.db_select(self.conn, 'SELECT SUM(score) AS total FROM (SELECT score FROM events)'))
+        self.assertEqual([{'name': 'b'}], functions.db_select(self.conn, 'SELECT name FROM events WHERE id = ?', (2,)))
+
+    def test_iter(self):
+        functions.db_bulk_insert(self.conn, 'events', ((n, 'name%d' % n, n / 2.0) for n in range(25)))
+        rows = list(functions.db_iter(self.conn, 'SELECT id, name AS label, COUNT(*) FROM events GROUP BY id',
+                                      batch_size=10))
+        self.assertEqual(25, len(rows))
+        self.assertEqual(('id', 'label', '_2'), rows[0]._fields)
+        self.assertEqual((3, 'name3', 1), rows[3])
+        self.assertEqual('name3', rows[3].label)
+
+    def test_iter_columnar(self):
+        functions.db_bulk_insert(self.conn, 'events', ((n, 'name%d' % n, n / 2.0) for n in range(25)))
+        batches = list(functions.db_iter(self.conn, 'SELECT * FROM events WHERE id >= ?', (5,), batch_size=10,
+                                         columnar=True))
+        self.assertEqual([10, 10], [len(batch['id']) for batch in batches])
+        self.assertEqual(['id', 'name', 'score'], batches[0].keys())
+        self.assertEqual(tuple(range(15, 25)), batches[1]['id'])
+        self.assertEqual([], list(functions.db_iter(self.conn, 'SELECT * FROM events WHERE id < 0')))
+
+    def test_bulk_error(self):
+        rows = [(n, 'name', 0) for n in range(10)] + [(0, 'duplicate', 0)]
+        self.assertRaises(sqlite3.IntegrityError, functions.db_bulk_insert, self.conn, 'events', rows,
+                          chunk_size=4, defer_indexes=True)
+        # the first two chunks were committed and the failed one rolled back
+        self.assertEqual(8, self.conn.execute('SELECT COUNT(*) FROM events').fetchone()[0])
+        indexes = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+        self.assertEqual([('events_name',)], indexes)
+
+    def test_bulk_autocommit(self):
+        conn = sqlite3.connect(':memory:', isolation_level=None)
+        conn.execute('CREATE TABLE events (id INTEGER PRIMARY KEY, name TEXT, score REAL)')
+        rows = [(n, 'name', 0) for n in range(10)] + [(0, 'duplicate', 0)]
+        self.assertRaises(sqlite3.IntegrityError, functions.db_bulk_insert, conn, 'events', rows, chunk_size=4)
+        # each chunk is still one transaction, so the failed one was rolled back whole
+        self.assertEqual(8, conn.execute('SELECT COUNT(*) FROM events').fetchone()[0])
+        self.assertEqual(None, conn.isolation_level)
+        self.assertEqual(1, functions.db_bulk_insert(self.conn, 'events', [(20, 'a', 0)]))
+        self.assertEqual('', self.conn.isolation_level)
+
+
+class TestCsv(unittest.TestCase):
+
+    CSV = ('id,name,day,score\n'
+           '1,"Smith, Jo",2015-01-02,1.5\n'
+           '2,"say ""hi""",2015-01-03,\n'
+           'id,name,day,score\n'
+           '3,plain,2015-01-04,3.5\n')
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'export.csv')
+        with open(self.filename, 'wb') as f:
+            f.write(self.CSV)
+        self.gzipped = self.filename + '.gz'
+        with contextlib.closing(gzip.open(self.gzipped, 'wb')) as f:
+            f.write(self.CSV)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_read_csv(self):
+        rows = functions.read_csv(self.filename)
+        self.assertEqual(5, len(rows))
+        self.assertEqual(['1', 'Smith, Jo', '2015-01-02', '1.5'], rows[1])
+        self.assertEqual(['2', 'say "hi"', '2015-01-03', ''], rows[2])
+
+    def test_iter_csv(self):
+        for filename in (self.filename, self.gzipped):
+            rows = list(functions.iter_csv(filename, header=True, repeated_headers=True))
+            self.assertEqual([['1', 'Smith, Jo', '2015-01-02', '1.5'], ['2', 'say "hi"', '2015-01-03', ''],
+                              ['3', 'plain', '2015-01-04', '3.5']], rows)
+        # by default a row equal to the header is data
+        rows = list(functions.iter_csv(StringIO('name\nname\nJo\n'), header=True))
+        self.assertEqual([['name'], ['Jo']], rows)
+
+    def test_types(self):
+        rows = list(functions.iter_csv(self.gzipped, ['score', 'id', 'day'],
+                                       {'id': int, 'score': 'float', 'day': 'date'}, header=True,
+                                       repeated_headers=True))
+        self.assertEqual([1.5, 1, datetime(2015, 1, 2)], rows[0])
+        self.assertEqual([None, 2, datetime(2015, 1, 3)], rows[1])
+        rows = list(functions.iter_csv(StringIO('1,a\n2,b\n'), types=[int]))
+        self.assertEqual([[1, 'a'], [2, 'b']], rows)
+        rows = list(functions.iter_csv(StringIO('1,a\n2,b\n'), [1], types={1: str.upper}))
+        self.assertEqual([['A'], ['B']], rows)
+        self.assertRaises(ValueError, list, functions.iter_csv(self.filename, ['id']))
+
+    def test_columns(self):
+        chunks = list(functions.iter_csv_columns(self.filename, ['id', 'score', 'name'],
+                                                 {'id': int, 'score': float}, header=True, chunk_size=2,
+                                                 repeated_headers=True))
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(['id', 'score', 'name'], chunks[0].keys())
+        self.assertEqual(array.array('l', [1, 2]), chunks[0]['id'])
+        self.assertEqual(1.5, chunks[0]['score'][0])
+        self.assertTrue(math.isnan(chunks[0]['score'][1]))
+        self.assertEqual(['Smith, Jo', 'say "hi"'], chunks[0]['name'])
+        self.assertEqual(['plain'], chunks[1]['name'])
+        self.assertRaises(ValueError, list, functions.iter_csv_columns(self.filename, ['score'], {'score': int},
+                                                                       header=True))
+
+    def test_ragged_columns(self):
+        for csv, row in [('a,b,c\n1,2,3\n4,5\n', 2), ('a,b\n1,2\n3,4\n5,6,7\n', 3)]:
+            try:
+                list(functions.iter_csv_columns(StringIO(csv), header=True, chunk_size=2))
+                self.fail('no ValueError')
+            except ValueError as e:
+                self.assertTrue(str(e).startswith('Data row %d ' % row), e)
+        self.assertRaises(ValueError, list, functions.iter_csv_columns(StringIO('1,2\n3\n')))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        chunk = next(functions.iter_csv_columns(self.gzipped, types={'id': int, 'score': float}, header=True,
+                                                numpy=True, repeated_headers=True))
+        self.assertEqual([1, 2, 3], chunk['id'].tolist())
+        self.assertEqual('int64', str(chunk['id'].dtype))
+        self.assertEqual(5.0, numpy.nansum(chunk['score']))
+        self.assertEqual('plain', chunk['name'][2])
+
+
+class TestDoEach(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+
+    def test_serial(self):
+        seen = []
+        functions.do_each(range(10), seen.append, report_every=3)
+        self.assertEqual(range(10), seen)
+        self.assertTrue('Finished. 10 items processed' in sys.stdout.getvalue())
+
+    def test_threads(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0, 'done': []}
+
+        def work(x):
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+                state['done'].append(x)
+
+        functions.do_each(iter(range(40)), work, report_every=10, workers=4, total=40)
+        self.assertEqual(range(40), sorted(state['done']))
+        self.assertEqual(4, state['most'])
+        self.assertTrue('/sec' in sys.stdout.getvalue())
+
+    def test_bounded(self):
+        read = []
+        release = threading.Event()
+
+        def items():
+            for n in range(1000):
+                read.append(n)
+                yield n
+
+        def work(x):
+            release.wait()
+
+        thread = threading.Thread(target=functions.do_each, args=(items(), work),
+                                  kwargs={'workers': 2, 'queue_size': 4})
+        thread.start()
+        time.sleep(0.1)
+        # two running and two queued
+        self.assertTrue(len(read) <= 4)
+        release.set()
+        thread.join()
+        self.assertEqual(1000, len(read))
+
+    def test_bounded_by_consumer(self):
+        read = []
+
+        def items():
+            for n in range(1000):
+                read.append(n)
+                yield n
+
+        results = iter(functions._ParallelMap(items(), lambda x: x, workers=4, queue_size=8))
+        for n in range(3):
+            next(results)
+            time.sleep(0.05)
+        # the workers are idle, but only queue_size items are read ahead of the results taken
+        self.assertTrue(len(read) <= 3 + 8)
+        self.assertEqual(997, sum(1 for result in results))
+        self.assertEqual(1000, len(read))
+
+    def test_errors(self):
+        self.assertRaises(ValueError, functions.do_each, range(20), cube, workers=3)
+        failed = functions.do_each(range(20), cube, workers=3, errors='collect')
+        self.assertEqual(1, len(failed))
+        self.assertEqual(13, failed[0][0])
+        self.assertEqual('unlucky', str(failed[0][1]))
+
+    def test_processes(self):
+        failed = functions.do_each(range(20), cube, workers=2, mode='process', errors='collect')
+        self.assertEqual([13], [item for item, error in failed])
+        self.assertRaises(ValueError, functions.do_each, range(20), cube, workers=2, mode='process')
+
+
+if __name__ == '__main__':
+    unittest.main()
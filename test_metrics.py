@@ -0,0 +1,61 @@
+import threading
+import unittest
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Metrics()
+
+    def test_counters(self):
+        self.registry.inc('requests', method='get')
+        self.registry.inc('requests', 2, method='get')
+        self.registry.inc('requests', method='put')
+        self.assertEqual(3, self.registry.counter('requests', method='get'))
+        self.assertEqual(1, self.registry.counter('requests', method='put'))
+        self.assertEqual(0, self.registry.counter('requests'))
+
+    def test_histogram(self):
+        for n in range(100):
+            self.registry.observe('latency', n / 100.0, buckets=(.1, .5, 1))
+        h = self.registry.histogram('latency')
+        self.assertEqual(100, h.count)
+        self.assertEqual([11, 40, 49, 0], h.counts)
+        self.assertEqual(.5, h.percentile(50))
+        self.assertEqual(.99, h.percentile(99))
+        self.assertAlmostEqual(.495, h.mean())
+
+    def test_threads(self):
+        def work():
+            for n in range(1000):
+                self.registry.inc('count')
+                self.registry.observe('value', n)
+        threads = [threading.Thread(target=work) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4000, self.registry.counter('count'))
+        self.assertEqual(4000, self.registry.histogram('value').count)
+
+    def test_export_text(self):
+        self.registry.inc('requests_total', method='get')
+        self.registry.observe('seconds', .3, buckets=(.1, 1), method='get')
+        self.assertEqual('\n'.join(['requests_total{method="get"} 1',
+                                    'seconds_bucket{method="get",le="0.1"} 0',
+                                    'seconds_bucket{method="get",le="1"} 1',
+                                    'seconds_bucket{method="get",le="+Inf"} 1',
+                                    'seconds_sum{method="get"} 0.3',
+                                    'seconds_count{method="get"} 1']) + '\n',
+                         self.registry.export_text())
+
+    def test_summary(self):
+        with self.registry.timer('seconds', method='get'):
+            pass
+        self.assertTrue(self.registry.summary().startswith('seconds{method="get"} count=1 '))
+
+
+if __name__ == '__main__':
+    unittest.main()